@@ -0,0 +1,216 @@
+"""
+Time how long each of the things you can do with a Runner takes, e.g.
+
+    python scripts/benchmark.py --iterations 20 --output bench_output.txt
+
+By default this benchmarks the tmux hecate would use anyway (i.e. the one in
+HECATE_TMUX_BINARY if that is set). Pass --tmux, possibly more than once, to
+pick binaries, or --all-muxen to use every one built by build_muxen.py. Each
+binary is benchmarked in a process of its own, as hecate only reads
+HECATE_TMUX_BINARY when it is imported.
+
+Results are written as JSON with the percentiles of the time each operation
+took, in seconds. Pass --baseline with the results of an earlier run to exit
+with a non-zero status if any operation's median got more than --threshold
+times slower for the same tmux version.
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+TMUXEN = os.path.expanduser("~/.tmuxen")
+
+PERCENTILES = [50, 90, 99]
+
+
+def percentile(values, p):
+    """
+    The p'th percentile of the sorted list values, interpolating linearly
+    between the closest ranks.
+    """
+    if len(values) == 1:
+        return values[0]
+    rank = (len(values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarise(timings):
+    result = {}
+    for operation, values in sorted(timings.items()):
+        values = sorted(values)
+        summary = {
+            "count": len(values),
+            "min": values[0],
+            "max": values[-1],
+            "mean": sum(values) / len(values),
+        }
+        for p in PERCENTILES:
+            summary["p%d" % (p,)] = percentile(values, p)
+        result[operation] = summary
+    return result
+
+
+def run_benchmarks(iterations, repeat, options):
+    from hecate.hecate import Runner
+    timings = {}
+
+    def timed(operation, f, *args, **kwargs):
+        start = time.perf_counter()
+        result = f(*args, **kwargs)
+        timings.setdefault(operation, []).append(time.perf_counter() - start)
+        return result
+
+    for i in range(iterations):
+        h = timed("startup", Runner, "cat", **options)
+        try:
+            for j in range(repeat):
+                timed("screenshot", h.screenshot)
+                timed("press", h.press, "a")
+                timed("write", h.write, "b")
+                timed(
+                    "batch", h.batch().press("c").write("d").press("e").send
+                )
+                marker = "m%d.%d" % (i, j)
+                h.write(marker)
+                timed("await_text", h.await_text, marker)
+                h.press("Enter")
+            h.press("Enter")
+            h.press("C-d")
+            timed("await_exit", h.await_exit)
+        finally:
+            timed("shutdown", h.shutdown)
+    return timings
+
+
+def worker(arguments):
+    from hecate.tmux import TMUX, tmux_version
+    options = {}
+    if arguments.control_mode:
+        options["control_mode"] = True
+    if arguments.backend == "pty":
+        from hecate.backends import PtyBackend
+        options["backend"] = PtyBackend
+    start = time.perf_counter()
+    timings = run_benchmarks(arguments.iterations, arguments.repeat, options)
+    version = tmux_version()
+    return {
+        "tmux": TMUX,
+        "tmux_version": version and "%d.%d" % version,
+        "backend": arguments.backend,
+        "control_mode": arguments.control_mode,
+        "iterations": arguments.iterations,
+        "repeat": arguments.repeat,
+        "elapsed": time.perf_counter() - start,
+        "operations": summarise(timings),
+    }
+
+
+def run_worker(binary, arguments):
+    env = dict(os.environ)
+    if binary is not None:
+        env["HECATE_TMUX_BINARY"] = binary
+    command = [
+        sys.executable, os.path.abspath(__file__), "--worker",
+        "--iterations", str(arguments.iterations),
+        "--repeat", str(arguments.repeat),
+        "--backend", arguments.backend,
+    ]
+    if arguments.control_mode:
+        command.append("--control-mode")
+    output = subprocess.check_output(command, env=env)
+    return json.loads(output.decode('utf-8'))
+
+
+def regressions(results, baseline, threshold):
+    def key(result):
+        return (
+            result["tmux_version"], result["backend"], result["control_mode"]
+        )
+    previous = {key(r): r["operations"] for r in baseline["results"]}
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        for operation, summary in sorted(result["operations"].items()):
+            if operation not in old:
+                continue
+            before = old[operation]["p50"]
+            after = summary["p50"]
+            if before > 0 and after > before * threshold:
+                yield "%s %s: median %.6fs -> %.6fs" % (
+                    result["tmux_version"], operation, before, after
+                )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark hecate's operations.")
+    parser.add_argument(
+        "--tmux", action="append", default=[],
+        help="A tmux binary to benchmark. May be given more than once.")
+    parser.add_argument(
+        "--all-muxen", action="store_true",
+        help="Benchmark every tmux in %s." % (TMUXEN,))
+    parser.add_argument("--iterations", type=int, default=10,
+                        help="How many Runners to start for each tmux.")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="How many times to repeat each operation on "
+                             "each Runner.")
+    parser.add_argument("--backend", choices=["tmux", "pty"], default="tmux")
+    parser.add_argument("--control-mode", action="store_true")
+    parser.add_argument("--output", help="Where to write the results. "
+                                         "Defaults to stdout.")
+    parser.add_argument("--baseline",
+                        help="Results of an earlier run to compare with.")
+    parser.add_argument("--threshold", type=float, default=1.5)
+    parser.add_argument("--worker", action="store_true",
+                        help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.worker:
+        json.dump(worker(arguments), sys.stdout)
+        return
+
+    binaries = list(arguments.tmux)
+    if arguments.all_muxen:
+        binaries.extend(sorted(glob.glob(os.path.join(TMUXEN, "tmux-*"))))
+    if not binaries:
+        binaries = [None]
+    results = []
+    for binary in binaries:
+        print("Benchmarking %s" % (binary or "the default tmux",),
+              file=sys.stderr)
+        results.append(run_worker(binary, arguments))
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "results": results,
+    }
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if arguments.output is None:
+        print(data)
+    else:
+        with open(arguments.output, "w") as o:
+            o.write(data)
+            o.write("\n")
+
+    if arguments.baseline is not None:
+        with open(arguments.baseline) as i:
+            baseline = json.load(i)
+        slower = list(regressions(results, baseline, arguments.threshold))
+        for line in slower:
+            print("Regression: " + line, file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -13,10 +13,10 @@ def trap_signal(name):
 
 
 def main():
-    print(os.getpid())
     for k in vars(signal):
         if k[:3] == "SIG":
             trap_signal(k)
+    print(os.getpid())
     sys.stdin.read()
 
 if __name__ == '__main__':
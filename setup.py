@@ -10,8 +10,7 @@
 
 # END HEADER
 
-from distutils.core import setup
-from setuptools import find_packages
+from setuptools import setup, find_packages
 import os
 
 
@@ -34,5 +33,8 @@ setup(
     description='A selenium style testing library for console applications',
     zip_safe=False,
     long_description=open(README).read(),
-    tests_require=['pytest']
+    tests_require=['pytest'],
+    entry_points={
+        'pytest11': ['hecate = hecate.pytest_plugin'],
+    },
 )
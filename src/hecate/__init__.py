@@ -1,6 +1,10 @@
-from hecate.hecate import Runner
+from hecate.hecate import Runner, Region, await_any, await_all
+from hecate.backends import Backend, TmuxBackend, PtyBackend
+from hecate.pool import RunnerPool, Scenario, WarmUp
+from hecate.snapshot import Snapshot
 from hecate.version import __version__
 
 __all__ = [
-    'Runner', '__version__'
+    'Runner', 'Region', 'await_any', 'await_all', 'RunnerPool', 'Scenario',
+    'WarmUp', 'Snapshot', 'Backend', 'TmuxBackend', 'PtyBackend', '__version__'
 ]
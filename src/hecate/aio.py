@@ -0,0 +1,404 @@
+"""
+An asyncio counterpart to hecate.hecate.Runner, for driving many console apps
+from a single event loop. Everything that would block in Runner (running tmux
+commands, waiting for reports from the controller, waiting for processes to
+die) is awaitable here instead.
+
+This module uses async/await syntax and asynchronous generators, so needs
+Python 3.6 or later.
+"""
+
+from hecate.hecate import Timeout, AbnormalExit, HecateWillHauntYou, \
+    ControllerReports, launch_command, has_exited
+from hecate.backends import HECATE_SESSION_NAME, random_id
+from hecate.tmux import TMUX, CommandFailed, DeadServer, _is_dead_server, \
+    _extract_names, tmux_supports, CAPTURE_TO_STDOUT_VERSION
+from hecate import instrument
+import hecate.runner as runner
+import asyncio
+import os
+import signal
+import tempfile
+import time
+import traceback
+from warnings import warn
+
+
+class AsyncTmux(object):
+    """
+    The subset of hecate.tmux.Tmux that Runners need, with commands run as
+    asyncio subprocesses.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    async def start(self):
+        try:
+            await self.execute_command("list-sessions")
+        except CommandFailed:
+            await self.new_session()
+
+    async def execute_command(self, *command):
+        start = time.perf_counter()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                TMUX, "-u", "-L", self.name, *map(str, command),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+            )
+            output, _ = await process.communicate()
+        finally:
+            instrument.record_command(command, start, "fork")
+        if process.returncode != 0:
+            if _is_dead_server(output):
+                raise DeadServer(output)
+            raise CommandFailed(output)
+        return output.decode('utf-8')
+
+    async def new_session(
+        self, width=80, height=24, name=None, command=None
+    ):
+        arguments = ["new-session", "-d", "-x", width, "-y", height]
+        if name is not None:
+            arguments.extend(["-s", name])
+        if command is not None:
+            arguments.append(command)
+        await self.execute_command(*arguments)
+
+    async def kill_session(self, name):
+        await self.execute_command("kill-session", "-t", name)
+
+    async def send_key(self, pane, key):
+        await self.execute_command("send-keys", "-t", pane, key)
+
+    async def new_buffer(self, data):
+        with temp_file() as t:
+            with open(t, "w", encoding="utf-8") as o:
+                o.write(data)
+            await self.execute_command("load-buffer", t)
+
+    async def capture_pane(self, pane):
+        if tmux_supports(CAPTURE_TO_STDOUT_VERSION):
+            return await self.execute_command(
+                "capture-pane", "-p", "-t", pane)
+        buffers = _extract_names(await self.execute_command("list-buffers"))
+        if not buffers:
+            await self.new_buffer("a_buffer")
+            buffers = _extract_names(
+                await self.execute_command("list-buffers"))
+        await self.execute_command(
+            "capture-pane", "-b", buffers[0], "-t", pane)
+        with temp_file() as t:
+            await self.execute_command("save-buffer", "-b", buffers[0], t)
+            with open(t, encoding="utf-8") as o:
+                return o.read()
+
+    async def shutdown(self):
+        try:
+            await self.execute_command("kill-server")
+        except CommandFailed:
+            pass
+
+
+class temp_file(object):
+    def __enter__(self):
+        fd, self.name = tempfile.mkstemp()
+        os.close(fd)
+        return self.name
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            os.unlink(self.name)
+        except FileNotFoundError:
+            pass
+
+
+async def wait_for_death(pid, timeout):
+    """
+    Like hecate.hecate.wait_for_death, but waiting on the event loop rather
+    than blocking it.
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        fd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return True
+    except (AttributeError, OSError):
+        fd = None
+    if fd is not None:
+        died = loop.create_future()
+        loop.add_reader(fd, _resolve, died)
+        try:
+            await asyncio.wait_for(died, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+    deadline = time.time() + timeout
+    delay = 0.001
+    while True:
+        if has_exited(pid):
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+
+
+async def must_die(pid):
+    """
+    Like hecate.hecate.must_die, but waiting on the event loop rather than
+    blocking it.
+    """
+    try:
+        for grace_period in [0.01, 1, 2]:
+            os.kill(pid, signal.SIGTERM)
+            if await wait_for_death(pid, grace_period):
+                return
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AsyncRunner(object):
+    """
+    An AsyncRunner manages a running console app just like a Runner, but all
+    of its operations that talk to tmux or wait for something are coroutines.
+
+    Creating an AsyncRunner does not start anything: you must await start()
+    first and shutdown() once you are done. Using it as an async context
+    manager does both for you:
+
+        async with AsyncRunner("vim") as h:
+            await h.await_text("VIM")
+    """
+    print_on_exit = False
+
+    def __init__(
+        self,
+        *command,
+        width=80, height=24,
+        wait_interval=0.01, default_timeout=1
+    ):
+        """
+        Takes the same arguments as Runner, and they mean the same things.
+        """
+        self.command = command
+        self.width = width
+        self.height = height
+        self.wait_interval = wait_interval
+        self.default_timeout = default_timeout
+        self.exit_seen = False
+        self.started = False
+        self.shutdown_called = False
+        self.tmux = None
+        self.reports = None
+        self.last_screenshot = None
+
+    async def start(self):
+        """
+        Start the command running and wait for it to launch.
+        """
+        assert not self.started
+        self.started = True
+        try:
+            self.reports = ControllerReports()
+            self.report_file = self.reports.path
+            self.tmux = AsyncTmux(random_id())
+            self.tmux_id = self.tmux.name
+            await self.tmux.start()
+            await self.tmux.new_session(
+                width=self.width, height=self.height,
+                name=HECATE_SESSION_NAME,
+                command=launch_command(self.report_file, self.command),
+            )
+            sessions = [
+                l.strip() for l in (await self.tmux.execute_command(
+                    "list-sessions", "-F", "#{session_name}")).splitlines()
+            ]
+            sessions.remove(HECATE_SESSION_NAME)
+            for s in sessions:
+                await self.tmux.kill_session(s)
+            await self.screenshot()
+            if await self.await_report(runner.CHILD) is None:
+                raise Timeout(
+                    "Process failed to start"
+                )
+            await self.screenshot()
+            report = self.report_variables()
+            os.kill(report[runner.CONTROLLER], signal.SIGUSR1)
+            self.child_pid = report[runner.CHILD]
+        except:
+            self.shutdown_called = True
+            if self.reports is not None:
+                self.reports.close()
+            if self.tmux is not None:
+                await self.tmux.shutdown()
+            raise
+        return self
+
+    async def shutdown(self):
+        """
+        Kill this instance and free all resources associated with it.
+
+        This is safe to call multiple times but is a no-op the second time. It
+        will be automatically called if you are using this as an async
+        context manager.
+        """
+        if self.shutdown_called or not self.started:
+            self.shutdown_called = True
+            return
+        self.shutdown_called = True
+        try:
+            if not self.exit_seen:
+                try:
+                    await self.await_exit()
+                except Timeout:
+                    pass
+            if self.print_on_exit:
+                print(self.last_screenshot)
+        finally:
+            report = self.report_variables()
+            if runner.EXIT_STATUS in report:
+                await self.release_controller()
+            for c in [runner.CHILD, runner.CONTROLLER]:
+                try:
+                    await must_die(report[c])
+                except KeyError:
+                    pass
+                except:
+                    traceback.print_exc()
+            self.reports.close()
+            await self.tmux.shutdown()
+
+    def __del__(self):
+        if self.started and not self.shutdown_called:
+            warn(HecateWillHauntYou(
+                "Garbage collecting AsyncRunner instance which has not been "
+                "shut down properly. Always await shutdown on your "
+                "AsyncRunner instances, ideally by using them as async "
+                "context managers."))
+
+    async def screenshot(self):
+        """
+        Return a string representing the current state of the screen.
+        """
+        try:
+            result = await self.tmux.capture_pane(0)
+            self.last_screenshot = result
+            return result
+        except DeadServer:
+            return self.last_screenshot
+
+    async def press(self, key):
+        """
+        Press the key identified by key-press, as for Runner.press.
+        """
+        await self.tmux.send_key(0, key)
+
+    async def write(self, text):
+        """
+        Write this as text to the console as it is, as for Runner.write.
+        """
+        await self.tmux.new_buffer(text)
+        await self.tmux.execute_command("paste-buffer")
+
+    async def await_text(self, text, timeout=None):
+        """
+        Wait for 'text' to appear on the screen, accounting for line wrapping.
+        If timeout (or default timeout if not set) seconds elapse first, raise
+        a Timeout error.
+        """
+        async for _ in self.poll_until_timeout(timeout):
+            screen = await self.screenshot()
+            munged = screen.replace('\n', '')
+            if text in munged:
+                return
+        raise Timeout("Timeout while waiting for text %r to appear" % (text,))
+
+    async def await_exit(self, timeout=None):
+        """
+        Wait for the process to exit. If it exits with a non-zero status code,
+        AbnormalExit will be raised. If timeout or default_timeout seconds pass
+        without it exiting, raise a Timeout.
+        """
+        status = await self.await_report(runner.EXIT_STATUS, timeout)
+        if status is not None:
+            self.exit_seen = True
+            await self.screenshot()
+            if status != 0:
+                raise AbnormalExit(
+                    "Process exited with status %d" % (status,))
+            else:
+                return
+        await self.screenshot()
+        raise Timeout("Timeout while waiting for process to exit")
+
+    async def release_controller(self):
+        controller = self.report_variables()[runner.CONTROLLER]
+        try:
+            os.kill(controller, signal.SIGUSR1)
+        except ProcessLookupError:
+            return
+        await wait_for_death(controller, runner.RELEASE_TIMEOUT)
+
+    def kill(self, sig):
+        """
+        Send a signal to the running process. sig is either an integer signal
+        number or the name of the signal.
+        """
+        if isinstance(sig, str):
+            sig = getattr(signal, sig)
+        os.kill(self.child_pid, sig)
+
+    async def poll_until_timeout(self, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        start = time.time()
+        while time.time() <= start + timeout:
+            yield
+            await asyncio.sleep(self.wait_interval)
+
+    def report_variables(self):
+        return self.reports.read()
+
+    async def await_report(self, field, timeout=None):
+        """
+        Wait for the controller process to report field and return its value,
+        or None if timeout (or default timeout if not set) seconds elapse
+        first.
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+        loop = asyncio.get_event_loop()
+        deadline = time.time() + timeout
+        while True:
+            report = self.report_variables()
+            if field in report:
+                return report[field]
+            remaining = deadline - time.time()
+            if remaining < 0 or self.reports.closed:
+                return None
+            readable = loop.create_future()
+            loop.add_reader(self.reports.fileno(), _resolve, readable)
+            try:
+                await asyncio.wait_for(readable, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                loop.remove_reader(self.reports.fileno())
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.shutdown()
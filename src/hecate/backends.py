@@ -0,0 +1,1044 @@
+"""
+Backends are what a Runner uses to provide the terminal its command runs in.
+The default TmuxBackend runs it inside a tmux server. PtyBackend instead runs
+it on a pty that hecate opens itself, and keeps track of the screen with an
+in-process terminal model, so does not need tmux at all.
+
+A backend is constructed with the argv to run (usually wrapped in the runner
+program that reports back to hecate) and the width and height of the terminal
+to run it in, plus any backend specific keyword arguments. Backends that can
+find out the pid and exit status of a command for themselves can also be
+asked to run it as it is, by passing direct=True.
+"""
+
+from hecate.tmux import Tmux, CommandFailed, DeadServer, tmux_supports, \
+    tmux_version, SEND_LITERAL_VERSION, PRINT_FORMAT_VERSION, \
+    CAPTURE_TO_STDOUT_VERSION, RESIZE_WINDOW_VERSION, DIRECT_LAUNCH_VERSION, \
+    BROKEN_PIPE_PANE_VERSION, PANE_STATE_FORMAT_VERSION
+from hecate.terminal import Screen, encode_key
+from hecate.snapshot import Snapshot
+from hecate import recorder
+import binascii
+import fcntl
+import os
+import pty
+import re
+import select
+import shlex
+import signal
+import struct
+import subprocess
+import sys
+import termios
+import threading
+import time
+
+
+HECATE_SESSION_NAME = "hecate_runner"
+
+LINE_BREAK = re.compile("[\r\n]")
+
+# How list-panes describes a pane's history, e.g. "[history 22/2000, 791
+# bytes]", for versions of tmux without a format for it.
+HISTORY_SIZE = re.compile(r"\[history (\d+)/")
+
+RECORDER_PROGRAM = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "recorder.py"))
+
+# How long to wait for the recorder to write out the end of a recording once
+# we have stopped sending it output.
+RECORDING_TIMEOUT = 1
+
+# How many of the last lines read from a pane's history we look for to work
+# out where we got to, in case tmux has thrown old history away since.
+ANCHOR_LINES = 8
+
+# Set before starting a command directly, so that its pane stays around with
+# the command's last screen on it after it exits, until we have seen that it
+# did and how.
+#
+# tmux (3.3a at least) also throws away anything the command wrote that it
+# has not read yet as soon as it notices the command exit, unless the pane is
+# piped somewhere, in which case it reads what it can first. So every new
+# pane is piped to nowhere, by hooks that run in the same breath as the
+# command that creates it, before tmux can notice anything. Respawned panes
+# keep their pipe.
+DRAIN_OUTPUT = "pipe-pane -o 'cat > /dev/null'"
+KEEP_DEAD_PANES = [
+    ["set-option", "-g", "-w", "remain-on-exit", "on"],
+    ["set-option", "-g", "-w", "remain-on-exit-format", ""],
+] + [
+    ["set-hook", "-g", hook, DRAIN_OUTPUT]
+    for hook in ["after-new-session", "after-new-window", "after-split-window"]
+]
+
+# Nor does it tell control mode clients about the last of what a command
+# launched directly wrote if the command exits before it has, so when waiting
+# to be told about output from one we look at the screen at least this often
+# anyway.
+DIRECT_OUTPUT_WAIT = 0.1
+
+# The redirection that gives a command launched directly its spare copy of
+# its terminal (see pane_command).
+HOLD_TERMINAL = "9<&0"
+
+
+def random_id():
+    return binascii.hexlify(os.urandom(8)).decode('ascii')
+
+
+def start_session(tmux, width, height, command, history_limit=None):
+    """
+    Create the session that Hecate runs command in on this tmux server, with
+    a window of the given size, and get rid of any other sessions (e.g. the
+    default one created when the server started) so that it is the only one.
+
+    If history_limit is set, that is how many lines of scrollback panes in
+    the session keep, rather than tmux's default.
+    """
+    if history_limit is not None:
+        # Panes take their limit from the option when they are created.
+        tmux.execute_command(
+            "set-option", "-g", "history-limit", history_limit)
+    tmux.new_session(
+        width=width, height=height, name=HECATE_SESSION_NAME,
+        command=command
+    )
+    sessions = [
+        l.strip() for l in tmux.execute_command(
+            "list-sessions", "-F", "#{session_name}").splitlines()
+    ]
+    sessions.remove(HECATE_SESSION_NAME)
+    for s in sessions:
+        tmux.kill_session(s)
+
+
+def pane_command(argv, direct=False):
+    """
+    The shell command line that tmux should run in a pane to run argv.
+    """
+    command = ' '.join(map(shlex.quote, argv))
+    if direct:
+        # tmux runs the command with sh -c, which then gets out of the way,
+        # so that the pane's pid is the command's.
+        #
+        # The command is then the only thing with the pane's terminal open,
+        # so if it closes it before exiting (as e.g. cat does on the way
+        # out) tmux sees it close, and closes its end in turn, while the
+        # command is still running. That hangs up the terminal, killing the
+        # command with SIGHUP in place of its real exit status. So it gets a
+        # spare copy of the terminal that stays open until it exits.
+        command = "exec " + command + " " + HOLD_TERMINAL
+    return command
+
+
+def unread_input(tty):
+    """
+    How many bytes typed into the terminal whose device is tty are waiting
+    for the program in it to read them, or None if we cannot tell (e.g.
+    because the terminal has gone). In canonical mode only complete lines
+    count.
+    """
+    try:
+        fd = os.open(tty, os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+    except OSError:
+        return None
+    try:
+        result = fcntl.ioctl(fd, termios.FIONREAD, struct.pack("i", 0))
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    return struct.unpack("i", result)[0]
+
+
+def split_rows(screen):
+    """
+    Split a screenshot, in which every row is followed by a newline, into a
+    list of its rows.
+    """
+    rows = screen.split("\n")
+    if rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+class Backend(object):
+    """
+    The interface a Runner drives its terminal through.
+    """
+
+    @classmethod
+    def can_launch_directly(cls):
+        """
+        Whether this backend can run a command with direct=True, without the
+        runner program, because it can find out the command's pid and exit
+        status itself.
+        """
+        return False
+
+    def pid(self):
+        """
+        Return the pid of a command launched directly.
+        """
+        raise NotImplementedError()
+
+    def exit_status(self):
+        """
+        Return None if a command launched directly is still running, or its
+        exit status in the form os.waitpid gives it once it has exited.
+        """
+        raise NotImplementedError()
+
+    def respawn(self, argv, direct=False):
+        """
+        Kill whatever is running in the terminal and run argv (as for the
+        constructor) in its place, on a blank screen with no history.
+        Raises NotImplementedError if this backend cannot.
+        """
+        raise NotImplementedError()
+
+    def screenshot(self):
+        """
+        Return the current contents of the screen as a string, one line per
+        row with trailing whitespace removed.
+        """
+        raise NotImplementedError()
+
+    def capture_rows(self, top, bottom):
+        """
+        Return a list of the rows of the screen from top up to but not
+        including bottom (or the last row if bottom is None), formatted as
+        for screenshot. Backends that can look at part of the screen more
+        cheaply than all of it should override this.
+        """
+        return split_rows(self.screenshot())[top:bottom]
+
+    def snapshot(self):
+        """
+        Return a Snapshot of the screen, with as much of its styling and the
+        cursor position as this backend can provide.
+        """
+        raise NotImplementedError()
+
+    def press(self, key):
+        """
+        Press the key named key, using tmux's names for keys.
+        """
+        raise NotImplementedError()
+
+    def write(self, text):
+        """
+        Type text into the terminal as is.
+        """
+        raise NotImplementedError()
+
+    def paste(self, data):
+        """
+        Type data, a bytestring, into the terminal as write would, without
+        waiting for the program to read it.
+        """
+        raise NotImplementedError()
+
+    def unread_input(self):
+        """
+        Return how many bytes typed into the terminal the program has yet to
+        read, or None if this backend cannot tell.
+        """
+        return None
+
+    def send(self, actions):
+        """
+        Carry out actions, a list of ("press", key) and ("write", text)
+        pairs, in order. Backends should do this in as few round trips as
+        they can, but by default it just presses and writes each in turn.
+        """
+        for action, argument in actions:
+            if action == "press":
+                self.press(argument)
+            elif action == "write":
+                self.write(argument)
+            else:
+                raise ValueError("Unknown input action %r" % (action,))
+
+    def output_count(self):
+        """
+        Return a counter that increases whenever the program produces output,
+        or None if this backend has no way of being told about output.
+        """
+        return None
+
+    def await_output(self, since, timeout):
+        """
+        Wait for up to timeout seconds for output_count() to move on from
+        since, returning the new count. Returns None if output notifications
+        are not available, in which case callers should fall back to polling.
+        """
+        return None
+
+    def watch_output(self, event):
+        """
+        Set the threading.Event event whenever the program produces output,
+        until unwatch_output is called with it, so that one thread can wait
+        for output from several backends at once. Returns False, and does
+        nothing, if this backend has no way of being told about output.
+        """
+        return False
+
+    def unwatch_output(self, event):
+        pass
+
+    def output_wait_limit(self):
+        """
+        Return the longest it is safe to wait to be told about output before
+        looking at the screen again, or None if we are told about all of it.
+        """
+        return None
+
+    def resize(self, width, height):
+        """
+        Change the size of the terminal, letting the program in it know with
+        SIGWINCH as usual. Raises NotImplementedError if this backend cannot.
+        """
+        raise NotImplementedError()
+
+    def scrollback(self, chunk_size):
+        """
+        Yield lists of up to chunk_size lines of the terminal's history (the
+        lines that have scrolled off the top of the screen), oldest first,
+        starting from the first line not yielded by a previous call. Lines
+        that scrolled off and were then thrown away (because there were more
+        than the history limit) before they were read are skipped.
+        """
+        raise NotImplementedError()
+
+    def record(self, path):
+        """
+        Start recording everything the program writes to the terminal to a
+        new recording file at path, in the format described in recorder.py.
+        """
+        raise NotImplementedError()
+
+    def stop_recording(self):
+        """
+        Stop recording and make sure the recording file is complete.
+        """
+        pass
+
+    def shutdown(self):
+        """
+        Free all resources associated with the terminal. The processes
+        running in it will already have been killed.
+        """
+        raise NotImplementedError()
+
+
+class TmuxServer(object):
+    """
+    A tmux server and the TmuxBackends running panes in it. The server is
+    shut down (or given back to the pool it came from) once the last of them
+    has been shut down.
+    """
+
+    def __init__(self, tmux, pool):
+        self.tmux = tmux
+        self.pool = pool
+        self.users = 0
+        # Whether anything has ever been opened beside the original pane, or
+        # the window has been resized. If so the server is not in a fit state
+        # to be recycled.
+        self.shared = False
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            self.users += 1
+
+    def release(self):
+        """
+        Note that one of the backends using this server has gone, and return
+        True if it was the last one, in which case the server has gone too.
+        """
+        with self.lock:
+            self.users -= 1
+            if self.users > 0:
+                return False
+        if self.pool is None:
+            self.tmux.shutdown()
+        elif self.shared:
+            self.pool.discard(self.tmux)
+        else:
+            self.pool.release(self.tmux)
+        return True
+
+    def open_pane(self, arguments):
+        """
+        Run the new-window or split-window command given by arguments and
+        return the id of the pane it created.
+        """
+        with self.lock:
+            self.shared = True
+            if tmux_supports(PRINT_FORMAT_VERSION):
+                return self.tmux.execute_command(*(
+                    arguments[:1] + ["-d", "-P", "-F", "#{pane_id}"] +
+                    arguments[1:]
+                )).strip()
+            # Without -F there's no way to ask for the pane's id directly,
+            # but the new pane is the only one we haven't seen before.
+            # Holding the lock means nobody else is adding panes meanwhile.
+            before = set(self.pane_ids())
+            self.tmux.execute_command(*(
+                arguments[:1] + ["-d"] + arguments[1:]
+            ))
+            new, = set(self.pane_ids()) - before
+            return new
+
+    def pane_ids(self):
+        return [
+            l.strip() for l in self.tmux.execute_command(
+                "list-panes", "-s", "-t", HECATE_SESSION_NAME,
+                "-F", "#{pane_id}"
+            ).splitlines()
+        ]
+
+
+class TmuxBackend(Backend):
+    """
+    Runs the command in the only pane of a fresh tmux server, or in one taken
+    from pool if that is set. control_mode is as for Tmux. history_limit sets
+    how many lines that have scrolled off the screen tmux keeps, and cannot
+    be used with a pool.
+
+    Alternatively, parent may be another TmuxBackend, in which case the
+    command is run in a new pane of the same server, created by the tmux
+    command place (new-window or split-window, plus any arguments for it).
+    The new pane gets its size from tmux rather than from width and height,
+    and control_mode and pool come from the parent.
+
+    If direct is True, argv is the command itself rather than the runner
+    program: its pane stays around after it exits, and tmux reports its pid
+    and exit status. This needs tmux 3.3 or later.
+    """
+
+    def __init__(
+        self, argv, width, height, control_mode=False, pool=None,
+        parent=None, place=("new-window",), history_limit=None, direct=False
+    ):
+        self.history_read = 0
+        self.history_anchor = []
+        self.last_screenshot = None
+        self.last_snapshot = None
+        self.recording = None
+        self.dead_status = None
+        self.direct = direct
+        self.tty = None
+        self.buffer_name = "hecate-" + random_id()
+        command = pane_command(argv, direct)
+        if parent is not None:
+            if control_mode or pool is not None or history_limit is not None:
+                raise TypeError(
+                    "control_mode, pool and history_limit are taken from the "
+                    "parent backend"
+                )
+            self.server = parent.server
+            self.tmux = parent.tmux
+            self.pool = parent.pool
+            self.server.acquire()
+            self.pane = None
+            try:
+                if direct:
+                    self.tmux.execute_commands(KEEP_DEAD_PANES)
+                self.pane = self.server.open_pane(list(place) + [command])
+                self.target_window = self.tmux.pane_format(
+                    self.pane, "#{window_name}")
+            except:
+                self.shutdown()
+                raise
+            return
+        if pool is not None and history_limit is not None:
+            # Pooled panes were created long ago, with whatever limit the
+            # pool gave them.
+            raise TypeError("history_limit cannot be used with a pool")
+        self.pool = pool
+        if pool is None:
+            self.tmux = Tmux(random_id(), control_mode=control_mode)
+        else:
+            self.tmux = pool.acquire(
+                command, width=width, height=height,
+                control_mode=control_mode, direct=direct
+            )
+        self.server = TmuxServer(self.tmux, pool)
+        self.server.acquire()
+        self.pane = None
+        try:
+            if pool is None:
+                # Pooled servers for direct commands already keep their dead
+                # panes.
+                if direct:
+                    self.tmux.execute_commands(KEEP_DEAD_PANES)
+                start_session(
+                    self.tmux, width, height, command, history_limit)
+            windows = [
+                l.strip() for l in self.tmux.execute_command(
+                    "list-windows", "-F", "#{window_name}").splitlines()
+            ]
+            assert len(windows) == 1
+            self.target_window = windows[0]
+            self.pane, = self.server.pane_ids()
+        except:
+            self.shutdown()
+            raise
+
+    def open(self, argv, width, height, place=("new-window",), direct=False):
+        """
+        Return a new TmuxBackend running argv in a new pane of this one's
+        server. This has the signature Runner expects of a backend, given
+        place, so can be passed to it with functools.partial.
+        """
+        return TmuxBackend(
+            argv, width, height, parent=self, place=place, direct=direct)
+
+    @classmethod
+    def can_launch_directly(cls):
+        return tmux_supports(DIRECT_LAUNCH_VERSION)
+
+    def pid(self):
+        return int(self.tmux.execute_command(
+            "display-message", "-p", "-t", self.pane, "#{pane_pid}"))
+
+    def exit_status(self):
+        if self.dead_status is not None:
+            return self.dead_status
+        try:
+            dead, status, signal_number, server = self.tmux.execute_command(
+                "display-message", "-p", "-t", self.pane,
+                "#{pane_dead}:#{pane_dead_status}:#{pane_dead_signal}:#{pid}"
+            ).strip().split(":")
+        except CommandFailed:
+            # The server or the pane has gone, and it is too late to ask.
+            return None
+        if dead != "1":
+            return None
+        if not (status or signal_number):
+            # The pane's terminal has closed but tmux has not reaped the
+            # command yet. Usually that is a matter of moments, but tmux can
+            # miss the SIGCHLD and leave it a zombie indefinitely, so give
+            # it another to make it look.
+            try:
+                os.kill(int(server), signal.SIGCHLD)
+            except (ProcessLookupError, PermissionError):
+                pass
+            return None
+        if status:
+            self.dead_status = int(status) << 8
+        else:
+            self.dead_status = int(signal_number)
+        return self.dead_status
+
+    def respawn(self, argv, direct=False):
+        self.tmux.execute_commands([
+            # Before respawning, or whatever the new command writes at once
+            # could go with it.
+            ["clear-history", "-t", self.pane],
+            ["respawn-pane", "-k", "-t", self.pane,
+             pane_command(argv, direct)],
+        ])
+        # The new command gets a new terminal.
+        self.tty = None
+        self.direct = direct
+        self.dead_status = None
+        self.history_read = 0
+        self.history_anchor = []
+
+    def screenshot(self):
+        try:
+            self.last_screenshot = self.tmux.capture_pane(self.pane)
+        except DeadServer:
+            pass
+        return self.last_screenshot
+
+    def capture_rows(self, top, bottom):
+        if bottom is not None and bottom <= top:
+            return []
+        try:
+            return split_rows(self.tmux.capture_pane(
+                self.pane, top, None if bottom is None else bottom - 1
+            ))
+        except DeadServer:
+            return split_rows(self.last_screenshot or "")[top:bottom]
+
+    def snapshot(self):
+        try:
+            if tmux_supports(CAPTURE_TO_STDOUT_VERSION):
+                # Both in one round trip. The size and cursor come last.
+                output = self.tmux.execute_commands([
+                    ["capture-pane", "-p", "-e", "-t", self.pane],
+                    ["display-message", "-p", "-t", self.pane,
+                     "#{pane_width} #{pane_height} #{cursor_x} #{cursor_y}"],
+                ])
+                captured, _, info = output.rstrip("\n").rpartition("\n")
+                width, height, x, y = map(int, info.split())
+                cursor = (x, y)
+            else:
+                captured = self.tmux.capture_pane(self.pane)
+                width, height = map(int, self.tmux.pane_format(
+                    self.pane, "#{pane_width} #{pane_height}").split())
+                # Older tmux can't say where the cursor is.
+                cursor = None
+        except DeadServer:
+            return self.last_snapshot
+        self.last_snapshot = Snapshot.parse(captured, width, height, cursor)
+        return self.last_snapshot
+
+    def press(self, key):
+        self.tmux.send_key(self.pane, key)
+
+    def write(self, text):
+        if self.direct:
+            # A directly launched command's pane dies with it, and pasting
+            # into a dead pane crashes tmux (3.3a at least), where typing the
+            # text into it does no harm.
+            self.send([("write", text)])
+            return
+        self.tmux.new_buffer(text)
+        self.tmux.execute_command("paste-buffer", "-t", self.pane)
+
+    def paste(self, data):
+        self.tmux.paste_data(
+            self.pane, data, self.buffer_name, if_alive=self.direct)
+
+    def unread_input(self):
+        if self.tty is None:
+            self.tty = self.tmux.pane_format(self.pane, "#{pane_tty}")
+        return unread_input(self.tty)
+
+    def send(self, actions):
+        if not tmux_supports(SEND_LITERAL_VERSION):
+            return Backend.send(self, actions)
+        # Runs of keys are sent with one send-keys, and text with send-keys -l
+        # (which would send a line feed literally, where paste-buffer turns it
+        # into a carriage return, so line breaks are sent as Enter).
+        commands = []
+        keys = []
+        for action, argument in actions:
+            if action == "press":
+                keys.append(argument)
+                continue
+            if action != "write":
+                raise ValueError("Unknown input action %r" % (action,))
+            for i, line in enumerate(LINE_BREAK.split(argument)):
+                if i > 0:
+                    keys.append("Enter")
+                if line:
+                    if keys:
+                        commands.append(["send-keys", "-t", self.pane] + keys)
+                        keys = []
+                    commands.append(
+                        ["send-keys", "-t", self.pane, "-l", "--", line])
+        if keys:
+            commands.append(["send-keys", "-t", self.pane] + keys)
+        if commands:
+            self.tmux.execute_commands(commands)
+
+    def output_count(self):
+        return self.tmux.output_count()
+
+    def await_output(self, since, timeout):
+        limit = self.output_wait_limit()
+        if limit is not None:
+            timeout = min(timeout, limit)
+        return self.tmux.await_output(since, timeout)
+
+    def watch_output(self, event):
+        return self.tmux.watch_output(event)
+
+    def unwatch_output(self, event):
+        self.tmux.unwatch_output(event)
+
+    def output_wait_limit(self):
+        if self.direct:
+            return DIRECT_OUTPUT_WAIT
+        return None
+
+    def resize(self, width, height):
+        if not tmux_supports(RESIZE_WINDOW_VERSION):
+            raise NotImplementedError(
+                "Resizing needs tmux %d.%d or later" % RESIZE_WINDOW_VERSION)
+        # The pool would hand the server out again as the size it was made.
+        self.server.shared = True
+        panes = self.tmux.execute_command(
+            "display-message", "-p", "-t", self.pane, "#{window_panes}"
+        )
+        if int(panes) > 1:
+            # One of several panes split from a window (see
+            # Runner.split_window), which can only grow at the expense of
+            # the others.
+            self.tmux.execute_command(
+                "resize-pane", "-t", self.pane, "-x", width, "-y", height)
+        else:
+            self.tmux.execute_command(
+                "resize-window", "-t", self.pane, "-x", width, "-y", height)
+
+    def scrollback(self, chunk_size):
+        while True:
+            size = self._history_size()
+            if self.history_read > size:
+                self._find_place_in_history(size)
+            start = self.history_read
+            if start >= size:
+                return
+            end = min(start + chunk_size, size)
+            anchor = self.history_anchor
+            # capture-pane numbers history lines backwards from -1, the most
+            # recent. We also fetch the last lines we read before, to check
+            # that they are where we left them, and the size again, to check
+            # that nothing scrolled while we were working out where to look.
+            first = start - len(anchor) - size
+            last = end - 1 - size
+            if tmux_supports(PANE_STATE_FORMAT_VERSION):
+                # All in one round trip. The size comes last.
+                rows = split_rows(self.tmux.execute_commands([
+                    ["capture-pane", "-p", "-t", self.pane,
+                     "-S", first, "-E", last],
+                    self._history_size_command(),
+                ]))
+                now = int(rows.pop())
+            else:
+                rows = split_rows(
+                    self.tmux.capture_pane(self.pane, first, last))
+                now = self._history_size()
+            if now != size:
+                continue
+            if rows[:len(anchor)] != anchor:
+                self._find_place_in_history(size)
+                continue
+            lines = rows[len(anchor):]
+            self.history_read = end
+            self.history_anchor = (anchor + lines)[-ANCHOR_LINES:]
+            yield lines
+
+    def _history_size_command(self):
+        return [
+            "display-message", "-p", "-t", self.pane, "#{history_size}"
+        ]
+
+    def _history_size(self):
+        if tmux_supports(PANE_STATE_FORMAT_VERSION):
+            return int(self.tmux.execute_command(
+                *self._history_size_command()))
+        for line in self.tmux.execute_command(
+            "list-panes", "-t", self.pane
+        ).splitlines():
+            if self.pane in line.split():
+                return int(HISTORY_SIZE.search(line).group(1))
+        raise CommandFailed("No pane %s" % (self.pane,))
+
+    def _find_place_in_history(self, size):
+        # tmux has thrown away old history since we last looked, so find the
+        # last lines we read in what is left.
+        anchor = self.history_anchor
+        rows = []
+        if size > 0:
+            rows = split_rows(self.tmux.capture_pane(self.pane, -size, -1))
+        for i in range(len(rows) - len(anchor), -1, -1):
+            if anchor and rows[i:i + len(anchor)] == anchor:
+                self.history_read = i + len(anchor)
+                return
+        # All of it is new to us.
+        self.history_read = 0
+        self.history_anchor = []
+
+    def record(self, path):
+        if tmux_version() == BROKEN_PIPE_PANE_VERSION:
+            raise NotImplementedError(
+                "Recording doesn't work with tmux %d.%d" %
+                BROKEN_PIPE_PANE_VERSION)
+        width, height = self.tmux.pane_format(
+            self.pane, "#{pane_width} #{pane_height}").split()
+        recorder.write_header(path, int(width), int(height))
+        self.recording = path
+        self.tmux.execute_command(
+            "pipe-pane", "-t", self.pane, ' '.join(map(shlex.quote, [
+                sys.executable, RECORDER_PROGRAM, path
+            ]))
+        )
+
+    def stop_recording(self):
+        if self.recording is None:
+            return
+        try:
+            # With no command, pipe-pane closes the pipe to the recorder.
+            self.tmux.execute_command("pipe-pane", "-t", self.pane)
+        except CommandFailed:
+            # The pane has gone, which closes the pipe anyway.
+            pass
+        deadline = time.time() + RECORDING_TIMEOUT
+        while not recorder.is_finished(self.recording):
+            if time.time() > deadline:
+                break
+            time.sleep(0.01)
+        self.recording = None
+
+    def shutdown(self):
+        if self.server.release() or self.pane is None:
+            return
+        # Other panes are still using the server, so just get rid of ours
+        # (which may well have closed itself already).
+        try:
+            self.tmux.execute_command("kill-pane", "-t", self.pane)
+        except CommandFailed:
+            pass
+
+
+def _take_controlling_terminal():
+    # Runs in the child after it has become the leader of a new session, so
+    # that the pty on its stdin becomes the session's controlling terminal and
+    # e.g. C-c sends SIGINT.
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+
+class PtyBackend(Backend):
+    """
+    Runs the command on a pty of its own and feeds everything it writes into
+    a Screen in this process, so screenshots never leave the process and
+    waiting for output is event driven rather than polled.
+
+    term is the value of TERM to run the command with. It defaults to the
+    one tmux uses, which is what Screen emulates. history_limit is how many
+    lines that have scrolled off the screen to keep, which is tmux's default
+    unless set.
+    """
+
+    def __init__(
+        self, argv, width, height, term="screen", history_limit=2000
+    ):
+        self.screen = Screen(width, height, history_limit)
+        self.history_read = 0
+        self.lock = threading.Lock()
+        self.output_changed = threading.Condition(self.lock)
+        self.count = 0
+        self.closed = False
+        self.watchers = set()
+        self.recording = None
+        master, slave = pty.openpty()
+        try:
+            fcntl.ioctl(
+                slave, termios.TIOCSWINSZ,
+                struct.pack("HHHH", height, width, 0, 0)
+            )
+            env = dict(os.environ)
+            env.pop("TMUX", None)
+            env.pop("TMUX_PANE", None)
+            env["TERM"] = term
+            self.process = subprocess.Popen(
+                argv, stdin=slave, stdout=slave, stderr=slave, env=env,
+                start_new_session=True,
+                preexec_fn=_take_controlling_terminal,
+            )
+            self.tty = os.ttyname(slave)
+        except:
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
+        fcntl.fcntl(
+            master, fcntl.F_SETFL,
+            fcntl.fcntl(master, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.master = master
+        self.wake_r, self.wake_w = os.pipe()
+        self.reader = threading.Thread(target=self._read_output)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def screenshot(self):
+        # Anything written before now has to be on the screen, even if the
+        # reader has not got to it yet.
+        with self.lock:
+            reply = self._drain()
+            result = self.screen.text()
+        self._reply(reply)
+        return result
+
+    def snapshot(self):
+        # The emulator does not keep track of styling, so this only has the
+        # characters and the cursor.
+        with self.lock:
+            reply = self._drain()
+            screen = self.screen
+            result = Snapshot.parse(
+                screen.text(), screen.width, screen.height,
+                (screen.cursor.x, screen.cursor.y)
+            )
+        self._reply(reply)
+        return result
+
+    def capture_rows(self, top, bottom):
+        with self.lock:
+            reply = self._drain()
+            result = self.screen.display(top, bottom)
+        self._reply(reply)
+        return result
+
+    def press(self, key):
+        with self.lock:
+            data = encode_key(key, self.screen.application_cursor_keys)
+        self._send(data)
+
+    def write(self, text):
+        # tmux's paste-buffer turns line feeds into carriage returns, as
+        # typing them would.
+        self._send(text.replace("\n", "\r").encode('utf-8'))
+
+    def paste(self, data):
+        self._send(data.replace(b"\n", b"\r"))
+
+    def unread_input(self):
+        return unread_input(self.tty)
+
+    def send(self, actions):
+        data = []
+        with self.lock:
+            for action, argument in actions:
+                if action == "press":
+                    data.append(encode_key(
+                        argument, self.screen.application_cursor_keys))
+                elif action == "write":
+                    data.append(argument.replace("\n", "\r").encode('utf-8'))
+                else:
+                    raise ValueError("Unknown input action %r" % (action,))
+        self._send(b"".join(data))
+
+    def output_count(self):
+        with self.lock:
+            if self.closed:
+                return None
+            return self.count
+
+    def await_output(self, since, timeout):
+        with self.output_changed:
+            if since is not None:
+                self.output_changed.wait_for(
+                    lambda: self.count != since or self.closed, timeout
+                )
+            if self.closed:
+                return None
+            return self.count
+
+    def watch_output(self, event):
+        with self.lock:
+            if self.closed:
+                return False
+            self.watchers.add(event)
+            return True
+
+    def unwatch_output(self, event):
+        with self.lock:
+            self.watchers.discard(event)
+
+    def scrollback(self, chunk_size):
+        with self.lock:
+            reply = self._drain()
+            history = self.screen.history
+            oldest = self.screen.scrolled - len(history)
+            start = max(self.history_read, oldest)
+            lines = list(history)[start - oldest:]
+        self._reply(reply)
+        for i in range(0, len(lines), chunk_size):
+            chunk = lines[i:i + chunk_size]
+            self.history_read = start + i + len(chunk)
+            yield chunk
+
+    def resize(self, width, height):
+        with self.lock:
+            reply = self._drain()
+            self.screen.resize(width, height)
+            # The kernel sends SIGWINCH to the program for us.
+            fcntl.ioctl(
+                self.master, termios.TIOCSWINSZ,
+                struct.pack("HHHH", height, width, 0, 0)
+            )
+        self._reply(reply)
+
+    def record(self, path):
+        with self.lock:
+            recorder.write_header(path, self.screen.width, self.screen.height)
+            self.recording = open(path, "ab", buffering=0)
+
+    def stop_recording(self):
+        with self.lock:
+            reply = self._drain()
+            if self.recording is not None:
+                recorder.write_end(self.recording)
+                self.recording.close()
+                self.recording = None
+        self._reply(reply)
+
+    def shutdown(self):
+        # Something the command started may still hold the pty open, so we
+        # cannot rely on the reader seeing it close.
+        os.write(self.wake_w, b"1")
+        self.reader.join()
+        for fd in (self.master, self.wake_r, self.wake_w):
+            os.close(fd)
+        try:
+            self.process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def _send(self, data):
+        while data:
+            try:
+                written = os.write(self.master, data)
+            except BlockingIOError:
+                select.select([], [self.master], [])
+                continue
+            data = data[written:]
+
+    def _drain(self):
+        # Called with the lock held. Feeds everything the program has written
+        # so far into the screen, and returns anything we need to reply with.
+        replies = []
+        while not self.closed:
+            try:
+                data = os.read(self.master, 65536)
+            except BlockingIOError:
+                break
+            except OSError:
+                # EIO, once everything holding the other end has exited.
+                data = b""
+            if not data:
+                self.closed = True
+            else:
+                if self.recording is not None:
+                    recorder.write_chunk(self.recording, data)
+                replies.append(self.screen.feed(data))
+                self.count += 1
+            self.output_changed.notify_all()
+            self._wake_watchers()
+        return b"".join(replies)
+
+    def _reply(self, data):
+        if data:
+            try:
+                self._send(data)
+            except OSError:
+                pass
+
+    def _read_output(self):
+        while not self.closed:
+            readable = select.select([self.master, self.wake_r], [], [])[0]
+            if self.wake_r in readable:
+                break
+            with self.lock:
+                reply = self._drain()
+            self._reply(reply)
+        with self.lock:
+            self.closed = True
+            self.output_changed.notify_all()
+            self._wake_watchers()
+
+    def _wake_watchers(self):
+        # Called with the lock held.
+        for event in self.watchers:
+            event.set()
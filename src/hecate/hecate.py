@@ -1,11 +1,17 @@
 import hecate.runner as runner
-from hecate.tmux import Tmux, DeadServer
+from hecate.instrument import (
+    instrumented, operation, note_poll, note_screenshot
+)
+from hecate.backends import TmuxBackend, HECATE_SESSION_NAME, random_id
+import functools
 import os
+import re
 import sys
+import threading
 import time
 import tempfile
-import binascii
 import signal
+import select
 import traceback
 import shlex
 from warnings import warn
@@ -31,14 +37,65 @@ class HecateWillHauntYou(HecateException):
     pass
 
 
+def wait_for_death(pid, timeout):
+    """
+    Wait up to timeout seconds for the process pid to go away, returning True
+    if it has. The processes we care about are not our children so we cannot
+    waitpid for them. Where the platform supports it we block on a pidfd,
+    otherwise we poll.
+    """
+    try:
+        fd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return True
+    except (AttributeError, OSError):
+        fd = None
+    if fd is not None:
+        try:
+            return bool(select.select([fd], [], [], timeout)[0])
+        finally:
+            os.close(fd)
+    deadline = time.time() + timeout
+    delay = 0.001
+    while True:
+        if has_exited(pid):
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+
+
+def has_exited(pid):
+    """
+    Whether the process pid has exited. That includes one that is still
+    waiting for its parent (usually tmux, which can take its time about it)
+    to reap it, as a pidfd says as soon as a process exits.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    try:
+        with open("/proc/%d/stat" % (pid,)) as stat:
+            # The state comes after the command name, which is in brackets
+            # and may have spaces (or brackets) in it.
+            return stat.read().rpartition(")")[2].split()[0] == "Z"
+    except (OSError, IndexError):
+        return False
+
+
 def must_die(pid):
+    """
+    Kill the process pid, escalating from SIGTERM to SIGKILL if it refuses to
+    go away, but returning as soon as it has.
+    """
     try:
-        os.kill(pid, signal.SIGTERM)
-        time.sleep(0.01)
-        os.kill(pid, signal.SIGTERM)
-        time.sleep(1)
-        os.kill(pid, signal.SIGTERM)
-        time.sleep(2)
+        for grace_period in [0.01, 1, 2]:
+            os.kill(pid, signal.SIGTERM)
+            if wait_for_death(pid, grace_period):
+                return
         os.kill(pid, signal.SIGKILL)
     except ProcessLookupError:
         pass
@@ -53,12 +110,206 @@ def hecate_temp_dir():
         pass
     return target
 
-HECATE_SESSION_NAME = "hecate_runner"
+# How much write_stream sends at a time: the size of the buffer a Linux
+# terminal holds typed input in, so that once the program has read what is in
+# it, it has read the whole of the last chunk.
+STREAM_CHUNK_SIZE = 4096
 
 RUNNER_PROGRAM = os.path.abspath(
     os.path.join(os.path.dirname(__file__), "runner.py"))
 
 
+class ControllerReports(object):
+    """
+    The fifo through which runner.py reports the pids of the controller and
+    the child it runs, and the child's exit status. It is created in
+    hecate_temp_dir() and removed again by close.
+    """
+
+    def __init__(self):
+        self.path = os.path.join(hecate_temp_dir(), random_id())
+        self.values = {}
+        self.buffer = b""
+        self.fds = []
+        os.mkfifo(self.path)
+        try:
+            self.fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+            self.fds.append(self.fd)
+            # We hold the write end open too, so that the fifo never reads as
+            # closed and select only wakes up when there is a report to read.
+            self.fds.append(
+                os.open(self.path, os.O_WRONLY | os.O_NONBLOCK))
+        except:
+            self.close()
+            raise
+
+    def fileno(self):
+        return self.fd
+
+    @property
+    def closed(self):
+        return not self.fds
+
+    def read(self):
+        """
+        Return a dict of everything reported so far, reading any new reports
+        without blocking.
+        """
+        while self.fds:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            self.buffer += data
+        *lines, self.buffer = self.buffer.split(b"\n")
+        for line in lines:
+            k, v = line.decode('ascii').split(":", 2)
+            self.values[k] = int(v)
+        return dict(self.values)
+
+    def close(self):
+        if self.fds:
+            self.read()
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def launch_argv(report_file, command):
+    """
+    The argv that runs command under runner.py, reporting to report_file.
+    """
+    return [sys.executable, RUNNER_PROGRAM, report_file] + list(command)
+
+
+def can_launch_directly(backend):
+    """
+    Whether backend, a Backend class or anything else that makes backends
+    when called (e.g. a functools.partial of one), can run a command without
+    the runner program.
+    """
+    while isinstance(backend, functools.partial):
+        backend = backend.func
+    # A bound method, like TmuxBackend.open, asks the backend it belongs to.
+    backend = getattr(backend, "__self__", backend)
+    check = getattr(backend, "can_launch_directly", None)
+    return check is not None and check()
+
+
+def launch_command(report_file, command):
+    """
+    The shell command line that runs command under runner.py, reporting to
+    report_file.
+    """
+    return ' '.join(map(shlex.quote, launch_argv(report_file, command)))
+
+
+class Region(object):
+    """
+    A rectangle of the screen: the rows from top up to but not including
+    bottom, cut down to the columns from left up to but not including right.
+    A bottom or right of None means the edge of the screen.
+    """
+
+    def __init__(self, top=0, bottom=None, left=0, right=None):
+        self.top = top
+        self.bottom = bottom
+        self.left = left
+        self.right = right
+
+    @classmethod
+    def rows(cls, top, bottom=None):
+        """
+        The whole width of the rows from top up to but not including bottom,
+        or just the row top if bottom is None.
+        """
+        if bottom is None:
+            bottom = top + 1
+        return cls(top=top, bottom=bottom)
+
+    def cut(self, rows):
+        """
+        Cut the rows from top to bottom of a screen down to this region's
+        columns.
+        """
+        if self.left == 0 and self.right is None:
+            return rows
+        return [row[self.left:self.right] for row in rows]
+
+    def __repr__(self):
+        return "Region(top=%r, bottom=%r, left=%r, right=%r)" % (
+            self.top, self.bottom, self.left, self.right)
+
+
+class InputBatch(object):
+    """
+    Key presses and text collected to be sent to a Runner's console together,
+    in the order they were added. press and write take the same arguments
+    as they do on Runner, and return the batch so that calls can be chained.
+    """
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.actions = []
+
+    def press(self, key):
+        self.actions.append(("press", key))
+        return self
+
+    def write(self, text):
+        self.actions.append(("write", text))
+        return self
+
+    @instrumented("batch")
+    def send(self):
+        """
+        Send everything collected so far, and start collecting afresh.
+        """
+        actions, self.actions = self.actions, []
+        self.runner.backend.send(actions)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.send()
+
+
+class Condition(object):
+    """
+    Something to wait for on a Runner with await_any or await_all, made by
+    one of its when_* methods. Once it has been met, value is what it was
+    met with: whatever the matching await_* method would have returned, or
+    the process's exit status for when_exit.
+    """
+
+    def __init__(self, runner, check, description, polled=False):
+        self.runner = runner
+        self.check = check
+        self.description = description
+        # Whether this can change without the screen changing, so that it
+        # has to be checked every wait_interval seconds even when we would
+        # be told about output.
+        self.polled = polled
+        self.value = None
+
+    def met(self):
+        met, value = self.check()
+        if met:
+            self.value = value
+        return met
+
+    def __repr__(self):
+        return "Condition(%s)" % (self.description,)
+
+
 class Runner(object):
     """
     A Runner manages a running console app. It is started in a
@@ -69,11 +320,14 @@ class Runner(object):
     """
     print_on_exit = False
 
+    @instrumented("startup")
     def __init__(
         self,
         *command,
         width=80, height=24,
-        wait_interval=0.01, default_timeout=1
+        wait_interval=0.01, default_timeout=1, control_mode=False,
+        pool=None, backend=None, record=None, history_limit=None,
+        controller=True
     ):
         """
         Hecate will run the command line arguments specified by command (
@@ -83,70 +337,119 @@ class Runner(object):
         Additional parameters:
 
             width and height specify the height of the console to run in in
-                characters. Note that you cannot currently resize the console
-                once started.
+                characters. It can be changed later with resize.
             wait_interval is the polling frequency for functions like
                 await_text. A smaller value will be more CPU intensive but
                 may be slightly faster.
             default_timeout specifies the default timeout for all await
                 functions.
+            control_mode, if True, talks to tmux through a single persistent
+                control mode client instead of starting a new tmux process
+                for every command. This is ignored on versions of tmux too
+                old to support it.
+            pool is a RunnerPool to take an already running tmux server
+                from rather than starting a new one. It is usually more
+                convenient to call pool.runner(...) than to pass this.
+            backend is the Backend class that provides the terminal to run
+                in. The default is TmuxBackend. Pass PtyBackend to run
+                without tmux, in which case control_mode and pool do not
+                apply.
+            record is a path to record everything the command draws to.
+                The recording can be replayed with hecate.recording, which
+                is useful for working out what happened in a test that
+                fails only some of the time. It does not work with tmux
+                1.8.
+            history_limit is how many lines that have scrolled off the top
+                of the screen to keep for scrollback. The default is the
+                backend's (for tmux, its history-limit option).
+            controller is whether to run the command under runner.py, a
+                small Python program that reports its pid and exit status
+                back to hecate. Pass controller=False to run the command
+                directly instead, which starts faster, if the backend can
+                find these out for itself (tmux 3.3 or later) and you are
+                not recording, which has to start before the command does.
+                Without the controller tmux can lose some of what a command
+                writes if it writes a lot of it just before exiting, too
+                fast for tmux to keep up.
         """
+        self.command = list(command)
         self.wait_interval = wait_interval
         self.default_timeout = default_timeout
         self.has_shutdown = False
-        self.tmux_id = binascii.hexlify(os.urandom(8)).decode('ascii')
         self.exit_seen = False
-        self.tmux = Tmux(self.tmux_id)
+        self.shutdown_called = False
+        self.launched = False
+        self.pool = pool
+        self.backend = None
+        self.tmux = None
+        self.reports = None
+        self.last_screenshot = None
+        self.tracked_rows = None
+        self.tracked_output = None
+        self.recording = None
+        self.report_file = None
+        self.direct = False
+        if backend is None:
+            backend = TmuxBackend
+        options = {}
+        if control_mode:
+            options["control_mode"] = control_mode
+        if pool is not None:
+            options["pool"] = pool
+        if history_limit is not None:
+            options["history_limit"] = history_limit
         try:
-            self.report_file = os.path.join(
-                hecate_temp_dir(), self.tmux_id
-            )
-            with open(self.report_file, "w"):
-                pass
-            self.shutdown_called = False
-            self.launched = False
-            self.tmux.new_session(
-                width=width, height=height, name=HECATE_SESSION_NAME,
-                command=' '.join(
-                    map(
-                        shlex.quote, [
-                            sys.executable,
-                            RUNNER_PROGRAM, self.report_file
-                        ] + list(command)))
-            )
-            sessions = [
-                l.strip() for l in self.tmux.execute_command(
-                    "list-sessions", "-F", "#{session_name}").splitlines()
-            ]
-            sessions.remove(HECATE_SESSION_NAME)
-            for s in sessions:
-                self.tmux.kill_session(s)
-            windows = [
-                l.strip() for l in self.tmux.execute_command(
-                    "list-windows", "-F", "#{window_name}").splitlines()
-            ]
-            assert len(windows) == 1
-            self.target_window = windows[0]
-            assert len(self.tmux.panes()) == 1
-            self.screenshot()
-            for _ in self.poll_until_timeout(self.default_timeout):
-                report = self.report_variables()
-                if runner.CHILD in report:
-                    self.ready = True
-                    self.screenshot()
-                    break
+            if not controller and (
+                record is not None or not can_launch_directly(backend)
+            ):
+                raise ValueError(
+                    "This command can only be run under the controller")
+            self.direct = not controller
+            if self.direct:
+                options["direct"] = True
+                argv = list(command)
             else:
-                raise Timeout(
-                    "Process failed to start"
-                )
-            report = self.report_variables()
-            os.kill(report[runner.CONTROLLER], signal.SIGUSR1)
-            self.child_pid = report[runner.CHILD]
+                self.reports = ControllerReports()
+                self.report_file = self.reports.path
+                argv = launch_argv(self.report_file, command)
+            self.backend = backend(argv, width, height, **options)
+            # Only set for the tmux backend, for those who need to talk to
+            # tmux directly.
+            self.tmux = getattr(self.backend, "tmux", None)
+            if self.tmux is not None:
+                self.tmux_id = self.tmux.name
+            if self.direct:
+                self.child_pid = self.backend.pid()
+            else:
+                self._start_controlled_child(record)
+            self.ready = True
         except:
             self.shutdown_called = True
-            self.tmux.shutdown()
+            if self.reports is not None:
+                self.reports.close()
+            if self.backend is not None:
+                if self.recording is not None:
+                    self.backend.stop_recording()
+                self.backend.shutdown()
             raise
 
+    def _start_controlled_child(self, record):
+        self.screenshot()
+        if self.await_report(runner.CHILD) is None:
+            raise Timeout(
+                "Process failed to start"
+            )
+        self.screenshot()
+        if record is not None:
+            # The child does not run the command until we signal the
+            # controller below, so this catches all of its output.
+            self.backend.record(record)
+            self.recording = record
+        report = self.report_variables()
+        os.kill(report[runner.CONTROLLER], signal.SIGUSR1)
+        self.child_pid = report[runner.CHILD]
+
+    @instrumented("shutdown")
     def shutdown(self):
         """
         Kill this Hecate instance and free all resources associated with it.
@@ -167,15 +470,75 @@ class Runner(object):
             if self.print_on_exit:
                 print(self.last_screenshot)
         finally:
-            report = self.report_variables()
-            for c in [runner.CHILD, runner.CONTROLLER]:
-                try:
-                    must_die(report[c])
-                except KeyError:
-                    pass
-                except:
-                    traceback.print_exc()
-            self.tmux.shutdown()
+            if self.direct:
+                # Once tmux has seen the command exit, its pid may belong to
+                # something else.
+                if not self.exit_seen and self.backend.exit_status() is None:
+                    try:
+                        must_die(self.child_pid)
+                    except:
+                        traceback.print_exc()
+            else:
+                self._stop_controller()
+            if self.recording is not None:
+                self.backend.stop_recording()
+            self.backend.shutdown()
+
+    @instrumented("restart")
+    def restart(self):
+        """
+        Kill the command if it is still running and start it again in the
+        same terminal, on a blank screen with no scrollback, as if this were
+        a new Runner. This is a lot cheaper than starting a new Runner, as
+        tmux and (where it is needed) the controller are already running.
+        Needs TmuxBackend, and cannot be used while recording.
+        """
+        if self.shutdown_called:
+            raise InvalidState("This Runner has been shut down")
+        if self.recording is not None:
+            raise InvalidState("Cannot restart a Runner while recording")
+        if self.direct:
+            # The pane stays around after the command dies, so it can go
+            # first.
+            if not self.exit_seen and self.backend.exit_status() is None:
+                must_die(self.child_pid)
+            self.backend.respawn(self.command, direct=True)
+            self.child_pid = self.backend.pid()
+        else:
+            # The controller is what keeps the pane around, so it has to
+            # stay until the new one has replaced it, which also kills it. It
+            # waits for as long as its reports are open, so they have to stay
+            # open until then too.
+            old = self.report_variables()
+            if runner.EXIT_STATUS not in old and runner.CHILD in old:
+                must_die(old[runner.CHILD])
+            old_reports = self.reports
+            self.reports = ControllerReports()
+            self.report_file = self.reports.path
+            try:
+                self.backend.respawn(
+                    launch_argv(self.report_file, self.command))
+            finally:
+                old_reports.close()
+            if runner.CONTROLLER in old:
+                must_die(old[runner.CONTROLLER])
+            self._start_controlled_child(None)
+        self.exit_seen = False
+        self.last_screenshot = None
+        self.tracked_output = None
+
+    def _stop_controller(self):
+        report = self.report_variables()
+        if runner.EXIT_STATUS in report:
+            self.release_controller()
+        for c in [runner.CHILD, runner.CONTROLLER]:
+            try:
+                must_die(report[c])
+            except KeyError:
+                pass
+            except:
+                traceback.print_exc()
+        self.reports.close()
 
     def __del__(self):
         if not self.shutdown_called:
@@ -186,66 +549,387 @@ class Runner(object):
                 "context managers."))
             self.shutdown()
 
+    @instrumented("screenshot")
     def screenshot(self):
         """
         Return a string representing the current state of the screen.
         """
-        try:
-            result = self.tmux.capture_pane(0)
-            self.last_screenshot = result
-            return result
-        except DeadServer:
-            return self.last_screenshot
+        note_screenshot()
+        self.last_screenshot = self.backend.screenshot()
+        return self.last_screenshot
+
+    def screen_changes(self):
+        """
+        Return a list of (row, text) pairs for the rows of the screen whose
+        text has changed since the last call to screen_changes, in order of
+        row. The first call returns every row.
+
+        Where the backend tells us about output (e.g. tmux in control mode
+        or PtyBackend) this does not look at the screen at all if nothing
+        has been written to it since.
+        """
+        # Note the output count before looking, so that anything arriving
+        # while we do is picked up next time.
+        count = self.backend.output_count()
+        if self.tracked_rows is not None and count is not None and \
+                count == self.tracked_output:
+            return []
+        rows = self.screenshot().splitlines()
+        old = self.tracked_rows or []
+        changes = [
+            (i, row) for i, row in enumerate(rows)
+            if i >= len(old) or old[i] != row
+        ]
+        self.tracked_rows = rows
+        self.tracked_output = count
+        return changes
 
+    def has_changed(self):
+        """
+        Return whether the screen differs from what the last call to
+        screen_changes saw, without updating what that was. This is
+        always True before the first call to screen_changes.
+        """
+        if self.tracked_rows is None:
+            return True
+        count = self.backend.output_count()
+        if count is not None and count == self.tracked_output:
+            return False
+        return self.screenshot().splitlines() != self.tracked_rows
+
+    @instrumented("press")
     def press(self, key):
         """
         Press the key identified by key-press. This will currently be passed
         uninterpreted to tmux, which will assign its own meaning to it. So e.g
         Enter will be the enter key, C-d will send EOF, etc.
         """
-        self.tmux.send_key(0, key)
+        self.backend.press(key)
 
+    @instrumented("write")
     def write(self, text):
         """
         Write this as text to the console as it is. Will not be interpreted as
         a special character, so e.g. Enter is the literal string Enter and not
         a return character.
         """
-        self.tmux.new_buffer(text)
-        self.tmux.execute_command("paste-buffer")
+        self.backend.write(text)
+
+    @instrumented("write_stream")
+    def write_stream(
+        self, source, chunk_size=STREAM_CHUNK_SIZE, timeout=None
+    ):
+        """
+        Type everything in source, a file object or any other iterable of
+        strings or bytestrings, into the terminal as write would, chunk_size
+        bytes at a time. This never holds more than one chunk in memory, so
+        can feed the command far more than write sensibly could.
+
+        Before each chunk, wait for the command to have read the last one,
+        so that a command that is slow to read its input is not overrun. If
+        it has not done so within timeout (or the default timeout) seconds,
+        raise a Timeout. If the command exits, stop early.
+        """
+        first = True
+        for chunk in _chunks(source, chunk_size):
+            if not first:
+                for _ in self.poll_until_timeout(timeout):
+                    if self._exit_status() is not None:
+                        return
+                    if not self.backend.unread_input():
+                        break
+                else:
+                    raise Timeout(
+                        "Timeout while waiting for input to be read")
+            first = False
+            self.backend.paste(chunk)
+
+    def _exit_status(self):
+        # The exit status if the command has exited, or None if it has not,
+        # without waiting.
+        if self.direct:
+            return self.backend.exit_status()
+        return self.report_variables().get(runner.EXIT_STATUS)
+
+    def batch(self):
+        """
+        Return an InputBatch for sending a sequence of key presses and text
+        to the console all at once, which is much faster than calling press
+        and write for each. Used as a context manager, it sends everything
+        when the block exits:
+
+            with runner.batch() as b:
+                b.press("i")
+                b.write("Hello world")
+                b.press("Escape")
+        """
+        return InputBatch(self)
+
+    def open_window(self, *command, **kwargs):
+        """
+        Start command in a new window of the tmux server this Runner is
+        using, and return a Runner for it. This is much cheaper than starting
+        a Runner of its own, and lets related programs (e.g. a server and a
+        client for it) run side by side.
+
+        The new window is the same size as this one. Any other keyword
+        arguments are as for Runner, except that width, height,
+        control_mode and pool all come from this Runner. The returned Runner
+        needs shutting down just like any other, and the server stays up
+        until every Runner using it has been shut down.
+        """
+        return self._open_pane(command, ["new-window", "-t",
+                                         HECATE_SESSION_NAME + ":"], kwargs)
+
+    def split_window(self, *command, horizontal=False, **kwargs):
+        """
+        As open_window, but start command in a new pane made by splitting
+        this Runner's pane in two, top and bottom or, if horizontal is True,
+        left and right. Both Runners' screens shrink to fit.
+        """
+        place = ["split-window", "-t", self.backend.pane]
+        if horizontal:
+            place.append("-h")
+        return self._open_pane(command, place, kwargs)
+
+    def focus(self):
+        """
+        Make this Runner's pane the active one, as if someone using tmux had
+        switched to it. Only meaningful for Runners sharing a server with
+        open_window or split_window.
+        """
+        self._check_shareable()
+        self.tmux.execute_command("select-window", "-t", self.backend.pane)
+        self.tmux.select_pane(self.backend.pane)
+
+    def _check_shareable(self):
+        if self.tmux is None:
+            raise InvalidState(
+                "Only Runners using tmux can share their terminal server")
+
+    def _open_pane(self, command, place, kwargs):
+        self._check_shareable()
+        for name in ["width", "height", "control_mode", "pool", "backend"]:
+            if name in kwargs:
+                raise TypeError(
+                    "%s can't be set for a Runner sharing a server" % (name,))
+        kwargs.setdefault("wait_interval", self.wait_interval)
+        kwargs.setdefault("default_timeout", self.default_timeout)
+        return Runner(*command, backend=functools.partial(
+            self.backend.open, place=place
+        ), **kwargs)
+
+    def scrollback(self, chunk_size=1000):
+        """
+        Iterate over the lines that have scrolled off the top of the screen,
+        in lists of up to chunk_size lines, oldest first. Each call carries
+        on from where the last one stopped, so calling this every so often
+        streams the whole output without reading any of it twice. Lines
+        that the backend's history limit threw away before they were read
+        are skipped.
 
-    def await_text(self, text, timeout=None):
+        The lines still on the screen are not history yet. Use screenshot
+        for those.
+        """
+        for lines in self.backend.scrollback(chunk_size):
+            yield lines
+
+    @instrumented("resize")
+    def resize(self, width, height):
+        """
+        Change the size of the console to width by height characters, without
+        restarting anything. The command gets a SIGWINCH, as it would if a
+        user resized their terminal. Needs tmux 2.9 or later, or PtyBackend.
+        """
+        self.backend.resize(width, height)
+        # Whatever screen_changes saw before is no use for comparison now,
+        # even if the command does not redraw.
+        self.tracked_output = None
+
+    @instrumented("snapshot")
+    def snapshot(self):
+        """
+        Return a Snapshot of the screen: its text along with the colours and
+        other styling of every cell and the position of the cursor. With
+        PtyBackend there is no styling, and nor is there with tmux older than
+        1.8, which does not say where the cursor is either.
+        """
+        note_screenshot()
+        return self.backend.snapshot()
+
+    @instrumented("capture")
+    def capture(self, region=None):
+        """
+        Return a list of the rows of the screen in region, a Region, or of
+        the whole screen if it is None, with trailing whitespace removed.
+        Only the rows in region are fetched, so this is cheaper than a
+        screenshot when region is small.
+        """
+        note_screenshot()
+        if region is None:
+            return self.backend.capture_rows(0, None)
+        return region.cut(self.backend.capture_rows(
+            region.top, region.bottom
+        ))
+
+    @instrumented("await_text")
+    def await_text(self, text, timeout=None, region=None):
         """
         Wait for 'text' to appear on the screen, accounting for line wrapping.
         If timeout (or default timeout if not set) seconds elapse first, raise
         a Timeout error.
+
+        If region is set, only look for text inside that Region of the
+        screen, in which case it has to be all on one row.
         """
-        for _ in self.poll_until_timeout(timeout):
+        if region is not None:
+            return self._await(
+                lambda rows: any(text in row for row in rows), region,
+                timeout, "text %r to appear in %r" % (text, region)
+            )
+        for _ in self.poll_until_changed(timeout):
             screen = self.screenshot()
             munged = screen.replace('\n', '')
             if text in munged:
                 return
         raise Timeout("Timeout while waiting for text %r to appear" % (text,))
 
+    @instrumented("await_match")
+    def await_match(self, pattern, timeout=None, region=None):
+        """
+        Wait for the regular expression pattern (either a string or compiled)
+        to match somewhere in region, or on the whole screen if region is
+        None, and return the match object. The text searched is the rows of
+        the region joined by newlines. Raise a Timeout if timeout (or the
+        default timeout) seconds pass first.
+        """
+        if not hasattr(pattern, "search"):
+            pattern = re.compile(pattern)
+        return self._await(
+            lambda rows: pattern.search("\n".join(rows)), region, timeout,
+            "a match for %r" % (pattern.pattern,)
+        )
+
+    @instrumented("await_condition")
+    def await_condition(self, predicate, timeout=None, region=None):
+        """
+        Wait for predicate, called with the list of rows that capture(region)
+        returns, to return something true, and return that. Raise a Timeout
+        if timeout (or the default timeout) seconds pass first.
+        """
+        return self._await(
+            predicate, region, timeout, "%r to be satisfied" % (predicate,)
+        )
+
+    def _await(self, predicate, region, timeout, description):
+        for _ in self.poll_until_changed(timeout):
+            result = predicate(self.capture(region))
+            if result:
+                return result
+        raise Timeout("Timeout while waiting for %s" % (description,))
+
+    def when_text(self, text, region=None):
+        """
+        A Condition for await_any and await_all that is met when text
+        appears, as for await_text.
+        """
+        if region is not None:
+            return self.when(
+                lambda rows: any(text in row for row in rows), region,
+                "text %r to appear in %r" % (text, region)
+            )
+
+        def check():
+            return text in self.screenshot().replace('\n', ''), None
+        return Condition(self, check, "text %r to appear" % (text,))
+
+    def when_match(self, pattern, region=None):
+        """
+        A Condition for await_any and await_all that is met when pattern
+        matches, as for await_match. Its value is the match object.
+        """
+        if not hasattr(pattern, "search"):
+            pattern = re.compile(pattern)
+        return self.when(
+            lambda rows: pattern.search("\n".join(rows)), region,
+            "a match for %r" % (pattern.pattern,)
+        )
+
+    def when(self, predicate, region=None, description=None):
+        """
+        A Condition for await_any and await_all that is met when predicate
+        returns something true, as for await_condition. Its value is what
+        predicate returned.
+        """
+        if description is None:
+            description = "%r to be satisfied" % (predicate,)
+
+        def check():
+            result = predicate(self.capture(region))
+            return bool(result), result
+        return Condition(self, check, description)
+
+    def when_exit(self):
+        """
+        A Condition for await_any and await_all that is met when the process
+        exits. Its value is the exit status as os.waitpid gives it, which
+        unlike with await_exit is not an error if it is non-zero.
+        """
+        def check():
+            status = self._exit_status()
+            if status is None:
+                return False, None
+            if not self.exit_seen:
+                self.exit_seen = True
+                self.screenshot()
+            return True, status
+        return Condition(self, check, "process to exit", polled=True)
+
+    @instrumented("await_exit")
     def await_exit(self, timeout=None):
         """
         Wait for the process to exit. If it exits with a non-zero status code,
         AbnormalExit will be raised. If timeout or default_timeout seconds pass
         without it exiting, raise a Timeout.
         """
-        for _ in self.poll_until_timeout(timeout):
-            report = self.report_variables()
-            if runner.EXIT_STATUS in report:
-                self.exit_seen = True
-                status = report[runner.EXIT_STATUS]
-                if status != 0:
-                    raise AbnormalExit(
-                        "Process exited with status %d" % (status,))
-                else:
-                    return
+        if self.direct:
+            status = self._await_exit_status(timeout)
+        else:
+            status = self.await_report(runner.EXIT_STATUS, timeout)
+        if status is not None:
+            self.exit_seen = True
+            # The pane stays open after the process exits (kept by tmux, or
+            # by the controller until we release it), so this is the screen
+            # as the process left it.
+            self.screenshot()
+            if status != 0:
+                raise AbnormalExit(
+                    "Process exited with status %d" % (status,))
+            else:
+                return
         self.screenshot()
         raise Timeout("Timeout while waiting for process to exit")
 
+    def _await_exit_status(self, timeout):
+        # Nothing tells us when a pane dies, so keep asking.
+        for _ in self.poll_until_timeout(timeout):
+            status = self.backend.exit_status()
+            if status is not None:
+                return status
+        return None
+
+    def release_controller(self):
+        """
+        Tell the controller process that we are done with the screen after the
+        command exited, and wait briefly for it to go.
+        """
+        controller = self.report_variables()[runner.CONTROLLER]
+        try:
+            os.kill(controller, signal.SIGUSR1)
+        except ProcessLookupError:
+            return
+        wait_for_death(controller, runner.RELEASE_TIMEOUT)
+
     def kill(self, sig):
         """
         Send a signal to the running process. sig is either an integer signal
@@ -261,18 +945,159 @@ class Runner(object):
         start = time.time()
         while time.time() <= start + timeout:
             yield
+            note_poll()
             time.sleep(self.wait_interval)
 
+    def poll_until_changed(self, timeout=None):
+        """
+        Like poll_until_timeout, but when the backend can notify us of output
+        from the app (e.g. tmux in control mode) only yield again once some
+        has arrived, rather than every wait_interval seconds.
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+        deadline = time.time() + timeout
+        seen = self.backend.output_count()
+        while time.time() <= deadline:
+            yield
+            note_poll()
+            remaining = deadline - time.time()
+            if remaining < 0:
+                break
+            seen = self.backend.await_output(seen, remaining)
+            if seen is None:
+                time.sleep(self.wait_interval)
+
     def report_variables(self):
-        with open(self.report_file) as r:
-            result = {}
-            for line in r:
-                k, v = line.split(":", 2)
-                result[k] = int(v)
-            return result
+        """
+        Return a dict of everything the controller process has reported so
+        far, reading any new reports from it without blocking. This is always
+        empty if the command was launched directly.
+        """
+        if self.reports is None:
+            return {}
+        return self.reports.read()
+
+    def await_report(self, field, timeout=None):
+        """
+        Wait for the controller process to report field and return its value,
+        or None if timeout (or default timeout if not set) seconds elapse
+        first.
+        """
+        if self.reports is None:
+            return None
+        if timeout is None:
+            timeout = self.default_timeout
+        deadline = time.time() + timeout
+        while True:
+            report = self.report_variables()
+            if field in report:
+                return report[field]
+            remaining = deadline - time.time()
+            if remaining < 0 or self.reports.closed:
+                return None
+            note_poll()
+            select.select([self.reports], [], [], remaining)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.shutdown()
+
+
+def _chunks(source, size):
+    # Turn source, as for write_stream, into bytestrings of size bytes (the
+    # last may be shorter).
+    if isinstance(source, (str, bytes)):
+        source = [source]
+    elif hasattr(source, "read"):
+        source = iter(functools.partial(source.read, size), source.read(0))
+    pending = b""
+    for part in source:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        if pending:
+            part = pending + part
+        start = 0
+        while len(part) - start >= size:
+            yield part[start:start + size]
+            start += size
+        pending = part[start:]
+    if pending:
+        yield pending
+
+
+def await_any(*conditions, timeout=None):
+    """
+    Wait for the first of conditions (made by the when_* methods of any
+    number of Runners) to be met, and return it. If timeout seconds pass
+    first, raise a Timeout. The default timeout is the longest
+    default_timeout of the Runners involved.
+
+    Every Runner is watched at once, so e.g. waiting for a server to print
+    something or a client to exit takes no longer than whichever happens
+    first.
+    """
+    return _await_conditions(conditions, 1, timeout, "await_any")[0]
+
+
+def await_all(*conditions, timeout=None):
+    """
+    Wait for every one of conditions to be met, as for await_any, and return
+    a list of their values in the same order. Once a condition has been met
+    it is not checked again.
+    """
+    _await_conditions(conditions, len(conditions), timeout, "await_all")
+    return [c.value for c in conditions]
+
+
+def _await_conditions(conditions, needed, timeout, name):
+    if not conditions:
+        raise ValueError("Nothing to wait for")
+    runners = []
+    for c in conditions:
+        if not any(r is c.runner for r in runners):
+            runners.append(c.runner)
+    if timeout is None:
+        timeout = max(r.default_timeout for r in runners)
+    interval = min(r.wait_interval for r in runners)
+    # One event that every Runner which can tell us about output sets when
+    # there is some, so that we can sleep until something might have
+    # changed on any of them.
+    wake = threading.Event()
+    watched = [r for r in runners if r.backend.watch_output(wake)]
+    limits = [
+        limit for limit in (r.backend.output_wait_limit() for r in watched)
+        if limit is not None
+    ]
+    met = []
+    pending = list(conditions)
+    try:
+        with operation(name):
+            deadline = time.time() + timeout
+            while True:
+                wake.clear()
+                for c in list(pending):
+                    if c.met():
+                        pending.remove(c)
+                        met.append(c)
+                if len(met) >= needed:
+                    return met
+                remaining = deadline - time.time()
+                if remaining < 0:
+                    break
+                note_poll()
+                if all(
+                    not c.polled and any(r is c.runner for r in watched)
+                    for c in pending
+                ):
+                    wake.wait(min(limits + [remaining]))
+                else:
+                    wake.wait(min(interval, remaining))
+    finally:
+        for r in watched:
+            r.backend.unwatch_output(wake)
+    raise Timeout("Timeout while waiting for %s" % (
+        (" or " if needed == 1 else " and ").join(
+            c.description for c in pending),))
@@ -0,0 +1,297 @@
+"""
+Hooks for finding out where the time in a hecate test goes.
+
+Every tmux command hecate issues, and every operation on a Runner (starting
+up, screenshots, input, the await_* methods and shutting down), is reported
+as an Event to any listeners that have been registered with add_listener.
+When nothing is listening this costs next to nothing, so it is fine to leave
+the hooks in place all the time.
+
+The easiest way to use this is collect(), which gathers everything that
+happens inside it into a Stats object:
+
+    with collect() as stats:
+        with Runner("vim") as h:
+            h.await_text("VIM")
+    print(stats.report())
+"""
+
+from contextlib import contextmanager
+import functools
+import threading
+import time
+
+
+COMMAND = "command"
+OPERATION = "operation"
+
+_listeners = ()
+_listeners_lock = threading.Lock()
+_local = threading.local()
+
+
+class Event(object):
+    """
+    Something hecate did, and how long it took in seconds.
+
+    kind is COMMAND for a tmux command, in which case name is the name of
+    the command, argv its arguments and via one of "fork" or "control"
+    depending on how it was sent. Commands sent together in one go are a
+    single event, with their argvs joined by ";".
+
+    kind is OPERATION for an operation on a Runner, in which case name is the
+    name of the method and polls and screenshots are the number of times it
+    went round its polling loop and looked at the screen respectively.
+    depth is the number of other operations it happened inside (e.g. the
+    screenshots taken by await_text), so the time spent in operations with a
+    depth of 0 adds up to the total time spent in hecate.
+
+    thread is the threading.get_ident() of the thread it happened in.
+    """
+
+    def __init__(
+        self, kind, name, duration, argv=None, via=None, polls=0,
+        screenshots=0, depth=0
+    ):
+        self.kind = kind
+        self.name = name
+        self.duration = duration
+        self.argv = argv
+        self.via = via
+        self.polls = polls
+        self.screenshots = screenshots
+        self.depth = depth
+        self.thread = threading.get_ident()
+
+    def __repr__(self):
+        return "Event(%r, %r, %.6f)" % (self.kind, self.name, self.duration)
+
+
+def add_listener(listener):
+    """
+    Call listener with every Event from now on, from whichever thread it
+    happens in.
+    """
+    global _listeners
+    with _listeners_lock:
+        _listeners = _listeners + (listener,)
+
+
+def remove_listener(listener):
+    global _listeners
+    with _listeners_lock:
+        listeners = list(_listeners)
+        listeners.remove(listener)
+        _listeners = tuple(listeners)
+
+
+def enabled():
+    return bool(_listeners)
+
+
+def emit(event):
+    for listener in _listeners:
+        listener(event)
+
+
+def record_command(argv, start, via):
+    """
+    Report that the tmux command argv, which started at time.perf_counter()
+    value start, has finished.
+    """
+    if _listeners:
+        argv = list(argv)
+        emit(Event(
+            COMMAND, argv[0] if argv else "", time.perf_counter() - start,
+            argv=argv, via=via
+        ))
+
+
+class Operation(object):
+    def __init__(self, name):
+        self.name = name
+        self.polls = 0
+        self.screenshots = 0
+        self.stack = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.stack = _stack()
+        self.depth = len(self.stack)
+        self.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stack.remove(self)
+        emit(Event(
+            OPERATION, self.name, time.perf_counter() - self.start,
+            polls=self.polls, screenshots=self.screenshots, depth=self.depth
+        ))
+
+
+class NoOperation(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+NO_OPERATION = NoOperation()
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+def operation(name):
+    """
+    A context manager that reports an OPERATION event called name when it
+    exits, counting any polls and screenshots that happen inside it.
+    """
+    if _listeners:
+        return Operation(name)
+    return NO_OPERATION
+
+
+def instrumented(name):
+    """
+    A decorator that makes each call to the function it decorates an
+    operation called name.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def accept(*args, **kwargs):
+            if not _listeners:
+                return f(*args, **kwargs)
+            with Operation(name):
+                return f(*args, **kwargs)
+        return accept
+    return decorator
+
+
+def note_poll():
+    """
+    Count a trip round a polling loop against every operation in progress in
+    this thread.
+    """
+    for op in getattr(_local, "stack", ()):
+        op.polls += 1
+
+
+def note_screenshot():
+    """
+    Count a screenshot against every operation in progress in this thread.
+    """
+    for op in getattr(_local, "stack", ()):
+        op.screenshots += 1
+
+
+class Summary(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.polls = 0
+        self.screenshots = 0
+
+    def add(self, event):
+        self.count += 1
+        self.total += event.duration
+        self.max = max(self.max, event.duration)
+        self.polls += event.polls
+        self.screenshots += event.screenshots
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+            "polls": self.polls,
+            "screenshots": self.screenshots,
+        }
+
+
+class Stats(object):
+    """
+    A listener that keeps every event it is given, and can summarise them.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def summary(self):
+        """
+        Return a dict with entries "commands" and "operations", mapping the
+        name of each tmux command or Runner operation to a dict of how many
+        times it happened, their total and maximum durations, and the
+        number of polls and screenshots they took.
+        """
+        result = {COMMAND: {}, OPERATION: {}}
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            result[event.kind].setdefault(event.name, Summary()).add(event)
+        return {
+            "commands": {
+                k: v.as_dict() for k, v in result[COMMAND].items()},
+            "operations": {
+                k: v.as_dict() for k, v in result[OPERATION].items()},
+        }
+
+    def total(self):
+        """
+        The total time spent in Runner operations, not counting operations
+        that happened inside others twice.
+        """
+        with self.lock:
+            return sum(
+                e.duration for e in self.events
+                if e.kind == OPERATION and e.depth == 0
+            )
+
+    def report(self, title=None):
+        """
+        Return the summary as a human readable table, slowest first.
+        """
+        summary = self.summary()
+        lines = []
+        if title is not None:
+            lines.append(title)
+        for heading, entries in [
+            ("tmux commands", summary["commands"]),
+            ("Runner operations", summary["operations"]),
+        ]:
+            if not entries:
+                continue
+            lines.append("%-20s %6s %10s %10s %6s %6s" % (
+                heading, "count", "total", "max", "polls", "shots"))
+            for name, s in sorted(
+                entries.items(), key=lambda kv: -kv[1]["total"]
+            ):
+                lines.append("  %-18s %6d %9.3fs %9.3fs %6d %6d" % (
+                    name, s["count"], s["total"], s["max"], s["polls"],
+                    s["screenshots"]))
+        return "\n".join(lines)
+
+
+@contextmanager
+def collect():
+    """
+    Collect every event that happens inside the with block into a Stats
+    object, which is what the block gets.
+    """
+    stats = Stats()
+    add_listener(stats)
+    try:
+        yield stats
+    finally:
+        remove_listener(stats)
@@ -0,0 +1,445 @@
+from hecate.hecate import Runner, AbnormalExit
+from hecate.backends import HECATE_SESSION_NAME, KEEP_DEAD_PANES, \
+    random_id, start_session
+from hecate.tmux import Tmux, CommandFailed
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import signal
+import threading
+import time
+
+# What a pooled server runs while it waits to be handed out. It just needs to
+# sit there quietly until respawn-pane replaces it.
+IDLE_COMMAND = "cat"
+
+WARM_UP_ACTIONS = ["press", "write", "await_text", "await_match"]
+
+
+class Scenario(object):
+    """
+    A scenario to be run by RunnerPool.run_all: function is called with a
+    Runner running command, which is created with the given keyword
+    arguments.
+    """
+
+    def __init__(self, function, *command, **kwargs):
+        self.function = function
+        self.command = command
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return "Scenario(%s, %s)" % (
+            getattr(self.function, "__name__", self.function),
+            ' '.join(self.command),
+        )
+
+
+class ScenarioResult(object):
+    """
+    The outcome of running a Scenario: value is whatever its function
+    returned and exception whatever it (or starting or shutting down its
+    Runner) raised. screenshot is the last screenshot taken of the Runner, and
+    elapsed how many seconds the whole thing took.
+    """
+
+    def __init__(self, scenario, value, exception, screenshot, elapsed):
+        self.scenario = scenario
+        self.value = value
+        self.exception = exception
+        self.screenshot = screenshot
+        self.elapsed = elapsed
+
+    @property
+    def succeeded(self):
+        return self.exception is None
+
+    def __repr__(self):
+        return "ScenarioResult(%r, %s, %.3fs)" % (
+            self.scenario,
+            "ok" if self.succeeded else repr(self.exception),
+            self.elapsed,
+        )
+
+
+class WarmUp(object):
+    """
+    A way of getting command into the state that a number of tests start
+    from, which RunnerPool.warmed can do ahead of time. command is started
+    with the given keyword arguments (as for RunnerPool.runner), then each of
+    steps, a list of (action, argument) pairs, is carried out in turn by
+    calling the Runner method named by action (one of "press", "write",
+    "await_text" or "await_match") with argument.
+    """
+
+    def __init__(self, *command, steps=(), **kwargs):
+        steps = tuple(tuple(step) for step in steps)
+        for action, _ in steps:
+            if action not in WARM_UP_ACTIONS:
+                raise ValueError("Unknown warm up action %r" % (action,))
+        self.command = command
+        self.steps = steps
+        self.kwargs = kwargs
+
+    def identity(self):
+        """
+        What distinguishes this warm up from others, regardless of the
+        environment it runs in.
+        """
+        return (self.command, self.steps, tuple(sorted(self.kwargs.items())))
+
+    def fingerprint(self):
+        """
+        A summary of everything outside hecate that could change what this
+        warm up produces: the environment variables, and the executable the
+        command runs.
+        """
+        executable = shutil.which(self.command[0])
+        if executable is not None:
+            stat = os.stat(executable)
+            executable = (executable, stat.st_mtime, stat.st_size)
+        return hash((tuple(sorted(os.environ.items())), executable))
+
+    def run(self, runner):
+        for action, argument in self.steps:
+            getattr(runner, action)(argument)
+
+    def __repr__(self):
+        return "WarmUp(%s, %d steps)" % (
+            ' '.join(self.command), len(self.steps))
+
+
+class WarmStock(object):
+    """
+    The warmed up Runners a RunnerPool has ready for one WarmUp, all made with
+    environment fingerprint. runners is a list of (runner, time it was ready)
+    pairs, and warming the number being made in the background.
+    """
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.runners = []
+        self.warming = 0
+
+
+def discard_runner(runner):
+    """
+    Shut down a Runner whose command may still be running, without waiting
+    for it to exit of its own accord.
+    """
+    try:
+        if runner._exit_status() is None:
+            try:
+                runner.kill(signal.SIGKILL)
+            except ProcessLookupError:
+                # It has exited since we looked.
+                pass
+    finally:
+        try:
+            runner.shutdown()
+        except AbnormalExit:
+            pass
+
+
+class RunnerPool(object):
+    """
+    A RunnerPool keeps a number of tmux servers booted in the background, each
+    with a session of the right size waiting to run a command, so that
+    starting a Runner from it does not have to wait for tmux to start up.
+    When a Runner from the pool shuts down its server is recycled for the next
+    one rather than killed.
+
+    You must call shutdown on the pool once you are done with it. You can
+    also use it as a context manager for automatic resource cleanup.
+    """
+
+    def __init__(
+        self, size=2, width=80, height=24, control_mode=False, spares=1,
+        max_warm_ups=8, max_warm_age=60, prefix=""
+    ):
+        """
+        size is the number of idle servers to keep ready. width, height and
+        control_mode are the settings that servers are prepared with in the
+        background. Runners asking for other settings still get recycled
+        servers if there are any, but otherwise have to wait for one to boot.
+
+        spares, max_warm_ups and max_warm_age control the Runners kept ready
+        by warmed: up to spares of them for each of the max_warm_ups WarmUps
+        most recently asked for, each of which is thrown away unused if it
+        has been waiting for longer than max_warm_age seconds.
+
+        prefix is put at the start of the socket name of every tmux server
+        the pool starts, so that e.g. different processes' servers can be
+        told apart.
+        """
+        self.size = size
+        self.default_key = (width, height, control_mode, False)
+        self.idle = {}
+        self.keys = {}
+        self.closed = False
+        self.spares = spares
+        self.prefix = prefix
+        self.max_warm_ups = max_warm_ups
+        self.max_warm_age = max_warm_age
+        self.warm = OrderedDict()
+        self.warmers = []
+        self.changed = threading.Condition()
+        self.filler = threading.Thread(target=self._fill)
+        self.filler.daemon = True
+        self.filler.start()
+
+    def runner(self, *command, **kwargs):
+        """
+        Start a Runner for command on a server from this pool. Takes the same
+        keyword arguments as Runner, with width, height and control_mode
+        defaulting to the pool's settings.
+        """
+        width, height, control_mode, _ = self.default_key
+        kwargs.setdefault("width", width)
+        kwargs.setdefault("height", height)
+        kwargs.setdefault("control_mode", control_mode)
+        return Runner(*command, pool=self, **kwargs)
+
+    def warmed(self, warm_up):
+        """
+        Return a Runner on which warm_up has been carried out. Its first use
+        does it there and then, but after that the pool keeps spares ready in
+        the background, so later calls return one straight away.
+
+        Spares are only handed out if the environment variables and the
+        command's executable are the same as when they were made, and are
+        thrown away otherwise. Only the most recently used WarmUps have
+        spares kept for them, and spares that have been waiting too long are
+        thrown away rather than used, as are any left when the pool shuts
+        down.
+        """
+        identity = warm_up.identity()
+        fingerprint = warm_up.fingerprint()
+        stale = []
+        runner = None
+        with self.changed:
+            stock = self.warm.get(identity)
+            if stock is not None and stock.fingerprint != fingerprint:
+                del self.warm[identity]
+                stale.extend(r for r, _ in stock.runners)
+                stock = None
+            if stock is None:
+                stock = self.warm[identity] = WarmStock(fingerprint)
+            self.warm.move_to_end(identity)
+            while len(self.warm) > self.max_warm_ups:
+                _, evicted = self.warm.popitem(last=False)
+                stale.extend(r for r, _ in evicted.runners)
+            now = time.time()
+            while stock.runners and runner is None:
+                candidate, ready = stock.runners.pop(0)
+                if now - ready > self.max_warm_age:
+                    stale.append(candidate)
+                else:
+                    runner = candidate
+            needed = 0
+            if not self.closed:
+                needed = max(
+                    self.spares - len(stock.runners) - stock.warming, 0)
+                stock.warming += needed
+        for r in stale:
+            discard_runner(r)
+        for _ in range(needed):
+            warmer = threading.Thread(
+                target=self._warm_spare, args=(warm_up, identity, stock))
+            warmer.daemon = True
+            with self.changed:
+                self.warmers = [w for w in self.warmers if w.is_alive()]
+                self.warmers.append(warmer)
+            warmer.start()
+        if runner is None:
+            runner = self._warm_up(warm_up)
+        return runner
+
+    def _warm_up(self, warm_up):
+        runner = self.runner(*warm_up.command, **warm_up.kwargs)
+        try:
+            warm_up.run(runner)
+        except:
+            discard_runner(runner)
+            raise
+        return runner
+
+    def _warm_spare(self, warm_up, identity, stock):
+        try:
+            runner = self._warm_up(warm_up)
+        except Exception:
+            # Leave it to the next call to warmed to report the problem.
+            runner = None
+        with self.changed:
+            stock.warming -= 1
+            wanted = not self.closed and self.warm.get(identity) is stock
+            if runner is not None and wanted:
+                stock.runners.append((runner, time.time()))
+                self.changed.notify_all()
+                return
+        if runner is not None:
+            discard_runner(runner)
+
+    def run_all(self, scenarios, max_workers=None):
+        """
+        Run each of scenarios on its own Runner from this pool, with up to
+        max_workers of them (default: the number of CPUs) running at once.
+        Returns a list of ScenarioResult in the same order as scenarios. A
+        failing scenario does not stop the others: its exception is recorded
+        in its result instead.
+        """
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self._run_scenario, scenarios))
+
+    def _run_scenario(self, scenario):
+        start = time.time()
+        runner = None
+        value = None
+        exception = None
+        try:
+            runner = self.runner(*scenario.command, **scenario.kwargs)
+            with runner:
+                value = scenario.function(runner)
+        except Exception as e:
+            exception = e
+        return ScenarioResult(
+            scenario, value, exception,
+            getattr(runner, "last_screenshot", None), time.time() - start,
+        )
+
+    def acquire(self, command, width, height, control_mode, direct=False):
+        """
+        Take a server out of the pool, booting a new one if none with these
+        settings is ready, and start command in its session. The server should
+        be given back with release once it is no longer needed.
+
+        direct is whether command is to be launched directly. Servers for
+        that are set up differently, so are kept apart from the rest.
+        """
+        key = (width, height, control_mode, direct)
+        while True:
+            with self.changed:
+                servers = self.idle.get(key)
+                tmux = servers.pop() if servers else None
+                self.changed.notify_all()
+            recycled = tmux is not None
+            if not recycled:
+                tmux = self._boot(key)
+            try:
+                tmux.clear_history(HECATE_SESSION_NAME)
+                tmux.respawn_pane(HECATE_SESSION_NAME, command)
+                return tmux
+            except CommandFailed:
+                self.discard(tmux)
+                if not recycled:
+                    raise
+                # Something happened to this server while it sat in the pool.
+                # Throw it away and try again.
+
+    def release(self, tmux):
+        """
+        Give a server acquired from this pool back to it. Its session should
+        no longer be running anything that matters, as it will be killed when
+        the server is next handed out.
+        """
+        with self.changed:
+            key = self.keys[tmux.name]
+            servers = self.idle.setdefault(key, [])
+            if not self.closed and len(servers) < self.size:
+                servers.append(tmux)
+                self.changed.notify_all()
+                return
+        self.discard(tmux)
+
+    def shutdown(self):
+        """
+        Kill all idle servers and spare warmed Runners in the pool and stop
+        making new ones. Servers still in use by Runners are killed when those
+        Runners shut down.
+
+        This is safe to call multiple times. It will be automatically called
+        if you are using this as a context manager.
+        """
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+        self.filler.join()
+        with self.changed:
+            warmers = list(self.warmers)
+        for warmer in warmers:
+            warmer.join()
+        with self.changed:
+            spares = [
+                r for stock in self.warm.values() for r, _ in stock.runners]
+            self.warm.clear()
+        for runner in spares:
+            discard_runner(runner)
+        with self.changed:
+            servers = [t for ts in self.idle.values() for t in ts]
+            self.idle.clear()
+        for tmux in servers:
+            tmux.shutdown()
+
+    def discard(self, tmux):
+        """
+        Kill a server acquired from this pool rather than giving it back, e.g.
+        because it has been used in ways that would make it unsafe to hand to
+        another Runner.
+        """
+        tmux.shutdown()
+        with self.changed:
+            self.keys.pop(tmux.name, None)
+
+    def _boot(self, key):
+        width, height, control_mode, direct = key
+        tmux = Tmux(self.prefix + random_id(), control_mode=control_mode)
+        try:
+            if direct:
+                # Runners launching their command directly need to see the
+                # screen it left behind, untouched. This has to come first,
+                # for the pane they will be respawned in to be set up for it.
+                tmux.execute_commands(KEEP_DEAD_PANES)
+            start_session(tmux, width, height, IDLE_COMMAND)
+            # Keep the pane (and so the server) around after the command in it
+            # exits, so that it can be respawned for the next Runner.
+            tmux.execute_command(
+                "set-window-option", "-t", HECATE_SESSION_NAME,
+                "remain-on-exit", "on"
+            )
+        except:
+            tmux.shutdown()
+            raise
+        with self.changed:
+            self.keys[tmux.name] = key
+        return tmux
+
+    def _fill(self):
+        while True:
+            with self.changed:
+                while not self.closed and len(
+                    self.idle.get(self.default_key, ())
+                ) >= self.size:
+                    self.changed.wait()
+                if self.closed:
+                    return
+            try:
+                tmux = self._boot(self.default_key)
+            except (OSError, CommandFailed):
+                # Leave it to acquire to boot servers and report the problem.
+                return
+            with self.changed:
+                if not self.closed:
+                    self.idle.setdefault(self.default_key, []).append(tmux)
+                    self.changed.notify_all()
+                    continue
+            tmux.shutdown()
+            return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
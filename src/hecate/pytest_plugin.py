@@ -0,0 +1,159 @@
+"""
+A pytest plugin for testing with hecate, installed automatically along with
+it. Tests get a runner fixture for starting Runners:
+
+    def test_vim(runner):
+        h = runner("vim")
+        h.await_text("VIM")
+
+Runners started with it come from a RunnerPool shared by the whole test
+session, and are shut down after each test however it ends, so there is no
+need for with blocks. Under pytest-xdist each worker has a pool of its own,
+whose tmux servers are named after the worker so they can be told apart and
+are all killed when it finishes.
+
+At the end of the run the tests that spent longest in hecate are listed in
+the terminal summary. See pytest --help for the options.
+"""
+
+from hecate import instrument
+from hecate.pool import RunnerPool, discard_runner
+from hecate.tmux import server_names, kill_server, socket_directory
+import os
+import pytest
+import threading
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("hecate")
+    group.addoption(
+        "--hecate-pool-size", type=int, default=2,
+        help="How many idle tmux servers to keep ready for the runner "
+             "fixture.")
+    group.addoption(
+        "--hecate-control-mode", action="store_true", default=False,
+        help="Talk to tmux in control mode in the runner fixture.")
+    group.addoption(
+        "--hecate-timings", type=int, default=10, metavar="N",
+        help="Show the N tests that spent longest in hecate (0 to turn "
+             "this off).")
+
+
+def pytest_configure(config):
+    config.pluginmanager.register(HecateTimings(config), "hecate-timings")
+
+
+def server_prefix(config):
+    """
+    The prefix for the names of tmux servers started by this process, which
+    is different for each xdist worker (and each test run).
+    """
+    worker = getattr(config, "workerinput", {}).get("workerid", "main")
+    return "hecate-%s-%d-" % (worker, os.getpid())
+
+
+@pytest.fixture(scope="session")
+def hecate_pool(request):
+    """
+    The RunnerPool that the runner fixture takes its tmux servers from.
+    """
+    config = request.config
+    prefix = server_prefix(config)
+    pool = RunnerPool(
+        size=config.getoption("hecate_pool_size"),
+        control_mode=config.getoption("hecate_control_mode"),
+        prefix=prefix,
+    )
+    yield pool
+    pool.shutdown()
+    # Anything still running was leaked by a Runner that was never shut
+    # down, and would otherwise outlive us. Either way, tmux leaves its
+    # sockets lying around.
+    for name in server_names():
+        if name.startswith(prefix):
+            kill_server(name)
+            try:
+                os.unlink(os.path.join(socket_directory(), name))
+            except FileNotFoundError:
+                pass
+
+
+@pytest.fixture
+def runner(request, hecate_pool):
+    """
+    A function taking the same arguments as Runner that starts a Runner
+    from the session's pool. Every Runner it started is shut down at the end
+    of the test: if its command is still running it is killed first rather
+    than waited for.
+    """
+    started = []
+    stats = instrument.Stats()
+    # Listeners hear about everything in the process, including the pool
+    # starting servers in the background, so only count this test's thread.
+    thread = threading.get_ident()
+
+    def listener(event):
+        if event.thread == thread:
+            stats(event)
+    instrument.add_listener(listener)
+
+    def start(*command, **kwargs):
+        h = hecate_pool.runner(*command, **kwargs)
+        started.append(h)
+        return h
+    try:
+        yield start
+    finally:
+        try:
+            errors = []
+            for h in started:
+                # Every one of them gets shut down, even if another fails to.
+                try:
+                    discard_runner(h)
+                except Exception as e:
+                    errors.append(e)
+            if errors:
+                raise errors[0]
+        finally:
+            instrument.remove_listener(listener)
+            commands = stats.summary()["commands"]
+            request.node.user_properties.append(("hecate", {
+                "runners": len(started),
+                "time": stats.total(),
+                "commands": sum(c["count"] for c in commands.values()),
+            }))
+
+
+class HecateTimings(object):
+    """
+    Gathers the time each test spent in hecate, as recorded by the runner
+    fixture, and reports the slowest tests at the end of the run. Under
+    xdist this happens in the controlling process, with the times coming in
+    on the workers' test reports.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.timings = []
+
+    def pytest_runtest_logreport(self, report):
+        if report.when != "teardown":
+            return
+        for name, value in report.user_properties:
+            if name == "hecate":
+                self.timings.append((report.nodeid, value))
+
+    def pytest_terminal_summary(self, terminalreporter):
+        count = self.config.getoption("hecate_timings")
+        if not count or not self.timings:
+            return
+        timings = sorted(self.timings, key=lambda t: -t[1]["time"])
+        total = sum(value["time"] for _, value in timings)
+        terminalreporter.write_sep(
+            "=", "slowest %d hecate tests (%.2fs in hecate altogether)" % (
+                min(count, len(timings)), total))
+        for nodeid, value in timings[:count]:
+            terminalreporter.write_line(
+                "%8.3fs %3d runners %5d tmux commands  %s" % (
+                    value["time"], value["runners"], value["commands"],
+                    nodeid))
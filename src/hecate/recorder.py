@@ -0,0 +1,89 @@
+"""
+Appends everything written to its stdin to a recording file, along with the
+time it arrived. hecate runs this with tmux's pipe-pane to record what the
+program in a pane draws. Like runner.py it is run as a script, so must not
+import anything from hecate.
+
+A recording file starts with the header line
+
+    hecate-recording 1 <width> <height> <start time>
+
+after which each chunk of output is a RECORD (the time.time() it arrived
+and its length) followed by the data itself. A chunk of length zero marks
+the end of the recording.
+"""
+
+from __future__ import division, print_function, absolute_import, \
+    unicode_literals
+
+import os
+import struct
+import sys
+import time
+
+MAGIC = "hecate-recording"
+VERSION = 1
+RECORD = struct.Struct("<dI")
+
+
+def write_header(path, width, height):
+    """
+    Create a new recording file at path for a terminal of the given size.
+    """
+    with open(path, "wb") as o:
+        o.write(("%s %d %d %d %r\n" % (
+            MAGIC, VERSION, width, height, time.time())).encode('ascii'))
+
+
+def write_chunk(out, data):
+    out.write(RECORD.pack(time.time(), len(data)) + data)
+
+
+def write_end(out):
+    out.write(RECORD.pack(time.time(), 0))
+
+
+def read_chunks(i):
+    """
+    Read the chunks from the recording file i, positioned just after its
+    header. Return a list of (time, data) pairs, and whether the recording
+    was finished (as opposed to cut short, or still being written).
+    """
+    chunks = []
+    while True:
+        record = i.read(RECORD.size)
+        if len(record) < RECORD.size:
+            return chunks, False
+        timestamp, length = RECORD.unpack(record)
+        if length == 0:
+            return chunks, True
+        data = i.read(length)
+        if len(data) < length:
+            return chunks, False
+        chunks.append((timestamp, data))
+
+
+def is_finished(path):
+    """
+    Whether whatever was writing the recording at path has marked its end.
+    """
+    with open(path, "rb") as i:
+        i.readline()
+        return read_chunks(i)[1]
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: recorder.py recording-file", file=sys.stderr)
+        sys.exit(1)
+    stdin = sys.stdin.fileno()
+    with open(sys.argv[1], "ab", buffering=0) as out:
+        while True:
+            data = os.read(stdin, 65536)
+            if not data:
+                break
+            write_chunk(out, data)
+        write_end(out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Replaying recordings of everything a program drew, as made by passing
+record=path to a Runner. e.g.
+
+    python -m hecate.recording recording-file --at 1.5
+
+prints the screen as it was a second and a half into the recording.
+"""
+
+from hecate import recorder
+from hecate.terminal import Screen
+import argparse
+import bisect
+
+
+class Recording(object):
+    """
+    The contents of a recording file. times is the list of when each chunk
+    of output arrived, in seconds since the recording started, and chunks
+    the list of the data in each.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as i:
+            header = i.readline().decode('ascii', 'replace').split()
+            if len(header) != 5 or header[0] != recorder.MAGIC:
+                raise ValueError("%r is not a hecate recording" % (path,))
+            if int(header[1]) != recorder.VERSION:
+                raise ValueError(
+                    "Unsupported recording version %s in %r" % (
+                        header[1], path))
+            self.width = int(header[2])
+            self.height = int(header[3])
+            self.start = float(header[4])
+            chunks, self.finished = recorder.read_chunks(i)
+        self.times = [t - self.start for t, _ in chunks]
+        self.chunks = [data for _, data in chunks]
+
+    @property
+    def duration(self):
+        if not self.times:
+            return 0.0
+        return self.times[-1]
+
+    def screen_at(self, offset=None):
+        """
+        Return a terminal.Screen showing what was on the screen offset
+        seconds after the recording started, or at the end of it if offset
+        is None.
+        """
+        if offset is None:
+            count = len(self.chunks)
+        else:
+            count = bisect.bisect_right(self.times, offset)
+        screen = Screen(self.width, self.height)
+        for data in self.chunks[:count]:
+            screen.feed(data)
+        return screen
+
+    def text_at(self, offset=None):
+        """
+        Return the screen at offset formatted as a Runner's screenshot is.
+        """
+        return self.screen_at(offset).text()
+
+    def frames(self):
+        """
+        Yield (offset, text) for every change to the screen in order. This is
+        much faster than calling text_at for each offset in turn, as the
+        screen is only built once.
+        """
+        screen = Screen(self.width, self.height)
+        for offset, data in zip(self.times, self.chunks):
+            screen.feed(data)
+            yield offset, screen.text()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Show the screen from a hecate recording.")
+    parser.add_argument("recording")
+    parser.add_argument(
+        "--at", type=float, default=None,
+        help="Seconds into the recording to show the screen at. Defaults to "
+             "the end.")
+    parser.add_argument(
+        "--frames", action="store_true",
+        help="Show every change to the screen in turn.")
+    arguments = parser.parse_args()
+    recording = Recording(arguments.recording)
+    if arguments.frames:
+        for offset, text in recording.frames():
+            print("--- %.3fs" % (offset,))
+            print(text, end="")
+    else:
+        print(recording.text_at(arguments.at), end="")
+
+if __name__ == '__main__':
+    main()
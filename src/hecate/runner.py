@@ -7,9 +7,13 @@ import sys
 import os
 import traceback
 import signal
+import select
 
 COMMAND_FAILED_STATUS = 111
 
+# How long hecate waits for us to go once it has released us.
+RELEASE_TIMEOUT = 1
+
 CONTROLLER = "Controller"
 CHILD = "Child"
 EXIT_STATUS = "Exit status"
@@ -71,23 +75,50 @@ def main():
         except:
             traceback.print_exc()
             os._exit(COMMAND_FAILED_STATUS)
-    report_field(CHILD, child)
     os.close(r)
+    # We share the terminal's foreground process group with the child, so
+    # e.g. C-c is meant for it rather than us.
+    for sig in [signal.SIGINT, signal.SIGQUIT, signal.SIGTSTP]:
+        signal.signal(sig, signal.SIG_IGN)
+    release_r, release_w = os.pipe()
 
     def awaken_child(signal, frame):
         global sig_user_1
-        sig_user_1 = True
-        os.write(w, b"1")
-        os.close(w)
+        if not sig_user_1:
+            sig_user_1 = True
+            os.write(w, b"1")
+            os.close(w)
+        else:
+            os.write(release_w, b"1")
 
+    # Hecate sends SIGUSR1 as soon as it sees the child reported, so the
+    # handler must be in place before then. A second SIGUSR1 releases us once
+    # hecate is done with the screen after the child exits.
     signal.signal(signal.SIGUSR1, awaken_child)
-    while not sig_user_1:
-        signal.pause()
-    _, exit_status = os.waitpid(child, 0)
+    report_field(CHILD, child)
+    # The child will not get past its read until the handler has run, so
+    # there is no need to wait for the signal separately (which would race
+    # with it arriving).
+    while True:
+        try:
+            _, exit_status = os.waitpid(child, 0)
+            break
+        except InterruptedError:
+            pass
     report_field(EXIT_STATUS, exit_status)
-    reporter.close()
-    # Long sleep to give time to snapshot the screen
-    time.sleep(1)
+    # Exiting closes the pane, so hang around until hecate has snapshotted the
+    # screen and releases us. It keeps reading the reports for as long as it
+    # might still want the pane, e.g. to restart the command in it, so we
+    # also go once nothing is reading them any more, which is the case if it
+    # has died. Writing to a pipe nobody reads is an error, which poll tells
+    # us about without our having to ask.
+    poller = select.poll()
+    poller.register(release_r, select.POLLIN)
+    poller.register(reporter.fileno(), 0)
+    try:
+        poller.poll()
+    except InterruptedError:
+        pass
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,360 @@
+"""
+A Snapshot is the whole state of a screen at one moment: what is in every
+cell, what it looks like (colours, bold, underline and so on) and where the
+cursor is. A Runner makes one from a single capture-pane -e.
+
+Snapshots are meant to be cheap enough to keep thousands of. Cells are
+stored in two flat arrays, one of code points and one of attributes packed
+into 64 bit integers, and the second is dropped entirely for screens with no
+styling on them.
+"""
+
+from hecate.terminal import DEC_SPECIAL_GRAPHICS, char_width
+from array import array
+
+BOLD = 1 << 0
+DIM = 1 << 1
+ITALIC = 1 << 2
+UNDERLINE = 1 << 3
+BLINK = 1 << 4
+REVERSE = 1 << 5
+HIDDEN = 1 << 6
+STRIKETHROUGH = 1 << 7
+
+FLAGS = [
+    ("bold", BOLD), ("dim", DIM), ("italic", ITALIC),
+    ("underline", UNDERLINE), ("blink", BLINK), ("reverse", REVERSE),
+    ("hidden", HIDDEN), ("strikethrough", STRIKETHROUGH),
+]
+
+# SGR parameters that set or clear a flag.
+SET_FLAG = {1: BOLD, 2: DIM, 3: ITALIC, 4: UNDERLINE, 5: BLINK, 7: REVERSE,
+            8: HIDDEN, 9: STRIKETHROUGH}
+CLEAR_FLAGS = {22: BOLD | DIM, 23: ITALIC, 24: UNDERLINE, 25: BLINK,
+               27: REVERSE, 28: HIDDEN, 29: STRIKETHROUGH}
+
+# A packed attribute is the flags in its bottom 8 bits, then the foreground
+# and then the background colour in COLOUR_BITS bits each. A colour is 0 for
+# the terminal's default, 1 + n for colour n of the 256 colour palette, or
+# TRUE_COLOUR plus 0xRRGGBB.
+FLAG_BITS = 8
+COLOUR_BITS = 25
+COLOUR_MASK = (1 << COLOUR_BITS) - 1
+TRUE_COLOUR = 1 << 24
+FOREGROUND_SHIFT = FLAG_BITS
+BACKGROUND_SHIFT = FLAG_BITS + COLOUR_BITS
+
+# Stands in for the right hand half of a wide character.
+CONTINUATION = 0
+
+ESCAPE = "\x1b"
+SHIFT_OUT = "\x0e"
+SHIFT_IN = "\x0f"
+
+
+def decode_colour(colour):
+    """
+    Turn a packed colour into None for the default colour, an int for a
+    palette colour, or an (r, g, b) tuple for a true colour.
+    """
+    if colour == 0:
+        return None
+    if colour & TRUE_COLOUR:
+        rgb = colour & 0xffffff
+        return (rgb >> 16, (rgb >> 8) & 0xff, rgb & 0xff)
+    return colour - 1
+
+
+def encode_colour(colour):
+    if colour is None:
+        return 0
+    if isinstance(colour, tuple):
+        r, g, b = colour
+        return TRUE_COLOUR | (r << 16) | (g << 8) | b
+    return colour + 1
+
+
+class Attributes(object):
+    """
+    What a cell looks like: fg and bg are its colours (as for decode_colour)
+    and there is a boolean attribute for each of bold, dim, italic,
+    underline, blink, reverse, hidden and strikethrough.
+    """
+
+    def __init__(self, packed=0):
+        self.packed = packed
+        self.fg = decode_colour((packed >> FOREGROUND_SHIFT) & COLOUR_MASK)
+        self.bg = decode_colour((packed >> BACKGROUND_SHIFT) & COLOUR_MASK)
+        for name, flag in FLAGS:
+            setattr(self, name, bool(packed & flag))
+
+    def matches(self, **criteria):
+        """
+        Whether every attribute named in criteria has the given value, e.g.
+        matches(fg=1, bold=True).
+        """
+        for name, value in criteria.items():
+            if name not in ("fg", "bg") and name not in dict(FLAGS):
+                raise TypeError("Unknown attribute %r" % (name,))
+            if getattr(self, name) != value:
+                return False
+        return True
+
+    def __eq__(self, other):
+        return isinstance(other, Attributes) and self.packed == other.packed
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.packed)
+
+    def __repr__(self):
+        parts = ["%s=%r" % (name, getattr(self, name))
+                 for name in ("fg", "bg") if getattr(self, name) is not None]
+        parts.extend(name for name, _ in FLAGS if getattr(self, name))
+        return "Attributes(%s)" % (", ".join(parts),)
+
+
+def _apply_sgr(packed, parameters):
+    codes = [int(p) if p else 0 for p in parameters.split(";")]
+    i = 0
+    while i < len(codes):
+        code = codes[i]
+        i += 1
+        if code == 0:
+            packed = 0
+        elif code in SET_FLAG:
+            packed |= SET_FLAG[code]
+        elif code in CLEAR_FLAGS:
+            packed &= ~CLEAR_FLAGS[code]
+        elif 30 <= code <= 37 or 90 <= code <= 97 or code in (38, 39):
+            colour, i = _sgr_colour(code, codes, i, 30)
+            packed = _with_colour(packed, FOREGROUND_SHIFT, colour)
+        elif 40 <= code <= 47 or 100 <= code <= 107 or code in (48, 49):
+            colour, i = _sgr_colour(code, codes, i, 40)
+            packed = _with_colour(packed, BACKGROUND_SHIFT, colour)
+    return packed
+
+
+def _sgr_colour(code, codes, i, base):
+    if code == base + 9:
+        return 0, i
+    if code == base + 8:
+        if codes[i:i + 1] == [5] and len(codes) > i + 1:
+            return encode_colour(codes[i + 1]), i + 2
+        if codes[i:i + 1] == [2] and len(codes) > i + 3:
+            return encode_colour(tuple(codes[i + 1:i + 4])), i + 4
+        return 0, len(codes)
+    if code >= base + 60:
+        return encode_colour(code - base - 60 + 8), i
+    return encode_colour(code - base), i
+
+
+def _with_colour(packed, shift, colour):
+    return (packed & ~(COLOUR_MASK << shift)) | (colour << shift)
+
+
+class Snapshot(object):
+    """
+    The contents of a width by height screen, with the cursor at column
+    cursor_x of row cursor_y (both counting from 0), or cursor None if the
+    position is not known.
+    """
+
+    def __init__(self, width, height, cursor=None):
+        self.width = width
+        self.height = height
+        self.cursor = cursor
+        self.chars = array("I", [ord(" ")]) * (width * height)
+        self.attributes = None
+
+    @classmethod
+    def parse(cls, captured, width, height, cursor=None):
+        """
+        Build a Snapshot from the output of capture-pane -e. Plain
+        capture-pane output works too, and gives a Snapshot with no styling.
+        """
+        snapshot = cls(width, height, cursor)
+        chars = snapshot.chars
+        attributes = None
+        packed = 0
+        special_graphics = False
+        x = y = 0
+        i = 0
+        n = len(captured)
+        while i < n:
+            c = captured[i]
+            i += 1
+            if c == "\n":
+                x = 0
+                y += 1
+                if y >= height:
+                    break
+                continue
+            if c == ESCAPE:
+                i, sgr = _skip_escape(captured, i)
+                if sgr is not None:
+                    packed = _apply_sgr(packed, sgr)
+                continue
+            if c == SHIFT_OUT:
+                special_graphics = True
+                continue
+            if c == SHIFT_IN:
+                special_graphics = False
+                continue
+            if special_graphics:
+                c = DEC_SPECIAL_GRAPHICS.get(c, c)
+            cell_width = char_width(c)
+            if cell_width == 0 or x + cell_width > width:
+                continue
+            start = y * width + x
+            chars[start] = ord(c)
+            if cell_width == 2:
+                chars[start + 1] = CONTINUATION
+            if packed:
+                if attributes is None:
+                    attributes = array("Q", [0]) * (width * height)
+                for j in range(cell_width):
+                    attributes[start + j] = packed
+            x += cell_width
+        snapshot.attributes = attributes
+        return snapshot
+
+    def char(self, x, y):
+        """
+        The character in column x of row y, or "" if it is the right hand
+        half of a wide character.
+        """
+        c = self.chars[y * self.width + x]
+        return chr(c) if c != CONTINUATION else ""
+
+    def attributes_at(self, x, y):
+        """
+        The Attributes of the cell in column x of row y.
+        """
+        if self.attributes is None:
+            return Attributes()
+        return Attributes(self.attributes[y * self.width + x])
+
+    def row(self, y, left=0, right=None):
+        """
+        The text of row y (from column left up to but not including right if
+        given) with trailing spaces removed.
+        """
+        if right is None or right > self.width:
+            right = self.width
+        start = y * self.width
+        return "".join(
+            chr(c) for c in self.chars[start + left:start + right]
+            if c != CONTINUATION
+        ).rstrip(" ")
+
+    def rows(self, region=None):
+        """
+        A list of the text of the rows of region (anything with top, bottom,
+        left and right attributes, like a Region), or of the whole screen.
+        """
+        if region is None:
+            return [self.row(y) for y in range(self.height)]
+        bottom = self.height if region.bottom is None else min(
+            region.bottom, self.height)
+        return [
+            self.row(y, region.left, region.right)
+            for y in range(region.top, bottom)
+        ]
+
+    def text(self):
+        """
+        The screen as a Runner's screenshot would show it.
+        """
+        return "".join(row + "\n" for row in self.rows())
+
+    def runs(self, y):
+        """
+        Split row y into runs of cells that look the same, returning a list
+        of (x, text, Attributes) triples. Trailing unstyled spaces are left
+        out.
+        """
+        start = y * self.width
+        result = []
+        run_start = 0
+        current = None
+        text = []
+        for x in range(self.width):
+            packed = 0 if self.attributes is None else self.attributes[
+                start + x]
+            if packed != current:
+                if text:
+                    result.append((run_start, "".join(text), current))
+                run_start = x
+                current = packed
+                text = []
+            c = self.chars[start + x]
+            if c != CONTINUATION:
+                text.append(chr(c))
+        if text:
+            result.append((run_start, "".join(text), current))
+        if result and result[-1][2] == 0:
+            x, text, packed = result.pop()
+            if text.rstrip(" "):
+                result.append((x, text.rstrip(" "), packed))
+        return [(x, text, Attributes(packed)) for x, text, packed in result]
+
+    def find(self, text, **criteria):
+        """
+        Return the (x, y) of the first place text appears on a single row, or
+        None if it does not. If criteria are given (as for
+        Attributes.matches) every cell of it must match them too.
+        """
+        for y in range(self.height):
+            line = self.row(y)
+            columns = self._columns(y)
+            start = line.find(text)
+            while start >= 0:
+                x = columns[start]
+                if not criteria or all(
+                    self.attributes_at(columns[k], y).matches(**criteria)
+                    for k in range(start, start + len(text))
+                ):
+                    return (x, y)
+                start = line.find(text, start + 1)
+        return None
+
+    def _columns(self, y):
+        # The column each character of row(y) starts at.
+        start = y * self.width
+        return [
+            x for x in range(self.width)
+            if self.chars[start + x] != CONTINUATION
+        ]
+
+    def __repr__(self):
+        return "Snapshot(%d, %d, cursor=%r)" % (
+            self.width, self.height, self.cursor)
+
+
+def _skip_escape(data, i):
+    # Called just after an escape. Returns where the sequence ends, and its
+    # parameters if it was an SGR.
+    if i >= len(data):
+        return i, None
+    c = data[i]
+    if c == "[":
+        j = i + 1
+        while j < len(data) and not ("@" <= data[j] <= "~"):
+            j += 1
+        if j < len(data) and data[j] == "m":
+            return j + 1, data[i + 1:j]
+        return j + 1, None
+    if c == "]":
+        # An OSC (e.g. a hyperlink), terminated by BEL or ST.
+        j = i + 1
+        while j < len(data):
+            if data[j] == "\x07":
+                return j + 1, None
+            if data[j] == ESCAPE and data[j + 1:j + 2] == "\\":
+                return j + 2, None
+            j += 1
+        return j, None
+    return i + 1, None
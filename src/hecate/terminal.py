@@ -0,0 +1,697 @@
+"""
+An in-process model of a VT100 style terminal screen, for backends that run
+programs on a pty of their own rather than inside tmux.
+
+It understands the subset of xterm that the "screen" terminfo entry (which is
+what tmux presents to the programs it runs) and the usual curses libraries
+rely on. Anything it does not understand is ignored rather than printed.
+"""
+
+import codecs
+import collections
+import unicodedata
+
+
+# The DEC special graphics character set, selected with ESC ( 0, which curses
+# uses for line drawing.
+DEC_SPECIAL_GRAPHICS = dict(zip(
+    "`abcdefghijklmnopqrstuvwxyz{|}~",
+    "◆▒␉␌␍␊°±␤␋┘┐┌└┼⎺⎻─⎼⎽├┤┴┬│≤≥π≠£·",
+))
+
+GROUND = 0
+ESCAPE = 1
+ESCAPE_INTERMEDIATE = 2
+CSI = 3
+STRING = 4
+STRING_ESCAPE = 5
+
+# Bytes for tmux's names for keys, as tmux sends them to a program running with
+# TERM=screen. Cursor keys are handled separately as they depend on the
+# terminal's mode.
+KEYS = {
+    "enter": "\r",
+    "escape": "\x1b",
+    "tab": "\t",
+    "btab": "\x1b[Z",
+    "space": " ",
+    "bspace": "\x7f",
+    "home": "\x1b[1~",
+    "end": "\x1b[4~",
+    "ic": "\x1b[2~",
+    "insert": "\x1b[2~",
+    "dc": "\x1b[3~",
+    "delete": "\x1b[3~",
+    "ppage": "\x1b[5~",
+    "pageup": "\x1b[5~",
+    "pgup": "\x1b[5~",
+    "npage": "\x1b[6~",
+    "pagedown": "\x1b[6~",
+    "pgdn": "\x1b[6~",
+    "f1": "\x1bOP",
+    "f2": "\x1bOQ",
+    "f3": "\x1bOR",
+    "f4": "\x1bOS",
+    "f5": "\x1b[15~",
+    "f6": "\x1b[17~",
+    "f7": "\x1b[18~",
+    "f8": "\x1b[19~",
+    "f9": "\x1b[20~",
+    "f10": "\x1b[21~",
+    "f11": "\x1b[23~",
+    "f12": "\x1b[24~",
+}
+
+CURSOR_KEYS = {
+    "up": "A",
+    "down": "B",
+    "right": "C",
+    "left": "D",
+}
+
+
+def char_width(c):
+    """
+    The number of cells c takes up on the screen: 0 for combining characters,
+    2 for wide East Asian ones and 1 for everything else.
+    """
+    if unicodedata.combining(c) or unicodedata.category(c) in ("Mn", "Me"):
+        return 0
+    if unicodedata.east_asian_width(c) in ("W", "F"):
+        return 2
+    return 1
+
+
+def _is_wide(cell):
+    return cell != "" and char_width(cell[0]) == 2
+
+
+def _control(c):
+    if c in " @2":
+        return "\x00"
+    if c == "?":
+        return "\x7f"
+    if "a" <= c <= "z":
+        return chr(ord(c) - 96)
+    if "@" <= c <= "_":
+        return chr(ord(c) - 64)
+    return c
+
+
+def encode_key(key, application_cursor_keys=False):
+    """
+    Return the bytes that pressing key sends to the program, where key is
+    named as for tmux send-keys (e.g. "Enter", "C-d", "M-x", "Up" or a single
+    character). As with tmux, anything that is not the name of a key is sent
+    as literal text.
+    """
+    ctrl = meta = shift = False
+    rest = key
+    while len(rest) > 2 and rest[1] == "-" and rest[0] in "CMScms":
+        modifier = rest[0].upper()
+        if modifier == "C":
+            ctrl = True
+        elif modifier == "M":
+            meta = True
+        else:
+            shift = True
+        rest = rest[2:]
+    if len(rest) == 2 and rest[0] == "^":
+        ctrl = True
+        rest = rest[1]
+    name = rest.lower()
+    if name in CURSOR_KEYS:
+        final = CURSOR_KEYS[name]
+        if ctrl or meta or shift:
+            code = 1 + shift + 2 * meta + 4 * ctrl
+            result = "\x1b[1;%d%s" % (code, final)
+        elif application_cursor_keys:
+            result = "\x1bO" + final
+        else:
+            result = "\x1b[" + final
+        return result.encode('utf-8')
+    if name in KEYS:
+        result = KEYS[name]
+        if ctrl and len(result) == 1:
+            result = _control(result)
+    elif len(rest) == 1:
+        result = rest
+        if shift:
+            result = result.upper()
+        if ctrl:
+            result = _control(result)
+    else:
+        return key.encode('utf-8')
+    if meta:
+        result = "\x1b" + result
+    return result.encode('utf-8')
+
+
+class Cursor(object):
+    def __init__(self, x=0, y=0):
+        self.x = x
+        self.y = y
+        self.pending_wrap = False
+        self.charsets = ["B", "B"]
+        self.shift = 0
+        self.origin = False
+
+    def copy(self):
+        result = Cursor(self.x, self.y)
+        result.pending_wrap = self.pending_wrap
+        result.charsets = list(self.charsets)
+        result.shift = self.shift
+        result.origin = self.origin
+        return result
+
+
+class Screen(object):
+    """
+    The state of a terminal screen of the given dimensions. Feed it the output
+    of a program with feed() and read the result with text().
+
+    Each line is a list of cells holding the text displayed in them. The cell
+    after a wide character holds the empty string.
+    """
+
+    def __init__(self, width, height, history_limit=0):
+        self.width = width
+        self.height = height
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        # Like tmux, keep up to history_limit of the lines that have scrolled
+        # off the top of the screen. scrolled counts every line that ever
+        # has, so that readers can tell which lines are new to them.
+        self.history = collections.deque(maxlen=history_limit)
+        self.scrolled = 0
+        self.reset()
+
+    def reset(self):
+        self.lines = [self._blank_line() for _ in range(self.height)]
+        self.cursor = Cursor()
+        self.saved_cursor = None
+        self.main_screen = None
+        self.top = 0
+        self.bottom = self.height - 1
+        self.autowrap = True
+        self.insert_mode = False
+        self.application_cursor_keys = False
+        self.cursor_visible = True
+        self.tab_stops = set(range(8, self.width, 8))
+        self.last_printed = None
+        self.state = GROUND
+        self.parameters = ""
+        self.intermediates = ""
+        self.replies = []
+
+    def resize(self, width, height):
+        """
+        Change the size of the screen, as resizing a terminal window does.
+        Rows are cut off or padded on the right. If there are too many, they
+        come off the bottom, or off the top if that is what it takes to keep
+        the cursor on the screen.
+        """
+        old_width = self.width
+        self.width = width
+        self.height = height
+        shift = self._fit(self.lines, self.cursor.y)
+        self.lines = self.lines[shift:shift + height]
+        self._move_after_resize(self.cursor, shift)
+        if self.saved_cursor is not None:
+            self._move_after_resize(self.saved_cursor, shift)
+        if self.main_screen is not None:
+            lines, cursor = self.main_screen
+            main_shift = self._fit(lines, cursor.y)
+            self._move_after_resize(cursor, main_shift)
+            self.main_screen = (lines[main_shift:main_shift + height], cursor)
+        self.top = 0
+        self.bottom = height - 1
+        self.tab_stops = set(t for t in self.tab_stops if t < width) | set(
+            range((old_width + 7) // 8 * 8, width, 8))
+
+    def _move_after_resize(self, cursor, shift):
+        cursor.y = max(0, min(cursor.y - shift, self.height - 1))
+        cursor.x = min(cursor.x, self.width - 1)
+        cursor.pending_wrap = False
+
+    def _fit(self, lines, cursor_y):
+        # Make each of lines the current width and pad them out to the
+        # current height. Returns how many should come off the top.
+        for line in lines:
+            del line[self.width:]
+            line.extend([" "] * (self.width - len(line)))
+            self._repair(line)
+        while len(lines) < self.height:
+            lines.append(self._blank_line())
+        excess = len(lines) - self.height
+        return min(excess, max(cursor_y - self.height + 1, 0))
+
+    def feed(self, data):
+        """
+        Update the screen with data, a bytes object written by the program.
+        Returns any bytes the terminal would send back in reply, e.g. to a
+        cursor position request.
+        """
+        self.replies = []
+        for c in self.decoder.decode(data):
+            self._consume(c)
+        result = "".join(self.replies).encode('utf-8')
+        self.replies = []
+        return result
+
+    def display(self, top=0, bottom=None):
+        """
+        Return a list of the lines on the screen, without trailing spaces, or
+        only of those from top up to but not including bottom.
+        """
+        return [
+            "".join(line).rstrip(" ") for line in self.lines[top:bottom]
+        ]
+
+    def text(self):
+        """
+        Return the screen formatted as tmux capture-pane formats it: every
+        line, with trailing spaces removed, followed by a newline.
+        """
+        return "".join(line + "\n" for line in self.display())
+
+    def _blank_line(self):
+        return [" "] * self.width
+
+    def _consume(self, c):
+        state = self.state
+        if state == GROUND:
+            if c >= " " and c != "\x7f":
+                if "\x80" <= c < "\xa0":
+                    return
+                self._print(c)
+            else:
+                self._execute(c)
+        elif state == ESCAPE:
+            self._escape(c)
+        elif state == ESCAPE_INTERMEDIATE:
+            self._escape_intermediate(c)
+        elif state == CSI:
+            if "0" <= c <= "?":
+                if c in "<=>?" and not self.parameters:
+                    self.intermediates += c
+                else:
+                    self.parameters += c
+            elif " " <= c <= "/":
+                self.intermediates += c
+            elif "@" <= c <= "~":
+                self.state = GROUND
+                self._csi(c)
+            elif c == "\x1b":
+                self.state = ESCAPE
+            elif c < " ":
+                self._execute(c)
+            else:
+                self.state = GROUND
+        elif state == STRING:
+            if c == "\x07":
+                self.state = GROUND
+            elif c == "\x1b":
+                self.state = STRING_ESCAPE
+        elif state == STRING_ESCAPE:
+            if c == "\\":
+                self.state = GROUND
+            elif c != "\x1b":
+                self.state = STRING
+
+    def _execute(self, c):
+        cursor = self.cursor
+        if c == "\x1b":
+            self.state = ESCAPE
+            self.intermediates = ""
+        elif c == "\r":
+            cursor.x = 0
+            cursor.pending_wrap = False
+        elif c in "\n\x0b\x0c":
+            self._linefeed()
+        elif c == "\x08":
+            if cursor.pending_wrap:
+                cursor.pending_wrap = False
+            elif cursor.x > 0:
+                cursor.x -= 1
+        elif c == "\t":
+            self._tab(1)
+        elif c == "\x0e":
+            cursor.shift = 1
+        elif c == "\x0f":
+            cursor.shift = 0
+
+    def _escape(self, c):
+        self.state = GROUND
+        cursor = self.cursor
+        if c == "[":
+            self.state = CSI
+            self.parameters = ""
+            self.intermediates = ""
+        elif c in "]PX^_k":
+            self.state = STRING
+        elif " " <= c <= "/":
+            self.state = ESCAPE_INTERMEDIATE
+            self.intermediates = c
+        elif c == "7":
+            self.saved_cursor = cursor.copy()
+        elif c == "8":
+            self._restore_cursor()
+        elif c == "D":
+            self._linefeed()
+        elif c == "E":
+            cursor.x = 0
+            self._linefeed()
+        elif c == "M":
+            self._reverse_index()
+        elif c == "H":
+            self.tab_stops.add(cursor.x)
+        elif c == "c":
+            self.reset()
+        elif c == "\x1b":
+            self.state = ESCAPE
+        elif c < " ":
+            self._execute(c)
+
+    def _escape_intermediate(self, c):
+        if " " <= c <= "/":
+            self.intermediates += c
+            return
+        self.state = GROUND
+        intermediate = self.intermediates[:1]
+        if intermediate in "()":
+            self.cursor.charsets["()".index(intermediate)] = c
+        elif intermediate == "#" and c == "8":
+            self.lines = [["E"] * self.width for _ in range(self.height)]
+
+    def _print(self, c):
+        cursor = self.cursor
+        if cursor.charsets[cursor.shift] == "0":
+            c = DEC_SPECIAL_GRAPHICS.get(c, c)
+        width = char_width(c)
+        if width == 0:
+            x = cursor.x if cursor.pending_wrap else cursor.x - 1
+            line = self.lines[cursor.y]
+            while x > 0 and line[x] == "":
+                x -= 1
+            if x >= 0:
+                line[x] += c
+            return
+        if cursor.pending_wrap or (
+            width == 2 and cursor.x == self.width - 1
+        ):
+            if self.autowrap:
+                cursor.x = 0
+                self._linefeed()
+            cursor.pending_wrap = False
+        if width > self.width:
+            return
+        line = self.lines[cursor.y]
+        if self.insert_mode:
+            line[cursor.x:cursor.x] = [" "] * width
+            del line[self.width:]
+            self._repair(line)
+        self._put(line, cursor.x, c)
+        if width == 2:
+            self._put(line, cursor.x + 1, "")
+        self.last_printed = c
+        if cursor.x + width >= self.width:
+            cursor.x = self.width - 1
+            cursor.pending_wrap = self.autowrap
+        else:
+            cursor.x += width
+
+    def _put(self, line, x, c):
+        # Overwriting half of a wide character blanks the other half.
+        if line[x] == "" and x > 0 and c != "":
+            line[x - 1] = " "
+        if x + 1 < self.width and line[x + 1] == "" and line[x] != "":
+            line[x + 1] = " "
+        line[x] = c
+
+    def _repair(self, line):
+        # Make sure that every wide character is followed by the empty cell
+        # standing in for its second half and that every empty cell is.
+        for i, c in enumerate(line):
+            if c == "":
+                if i == 0 or not _is_wide(line[i - 1]):
+                    line[i] = " "
+            elif _is_wide(c) and (i + 1 == self.width or line[i + 1] != ""):
+                line[i] = " "
+
+    def _linefeed(self):
+        cursor = self.cursor
+        cursor.pending_wrap = False
+        if cursor.y == self.bottom:
+            self._scroll_up(1)
+        elif cursor.y < self.height - 1:
+            cursor.y += 1
+
+    def _reverse_index(self):
+        cursor = self.cursor
+        cursor.pending_wrap = False
+        if cursor.y == self.top:
+            self._scroll_down(1)
+        elif cursor.y > 0:
+            cursor.y -= 1
+
+    def _scroll_up(self, n, top=None):
+        if top is None:
+            top = self.top
+            keep = top == 0 and self.bottom == self.height - 1 and \
+                self.main_screen is None
+        else:
+            # Deleting lines does not add them to the history.
+            keep = False
+        n = min(n, self.bottom - top + 1)
+        if keep:
+            self.history.extend(
+                "".join(line).rstrip(" ") for line in self.lines[:n])
+            self.scrolled += n
+        del self.lines[top:top + n]
+        for _ in range(n):
+            self.lines.insert(self.bottom - n + 1, self._blank_line())
+
+    def _scroll_down(self, n, top=None):
+        if top is None:
+            top = self.top
+        n = min(n, self.bottom - top + 1)
+        del self.lines[self.bottom - n + 1:self.bottom + 1]
+        for _ in range(n):
+            self.lines.insert(top, self._blank_line())
+
+    def _tab(self, n):
+        cursor = self.cursor
+        cursor.pending_wrap = False
+        for _ in range(n):
+            stops = [s for s in self.tab_stops if s > cursor.x]
+            cursor.x = min(stops) if stops else self.width - 1
+
+    def _move_to(self, x, y):
+        cursor = self.cursor
+        cursor.pending_wrap = False
+        if cursor.origin:
+            y += self.top
+            low, high = self.top, self.bottom
+        else:
+            low, high = 0, self.height - 1
+        cursor.x = max(0, min(x, self.width - 1))
+        cursor.y = max(low, min(y, high))
+
+    def _move_vertically(self, n):
+        # Relative movement stops at the scrolling region if it starts in it.
+        cursor = self.cursor
+        cursor.pending_wrap = False
+        if self.top <= cursor.y <= self.bottom:
+            low, high = self.top, self.bottom
+        else:
+            low, high = 0, self.height - 1
+        cursor.y = max(low, min(cursor.y + n, high))
+
+    def _restore_cursor(self):
+        if self.saved_cursor is None:
+            self.cursor = Cursor()
+        else:
+            self.cursor = self.saved_cursor.copy()
+        self.cursor.x = min(self.cursor.x, self.width - 1)
+        self.cursor.y = min(self.cursor.y, self.height - 1)
+
+    def _erase(self, line, start, end):
+        for x in range(max(start, 0), min(end, self.width)):
+            line[x] = " "
+        self._repair(line)
+
+    def _set_mode(self, private, modes, value):
+        for mode in modes:
+            if not private:
+                if mode == 4:
+                    self.insert_mode = value
+                continue
+            if mode == 1:
+                self.application_cursor_keys = value
+            elif mode == 6:
+                self.cursor.origin = value
+                self._move_to(0, 0)
+            elif mode == 7:
+                self.autowrap = value
+            elif mode == 25:
+                self.cursor_visible = value
+            elif mode == 1048:
+                if value:
+                    self.saved_cursor = self.cursor.copy()
+                else:
+                    self._restore_cursor()
+            elif mode in (47, 1047, 1049):
+                self._alternate_screen(value, save_cursor=mode == 1049)
+
+    def _alternate_screen(self, value, save_cursor):
+        if value and self.main_screen is None:
+            self.main_screen = (self.lines, self.cursor.copy())
+            self.lines = [self._blank_line() for _ in range(self.height)]
+        elif not value and self.main_screen is not None:
+            self.lines, cursor = self.main_screen
+            self.main_screen = None
+            if save_cursor:
+                self.cursor = cursor
+
+    def _csi(self, final):
+        private = self.intermediates[:1] in ("?", ">", "<", "=") and \
+            self.intermediates[:1] or ""
+        others = self.intermediates[len(private):]
+        params = []
+        for p in self.parameters.split(";"):
+            try:
+                params.append(int(p.split(":")[0]))
+            except ValueError:
+                params.append(0)
+
+        def arg(i, default=1):
+            if i < len(params) and params[i]:
+                return params[i]
+            return default
+
+        if others:
+            return
+        cursor = self.cursor
+        line = self.lines[cursor.y]
+        if private == "?":
+            if final in "hl":
+                self._set_mode(True, params, final == "h")
+            return
+        if private == ">":
+            if final == "c":
+                self.replies.append("\x1b[>0;0;0c")
+            return
+        if private:
+            return
+        if final == "@":
+            n = min(arg(0), self.width - cursor.x)
+            line[cursor.x:cursor.x] = [" "] * n
+            del line[self.width:]
+            self._repair(line)
+            cursor.pending_wrap = False
+        elif final == "A":
+            self._move_vertically(-arg(0))
+        elif final in "Be":
+            self._move_vertically(arg(0))
+        elif final in "Ca":
+            cursor.pending_wrap = False
+            cursor.x = min(cursor.x + arg(0), self.width - 1)
+        elif final == "D":
+            cursor.pending_wrap = False
+            cursor.x = max(cursor.x - arg(0), 0)
+        elif final == "E":
+            self._move_vertically(arg(0))
+            cursor.x = 0
+        elif final == "F":
+            self._move_vertically(-arg(0))
+            cursor.x = 0
+        elif final in "G`":
+            cursor.pending_wrap = False
+            cursor.x = max(0, min(arg(0) - 1, self.width - 1))
+        elif final in "Hf":
+            self._move_to(arg(1) - 1, arg(0) - 1)
+        elif final == "d":
+            y = arg(0) - 1
+            x = cursor.x
+            self._move_to(x, y)
+        elif final == "I":
+            self._tab(arg(0))
+        elif final == "Z":
+            cursor.pending_wrap = False
+            for _ in range(arg(0)):
+                stops = [s for s in self.tab_stops if s < cursor.x]
+                cursor.x = max(stops) if stops else 0
+        elif final == "J":
+            mode = arg(0, 0)
+            if mode == 0:
+                self._erase(line, cursor.x, self.width)
+                for l in self.lines[cursor.y + 1:]:
+                    self._erase(l, 0, self.width)
+            elif mode == 1:
+                self._erase(line, 0, cursor.x + 1)
+                for l in self.lines[:cursor.y]:
+                    self._erase(l, 0, self.width)
+            elif mode in (2, 3):
+                for l in self.lines:
+                    self._erase(l, 0, self.width)
+        elif final == "K":
+            mode = arg(0, 0)
+            if mode == 0:
+                self._erase(line, cursor.x, self.width)
+            elif mode == 1:
+                self._erase(line, 0, cursor.x + 1)
+            elif mode == 2:
+                self._erase(line, 0, self.width)
+        elif final in "LM":
+            if self.top <= cursor.y <= self.bottom:
+                if final == "L":
+                    self._scroll_down(arg(0), top=cursor.y)
+                else:
+                    self._scroll_up(arg(0), top=cursor.y)
+                cursor.x = 0
+                cursor.pending_wrap = False
+        elif final == "P":
+            n = min(arg(0), self.width - cursor.x)
+            del line[cursor.x:cursor.x + n]
+            line.extend([" "] * n)
+            self._repair(line)
+            cursor.pending_wrap = False
+        elif final == "X":
+            self._erase(line, cursor.x, cursor.x + arg(0))
+        elif final == "S":
+            self._scroll_up(arg(0))
+        elif final == "T":
+            self._scroll_down(arg(0))
+        elif final == "b":
+            if self.last_printed is not None:
+                for _ in range(arg(0)):
+                    self._print(self.last_printed)
+        elif final == "c":
+            self.replies.append("\x1b[?1;2c")
+        elif final == "g":
+            mode = arg(0, 0)
+            if mode == 0:
+                self.tab_stops.discard(cursor.x)
+            elif mode == 3:
+                self.tab_stops.clear()
+        elif final in "hl":
+            self._set_mode(False, params, final == "h")
+        elif final == "n":
+            mode = arg(0, 0)
+            if mode == 5:
+                self.replies.append("\x1b[0n")
+            elif mode == 6:
+                y = cursor.y - (self.top if cursor.origin else 0)
+                self.replies.append("\x1b[%d;%dR" % (y + 1, cursor.x + 1))
+        elif final == "r":
+            top = arg(0) - 1
+            bottom = arg(1, self.height) - 1
+            bottom = min(bottom, self.height - 1)
+            if top < bottom:
+                self.top = top
+                self.bottom = bottom
+                self._move_to(0, 0)
+        elif final == "s":
+            self.saved_cursor = cursor.copy()
+        elif final == "u":
+            self._restore_cursor()
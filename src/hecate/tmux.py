@@ -1,11 +1,74 @@
+from hecate import instrument
 import subprocess
 import re
+import time
 from contextlib import contextmanager
 import os
 import tempfile
+import threading
+import queue
 
 
 AFTER_COLON = re.compile(":.+$")
+VERSION_NUMBER = re.compile(r"(\d+)\.(\d+)")
+
+# Older versions either lack control mode entirely or resize the session to
+# the control client's notional 80x24 terminal when it attaches, so below this
+# we fork a client per command.
+CONTROL_MODE_VERSION = (3, 0)
+
+# capture-pane learned -p (write to stdout) in 1.8.
+CAPTURE_TO_STDOUT_VERSION = (1, 8)
+
+# send-keys learned -l (send keys literally) in 1.7.
+SEND_LITERAL_VERSION = (1, 7)
+
+# new-window and split-window learned -F (how to print the new pane with -P)
+# in 1.8.
+PRINT_FORMAT_VERSION = (1, 8)
+
+# Formats for a pane's cursor position and the size of its history arrived
+# in 1.8.
+PANE_STATE_FORMAT_VERSION = (1, 8)
+
+# resize-window, the only way to resize a window with no clients attached,
+# arrived in 2.9.
+RESIZE_WINDOW_VERSION = (2, 9)
+
+# The first version that can report the exit status of (or signal that
+# killed) the command in a dead pane, and that can be told not to write
+# "Pane is dead" over what it left on the screen (with remain-on-exit-format).
+DIRECT_LAUNCH_VERSION = (3, 3)
+
+# Buffers got names in 2.0, so that we can load one of our own from a client's
+# stdin and paste it without disturbing anyone else's.
+NAMED_BUFFER_VERSION = (2, 0)
+
+# pipe-pane in 1.8 crashes (in the process it forks to run the pipe's
+# command) unless there is a client attached, so panes can't be piped there.
+BROKEN_PIPE_PANE_VERSION = (1, 8)
+
+# A tmux client sends its whole command line to the server in one message,
+# which may be at most 16k, so longer batches are split between clients.
+# Before 1.9 it had to fit in a fixed buffer of 2k instead.
+LONG_COMMAND_VERSION = (1, 9)
+MAX_FORKED_COMMAND_LENGTH = 8192
+MAX_OLD_FORKED_COMMAND_LENGTH = 1024
+
+# How long to wait for a new control mode client to be attached.
+ATTACH_TIMEOUT = 1
+
+FILE_COMMANDS = ["load-buffer", "loadb", "save-buffer", "saveb"]
+
+DEAD_SERVER_MESSAGES = [
+    b"failed to connect to server",
+    b"no server running on",
+    b"error connecting to",
+    b"server exited unexpectedly",
+    b"lost server",
+    # What a server with no sessions left says in the moment before it exits.
+    b"no current target",
+]
 
 
 class CommandFailed(Exception):
@@ -23,31 +86,409 @@ def _extract_names(output):
     ]))
 
 
+def _is_dead_server(output):
+    return any(m in output for m in DEAD_SERVER_MESSAGES)
+
+
+def _quote(argument):
+    return "'" + argument.replace("'", "'\"'\"'") + "'"
+
+
+def _joined(commands):
+    result = []
+    for command in commands:
+        if result:
+            result.append(";")
+        result.extend(command)
+    return result
+
+
+def _forkable_batches(commands, limit):
+    # Group commands into runs that fit on one client's command line. A
+    # single command that is too long on its own gets a client to itself,
+    # and tmux will say what it thinks of it.
+    batch = []
+    length = 0
+    for command in commands:
+        size = sum(len(a.encode('utf-8')) + 1 for a in command) + 2
+        if batch and length + size > limit:
+            yield batch
+            batch = []
+            length = 0
+        batch.append(command)
+        length += size
+    if batch:
+        yield batch
+
+
+def _escape_separator(argument):
+    # tmux splits its command line into separate commands at any argument
+    # ending in an unescaped ;
+    if argument.endswith(";"):
+        return argument[:-1] + "\\;"
+    return argument
+
+
 TMUX = os.getenv("HECATE_TMUX_BINARY") or "tmux"
 
+_versions = {}
+
+
+def tmux_version(binary=None):
+    """
+    Return the version of the tmux binary (defaulting to the one hecate is
+    configured to use) as a (major, minor) tuple. Letter suffixes such as the
+    one in 1.9a are ignored. Returns None if the version cannot be determined,
+    e.g. for a development build, which callers should treat as recent.
+    """
+    if binary is None:
+        binary = TMUX
+    try:
+        return _versions[binary]
+    except KeyError:
+        pass
+    try:
+        output = subprocess.check_output(
+            [binary, "-V"], stderr=subprocess.STDOUT
+        ).decode('ascii', 'replace')
+    except (OSError, subprocess.CalledProcessError):
+        output = ""
+    match = VERSION_NUMBER.search(output)
+    if match is None:
+        result = None
+    else:
+        result = (int(match.group(1)), int(match.group(2)))
+    _versions[binary] = result
+    return result
+
+
+def tmux_supports(minimum_version):
+    version = tmux_version()
+    return version is None or version >= minimum_version
+
+
+class ControlClient(object):
+    """
+    A single long lived tmux client running in control mode (tmux -C)
+    attached to the server. Commands are written to it one per line and the
+    reply to each is read back from the %begin/%end (or %error) block that
+    tmux writes for it, which saves forking a new client for every command.
+    """
 
-class Tmux(object):
     def __init__(self, name):
+        self.process = subprocess.Popen(
+            [TMUX, "-u", "-C", "-L", name, "attach-session"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self.lock = threading.Lock()
+        self.replies = queue.Queue()
+        self.error_output = b""
+        self.output_changed = threading.Condition()
+        self.output_count = 0
+        self.watchers = set()
+        self.session = None
+        self.attached = threading.Event()
+        self.reader = threading.Thread(target=self._read_output)
+        self.reader.daemon = True
+        self.reader.start()
+        # tmux answers commands before it has finished attaching us, and
+        # until it has we are not told about output, so anything a command
+        # sent now made happen could go unnoticed.
+        self.attached.wait(ATTACH_TIMEOUT)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def execute_command(self, *command):
+        return self.execute_commands([command])
+
+    def execute_commands(self, commands):
+        """
+        Run each of commands in turn, sending them all in a single write, and
+        return their combined output. Each is on a line of its own, so that
+        one failing does not stop tmux from running the rest, but
+        CommandFailed is raised if any of them did fail.
+        """
+        start = time.perf_counter()
+        data = "".join(
+            " ".join(map(_quote, command)) + "\n" for command in commands
+        )
+        try:
+            replies = self._send(data, len(commands))
+        finally:
+            instrument.record_command(
+                _joined(commands), start, "control")
+        output = b"".join(
+            l + b"\n" for _, lines in replies for l in lines
+        )
+        if not all(succeeded for succeeded, _ in replies):
+            raise CommandFailed(output)
+        return output.decode('utf-8')
+
+    def _send(self, data, count):
+        replies = []
+        with self.lock:
+            try:
+                self.process.stdin.write(data.encode('utf-8'))
+                self.process.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                pass
+            for _ in range(count):
+                reply = self.replies.get()
+                if reply is None:
+                    # Leave the marker for anyone else waiting on a reply.
+                    self.replies.put(None)
+                    break
+                replies.append(reply)
+        if len(replies) < count:
+            self.reader.join()
+            if _is_dead_server(self.error_output):
+                raise DeadServer(self.error_output)
+            raise CommandFailed(self.error_output)
+        return replies
+
+    def await_output(self, since, timeout):
+        """
+        Block until tmux has notified us of pane output beyond the first
+        since notifications, the client exits, or timeout seconds pass.
+        Returns the number of output notifications seen so far.
+        """
+        with self.output_changed:
+            self.output_changed.wait_for(
+                lambda: self.output_count != since or not self.alive(),
+                timeout
+            )
+            return self.output_count
+
+    def watch_output(self, event):
+        """
+        Set the threading.Event event whenever there is output, and when the
+        client exits, until unwatch_output is called with it.
+        """
+        with self.output_changed:
+            self.watchers.add(event)
+
+    def unwatch_output(self, event):
+        with self.output_changed:
+            self.watchers.discard(event)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self.process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.reader.join()
+
+    def _read_output(self):
+        guard = None
+        block = None
+        for line in self.process.stdout:
+            line = line.rstrip(b"\n")
+            if block is not None:
+                if line.startswith((b"%end ", b"%error ")) and \
+                        line.split(b" ", 1)[1] == guard:
+                    fields = guard.split()
+                    # Blocks flagged 0 are for commands we did not send, such
+                    # as the initial attach.
+                    if len(fields) < 3 or fields[2] != b"0":
+                        self.replies.put((line.startswith(b"%end "), block))
+                    block = None
+                else:
+                    block.append(line)
+            elif line.startswith(b"%begin "):
+                guard = line.split(b" ", 1)[1]
+                block = []
+            elif line.startswith(b"%session-changed "):
+                self.session = line.split(b" ", 2)[2].decode('utf-8')
+                self.attached.set()
+            elif line.startswith((b"%output ", b"%extended-output ")):
+                with self.output_changed:
+                    self.output_count += 1
+                    self.output_changed.notify_all()
+                    self._wake_watchers()
+        self.process.wait()
+        self.error_output = self.process.stderr.read()
+        self.attached.set()
+        self.replies.put(None)
+        with self.output_changed:
+            self.output_changed.notify_all()
+            self._wake_watchers()
+
+    def _wake_watchers(self):
+        # Called with output_changed held.
+        for event in self.watchers:
+            event.set()
+
+
+def socket_directory():
+    """
+    Where tmux puts the sockets of this user's servers.
+    """
+    return os.path.join(
+        os.getenv("TMUX_TMPDIR") or "/tmp", "tmux-%d" % (os.getuid(),))
+
+
+def server_names():
+    """
+    The socket names (as passed to -L) of the tmux servers this user may
+    have running. tmux does not clean up after itself, so this includes the
+    sockets of servers that have exited.
+    """
+    try:
+        return sorted(os.listdir(socket_directory()))
+    except FileNotFoundError:
+        return []
+
+
+def kill_server(name):
+    """
+    Kill the tmux server on the socket called name if it is running. Unlike
+    Tmux(name).shutdown() this never starts one first.
+    """
+    with open(os.devnull, "w") as o:
+        subprocess.call([TMUX, "-u", "-L", name, "kill-server"], stderr=o)
+
+
+class Tmux(object):
+    def __init__(self, name, control_mode=False):
+        """
+        Manage the tmux server on the socket called name, starting it if it is
+        not already running.
+
+        If control_mode is True and the tmux version supports it, commands are
+        sent down a single persistent control mode client rather than forking
+        a new tmux process for each one.
+        """
         self.name = name
+        self.control_mode = False
+        self.control_client = None
+        start = time.perf_counter()
         try:
             subprocess.check_output(
                 [TMUX, "-u", "-L", self.name, "list-sessions"],
                 stderr=subprocess.STDOUT
             )
         except subprocess.CalledProcessError:
+            instrument.record_command(["list-sessions"], start, "fork")
             self.new_session()
+        else:
+            instrument.record_command(["list-sessions"], start, "fork")
+        # A control mode client has to attach to a session, so can only be
+        # used once the server is running.
+        self.control_mode = control_mode and tmux_supports(
+            CONTROL_MODE_VERSION)
 
     def execute_command(self, *command):
+        command = list(map(str, command))
+        if self.control_mode and self._can_control(command):
+            return self._control().execute_command(*command)
+        return self.fork_command(*command)
+
+    def execute_commands(self, commands):
+        """
+        Run each of commands, a list of argument lists, in order with a single
+        tmux client (one control mode write, or one new process) and return
+        their combined output. Without control mode, batches too long for
+        one client's command line are split between as few as will do.
+        """
+        commands = [list(map(str, command)) for command in commands]
+        if self.control_mode and all(map(self._can_control, commands)):
+            return self._control().execute_commands(commands)
+        if tmux_supports(LONG_COMMAND_VERSION):
+            limit = MAX_FORKED_COMMAND_LENGTH
+        else:
+            limit = MAX_OLD_FORKED_COMMAND_LENGTH
+        return "".join(
+            self.fork_command(*_joined(
+                list(map(_escape_separator, command)) for command in batch
+            ))
+            for batch in _forkable_batches(commands, limit)
+        )
+
+    def fork_command(self, *command, input=None):
+        """
+        Run a command in a new tmux client process, regardless of whether
+        control mode is in use. If input is given it is the client's stdin,
+        for commands that read from it.
+        """
+        start = time.perf_counter()
         try:
             cmd = [TMUX, "-u", "-L", self.name] + list(map(str, command))
             return subprocess.check_output(
-                cmd,
+                cmd, input=input,
                 stderr=subprocess.STDOUT
-            ).decode('ascii')
+            ).decode('utf-8')
         except subprocess.CalledProcessError as e:
-            if b"failed to connect to server: Connection refused" in e.output:
+            if _is_dead_server(e.output):
                 raise DeadServer(e.output)
             raise CommandFailed(e.output)
+        finally:
+            instrument.record_command(command, start, "fork")
+
+    def output_count(self):
+        """
+        Return a counter that increases whenever any pane produces output, or
+        None if this Tmux has no way of being told about output.
+        """
+        client = self.control_client
+        if client is None or not client.alive():
+            return None
+        return client.output_count
+
+    def await_output(self, since, timeout):
+        """
+        Wait for up to timeout seconds for output_count() to move on from
+        since, returning the new count. Returns None if output notifications
+        are not available, in which case callers should fall back to polling.
+        """
+        client = self.control_client
+        if client is None or not client.alive():
+            return None
+        if since is None:
+            return client.output_count
+        result = client.await_output(since, timeout)
+        if not client.alive():
+            return None
+        return result
+
+    def watch_output(self, event):
+        """
+        Set the threading.Event event whenever any pane produces output,
+        until unwatch_output is called with it. Returns False, and does
+        nothing, if this Tmux has no way of being told about output.
+        """
+        client = self.control_client
+        if client is None or not client.alive():
+            return False
+        client.watch_output(event)
+        return True
+
+    def unwatch_output(self, event):
+        client = self.control_client
+        if client is not None:
+            client.unwatch_output(event)
+
+    def _control(self):
+        if self.control_client is None or not self.control_client.alive():
+            self.control_client = ControlClient(self.name)
+        return self.control_client
+
+    def _can_control(self, command):
+        # Newer versions read and write buffer files through the client, and
+        # may answer a control client before they have finished doing so.
+        if command and command[0] in FILE_COMMANDS:
+            return False
+        # Control mode is line based, and the command parsers in different
+        # versions disagree about a trailing ; so leave those to a fork.
+        return not any(
+            "\n" in c or "\r" in c or c.endswith(";") for c in command
+        )
 
     def new_session(
         self, width=80, height=24, window=None, name=None, command=None
@@ -64,7 +505,16 @@ class Tmux(object):
         self.execute_command(*arguments)
 
     def kill_session(self, name):
-        self.execute_command("kill-session", "-t", name)
+        client = self.control_client
+        if client is not None and client.session in (None, name):
+            # The control client may exit rather than answer if we kill the
+            # session it is attached to, so kill it with a fork instead and
+            # let the next command attach a new client elsewhere.
+            client.close()
+            self.control_client = None
+            self.fork_command("kill-session", "-t", name)
+        else:
+            self.execute_command("kill-session", "-t", name)
 
     def buffers(self):
         return _extract_names(self.execute_command("list-buffers"))
@@ -77,6 +527,12 @@ class Tmux(object):
                 "list-panes", "-t", session
             ))
 
+    def respawn_pane(self, pane, command):
+        self.execute_command("respawn-pane", "-k", "-t", pane, command)
+
+    def clear_history(self, pane):
+        self.execute_command("clear-history", "-t", pane)
+
     def select_pane(self, pane):
         self.execute_command("select-pane", "-t", pane)
 
@@ -111,6 +567,32 @@ class Tmux(object):
                 o.write(data)
             self.execute_command("load-buffer", t)
 
+    def paste_data(self, pane, data, buffer_name, if_alive=False):
+        """
+        Paste data, a bytestring, into pane. It goes by way of the buffer
+        called buffer_name, which is loaded from the client's stdin and
+        deleted again, all in one client. If if_alive is set, nothing is
+        pasted if the pane's command has exited, which tmux 3.3a at least
+        would crash on.
+        """
+        if not tmux_supports(NAMED_BUFFER_VERSION):
+            with self.temp() as t:
+                with open(t, "wb") as o:
+                    o.write(data)
+                self.execute_command("load-buffer", t)
+            self.execute_command("paste-buffer", "-d", "-t", pane)
+            return
+        paste = ["paste-buffer", "-d", "-b", buffer_name, "-t", pane]
+        if if_alive:
+            paste = [
+                "if-shell", "-F", "-t", pane, "#{?pane_dead,,1}",
+                " ".join(map(_quote, paste)),
+                " ".join(map(_quote, ["delete-buffer", "-b", buffer_name])),
+            ]
+        self.fork_command(*_joined([
+            ["load-buffer", "-b", buffer_name, "-"], paste
+        ]), input=data)
+
     def a_buffer(self):
         buffers = self.buffers()
         if buffers:
@@ -120,12 +602,44 @@ class Tmux(object):
         assert buffers
         return buffers[0]
 
-    def capture_pane(self, pane):
+    def capture_pane(self, pane, start=None, end=None):
+        """
+        Return the contents of pane, or only of its lines start to end
+        (inclusive, counting from 0 at the top of the visible screen) if
+        those are given.
+        """
+        arguments = ["-t", pane]
+        if start is not None:
+            arguments.extend(["-S", start])
+        if end is not None:
+            arguments.extend(["-E", end])
+        if tmux_supports(CAPTURE_TO_STDOUT_VERSION):
+            return self.execute_command(*(["capture-pane", "-p"] + arguments))
         buf = self.a_buffer()
-        self.execute_command("capture-pane", "-b", buf, "-t", pane)
+        self.execute_command(*(["capture-pane", "-b", buf] + arguments))
         return self.get_buffer(buf)
 
+    def pane_format(self, pane, format):
+        """
+        Return the tmux format string format (e.g. "#{pane_width}") expanded
+        for the pane with id pane. Formats that this version of tmux does not
+        know about expand to nothing.
+        """
+        if tmux_supports(PRINT_FORMAT_VERSION):
+            return self.execute_command(
+                "display-message", "-p", "-t", pane, format).rstrip("\n")
+        # display-message can't print formats yet, but list-panes can, for
+        # every pane in the window pane is in.
+        for line in self.execute_command(
+            "list-panes", "-t", pane, "-F", "#{pane_id} " + format
+        ).splitlines():
+            pane_id, _, value = line.partition(" ")
+            if pane_id == pane:
+                return value
+        raise CommandFailed("No pane %s" % (pane,))
+
     def shutdown(self):
+        start = time.perf_counter()
         try:
             o = open("/dev/null")
             subprocess.check_call(
@@ -135,7 +649,11 @@ class Tmux(object):
         except subprocess.CalledProcessError:
             pass
         finally:
+            instrument.record_command(["kill-server"], start, "fork")
             o.close()
+            if self.control_client is not None:
+                self.control_client.close()
+                self.control_client = None
 
     @contextmanager
     def temp(self):
@@ -0,0 +1,8 @@
+import sys
+
+pytest_plugins = ["pytester"]
+
+collect_ignore = []
+if sys.version_info < (3, 6):
+    # hecate.aio uses asynchronous generators.
+    collect_ignore.append("test_aio.py")
@@ -0,0 +1,80 @@
+# coding=utf-8
+
+from hecate.aio import AsyncRunner
+from hecate.hecate import AbnormalExit, Timeout
+import asyncio
+import os
+import pytest
+import time
+
+
+AsyncRunner.print_on_exit = True
+
+
+def run_in_loop(coroutine):
+    # asyncio.run needs Python 3.7.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def test_can_run_cat():
+    async def run():
+        async with AsyncRunner("cat") as h:
+            await h.write("☃ hello")
+            await h.press("Enter")
+            await h.await_text("☃ hello")
+            await h.press("C-d")
+            await h.await_exit()
+    run_in_loop(run())
+
+
+def test_reports_abnormal_exit():
+    async def run():
+        async with AsyncRunner("bash", "-c", "exit 3") as h:
+            with pytest.raises(AbnormalExit):
+                await h.await_exit()
+    run_in_loop(run())
+
+
+def test_times_out_waiting_for_text():
+    async def run():
+        async with AsyncRunner("cat", default_timeout=0.1) as h:
+            with pytest.raises(Timeout):
+                await h.await_text("never")
+            await h.press("C-d")
+            await h.await_exit()
+    run_in_loop(run())
+
+
+def test_runs_many_sessions_in_one_loop():
+    async def scenario(i):
+        async with AsyncRunner(
+            "bash", "-c", "sleep 0.5; echo done %d" % (i,),
+            default_timeout=5
+        ) as h:
+            await h.await_text("done %d" % (i,))
+            await h.await_exit()
+            return h.child_pid
+
+    async def run():
+        return await asyncio.gather(*[scenario(i) for i in range(4)])
+
+    start = time.time()
+    pids = run_in_loop(run())
+    assert time.time() - start < 2
+    assert len(set(pids)) == 4
+
+
+def test_cleans_up_after_itself():
+    async def run():
+        async with AsyncRunner("cat") as h:
+            await h.press("C-d")
+            await h.await_exit()
+        return h.report_file
+    report_file = run_in_loop(run())
+    assert not os.path.exists(report_file)
@@ -0,0 +1,147 @@
+# coding=utf-8
+
+from hecate.hecate import Runner, Region, AbnormalExit, InvalidState
+from hecate.backends import PtyBackend
+import os
+import pytest
+import tempfile
+
+
+Runner.print_on_exit = True
+
+
+def test_can_run_cat_on_a_pty():
+    with Runner("cat", backend=PtyBackend) as h:
+        assert h.tmux is None
+        h.write("☃ hello")
+        h.press("Enter")
+        h.await_text("☃ hello")
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_can_run_vim_on_a_pty():
+    f = tempfile.mktemp()
+    # -n, so that a run that fails part way does not leave a swap file behind.
+    with Runner("vim", "-u", "NONE", "-n", backend=PtyBackend) as h:
+        h.await_text("VIM")
+        h.press("i")
+        h.write("Hello world")
+        h.press("Escape")
+        h.write(":w " + f)
+        h.press("Enter")
+        h.write(":q")
+        h.press("Enter")
+        h.await_exit()
+    with open(f) as r:
+        assert "Hello world" in r.read()
+    os.unlink(f)
+
+
+def test_sees_the_last_output_before_exit_on_a_pty():
+    with Runner(
+        "bash", "-c", "echo goodbye; exit 1", backend=PtyBackend
+    ) as h:
+        with pytest.raises(AbnormalExit):
+            h.await_exit()
+        assert "goodbye" in h.screenshot()
+
+
+def test_control_c_interrupts_on_a_pty():
+    with Runner(
+        "bash", "-c", "echo ready; cat", backend=PtyBackend
+    ) as h:
+        h.await_text("ready")
+        h.press("C-c")
+        with pytest.raises(AbnormalExit):
+            h.await_exit()
+
+
+def test_pty_backend_does_not_take_tmux_options():
+    with pytest.raises(TypeError):
+        Runner("cat", backend=PtyBackend, control_mode=True)
+
+
+def test_tracks_screen_changes_on_a_pty():
+    with Runner("cat", height=3, backend=PtyBackend) as h:
+        assert len(h.screen_changes()) == 3
+        h.write("hello")
+        h.await_text("hello")
+        assert h.has_changed()
+        assert h.screen_changes() == [(0, "hello")]
+        assert not h.has_changed()
+        h.press("Enter")
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_can_batch_input_on_a_pty():
+    with Runner("cat", backend=PtyBackend) as h:
+        h.batch().write("hello").press("Enter").press("C-d").send()
+        h.await_exit()
+        assert "hello" in h.screenshot()
+
+
+def test_pty_backend_cannot_share_a_server():
+    with Runner("cat", backend=PtyBackend) as h:
+        with pytest.raises(InvalidState):
+            h.open_window("cat")
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_can_capture_part_of_a_pty():
+    with Runner("cat", backend=PtyBackend) as h:
+        h.write("abc\ndef\n")
+        h.await_text("def", region=Region.rows(1))
+        assert h.capture(Region(0, 2, 1)) == ["bc", "ef"]
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_can_snapshot_a_pty():
+    with Runner("cat", backend=PtyBackend, width=20, height=4) as h:
+        h.write("abc")
+        h.await_text("abc")
+        s = h.snapshot()
+        assert s.row(0) == "abc"
+        assert s.cursor == (3, 0)
+        h.press("Enter")
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_can_resize_a_pty():
+    with Runner("bash", "-c", "trap 'stty size' WINCH; trap 'exit 0' INT; "
+                "echo ready; "
+                "while true; do sleep 0.01; done",
+                backend=PtyBackend, width=20, height=5) as h:
+        h.await_text("ready")
+        h.resize(40, 3)
+        h.await_text("3 40")
+        assert len(h.screenshot().splitlines()) == 3
+        h.press("C-c")
+        h.await_exit()
+
+
+def test_streams_scrollback_on_a_pty():
+    with Runner("bash", "-c", "seq 30; cat", backend=PtyBackend,
+                height=5, history_limit=20) as h:
+        h.await_text("30")
+        # Lines 1 to 6 were pushed out of the history by later ones.
+        assert list(h.scrollback(chunk_size=15)) == [
+            [str(i) for i in range(7, 22)],
+            [str(i) for i in range(22, 27)],
+        ]
+        assert list(h.scrollback()) == []
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_can_stream_input_on_a_pty():
+    lines = ["line %d\n" % i for i in range(5000)]
+    with Runner("bash", "-c", "wc -lc", backend=PtyBackend) as h:
+        h.write_stream(iter(lines), chunk_size=1000)
+        h.press("C-d")
+        h.await_match(r"5000 +%d" % (sum(map(len, lines)),))
+        h.await_exit()
@@ -1,12 +1,20 @@
 # coding=utf-8
 
 import hecate.runner as r
-from hecate.hecate import Runner, AbnormalExit
+from hecate.hecate import (
+    Runner, Region, AbnormalExit, Timeout, InvalidState, must_die,
+    wait_for_death, await_any, await_all
+)
+from hecate.backends import PtyBackend
+from hecate.tmux import TMUX, tmux_supports, DIRECT_LAUNCH_VERSION, \
+    RESIZE_WINDOW_VERSION, SEND_LITERAL_VERSION
 import tempfile
 import pytest
 import sys
 import os
 import signal
+import subprocess
+import time
 
 
 Runner.print_on_exit = True
@@ -100,9 +108,12 @@ PRINTER = os.path.join(
 def test_can_send_signals_to_child():
     with pytest.raises(AbnormalExit):
         with Runner(sys.executable, PRINTER) as h:
+            h.await_text(str(h.child_pid))
             for s in ["SIGTERM", "SIGUSR1", "SIGQUIT"]:
                 h.kill(s)
                 h.await_text(s)
+            h.kill("SIGKILL")
+            h.await_exit()
 
 
 def test_uses_last_screenshot_if_server_goes_away():
@@ -115,3 +126,552 @@ def test_uses_last_screenshot_if_server_goes_away():
         controller = h.report_variables()[r.CONTROLLER]
         os.kill(controller, signal.SIGKILL)
         assert "Hello" in h.screenshot()
+
+
+def test_can_run_in_control_mode():
+    with Runner("cat", control_mode=True) as h:
+        h.write("hello")
+        h.press("Enter")
+        h.await_text("hello")
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_await_text_wakes_on_output_in_control_mode():
+    with Runner(
+        "bash", "-c", "sleep 0.2; echo hello; cat",
+        control_mode=True, wait_interval=1, default_timeout=5
+    ) as h:
+        start = time.time()
+        h.await_text("hello")
+        if h.tmux.control_mode:
+            assert time.time() - start < 0.9
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_cleans_up_report_fifo():
+    with Runner("cat") as h:
+        assert os.path.exists(h.report_file)
+        h.press("C-d")
+        h.await_exit()
+    assert not os.path.exists(h.report_file)
+
+
+def test_shutdown_after_clean_exit_is_fast():
+    h = Runner("cat")
+    try:
+        h.press("C-d")
+        h.await_exit()
+    finally:
+        start = time.time()
+        h.shutdown()
+    assert time.time() - start < 0.5
+
+
+def test_must_die_returns_once_the_process_is_gone():
+    process = subprocess.Popen(["sleep", "10"])
+    start = time.time()
+    must_die(process.pid)
+    assert time.time() - start < 0.5
+    process.wait()
+
+
+def test_does_not_wait_for_a_dead_process_to_be_reaped(monkeypatch):
+    # As before Python 3.9, which has no pidfd_open.
+    monkeypatch.delattr(os, "pidfd_open", raising=False)
+    process = subprocess.Popen(["true"])
+    start = time.time()
+    # Nothing reaps it until we do below.
+    assert wait_for_death(process.pid, 2)
+    assert time.time() - start < 0.5
+    process.wait()
+
+
+@pytest.mark.parametrize("control_mode", [False, True])
+def test_reports_only_the_rows_that_changed(control_mode):
+    with Runner("cat", height=5, control_mode=control_mode) as h:
+        assert h.has_changed()
+        # Older tmux takes a row for the status line.
+        rows = len(h.capture())
+        assert [i for i, _ in h.screen_changes()] == list(range(rows))
+        assert h.screen_changes() == []
+        assert not h.has_changed()
+        h.write("hello")
+        h.press("Enter")
+        h.await_text("hello")
+        assert h.has_changed()
+        h.await_text("hellohello")
+        assert h.screen_changes() == [(0, "hello"), (1, "hello")]
+        assert not h.has_changed()
+        h.press("C-d")
+        h.await_exit()
+
+
+@pytest.mark.parametrize("control_mode", [False, True])
+def test_can_run_vim_with_batched_input(control_mode):
+    f = tempfile.mktemp()
+    # -n, so that a run that fails part way does not leave a swap file behind.
+    with Runner("vim", "-u", "NONE", "-n", control_mode=control_mode) as h:
+        h.await_text("VIM")
+        with h.batch() as b:
+            b.press("i")
+            b.write("Hello world\nGoodbye world")
+            b.press("Escape")
+            b.write(":w " + f)
+            b.press("Enter")
+            b.write(":q")
+            b.press("Enter")
+        h.await_exit()
+    with open(f) as r:
+        assert r.read() == "Hello world\nGoodbye world\n"
+    os.unlink(f)
+
+
+def test_batched_input_keeps_awkward_text_intact():
+    with Runner("cat") as h:
+        h.batch().write("-l; it's").press("Space").write("a\\;").press(
+            "Enter").send()
+        h.await_text("-l; it's a\\;-l; it's a\\;")
+        h.press("C-d")
+        h.await_exit()
+
+
+@pytest.mark.skipif(
+    not tmux_supports(SEND_LITERAL_VERSION),
+    reason="tmux is too old to type text in without a buffer")
+def test_batched_input_uses_one_tmux_process():
+    with Runner("cat") as h:
+        calls = []
+        fork_command = h.tmux.fork_command
+
+        def counting_fork_command(*command):
+            calls.append(command)
+            return fork_command(*command)
+        h.tmux.fork_command = counting_fork_command
+        h.batch().write("one").press("Enter").write("two").press(
+            "Enter").send()
+        assert len(calls) == 1
+        h.await_text("two")
+        h.press("C-d")
+        h.await_exit()
+
+
+@pytest.mark.parametrize("control_mode", [False, True])
+def test_can_run_several_programs_in_one_server(control_mode):
+    with Runner("cat", width=50, height=10, control_mode=control_mode) as h:
+        # Older tmux takes a row for the status line.
+        rows = len(h.capture())
+        other = h.open_window("bash", "-c", "stty size; cat")
+        with other:
+            assert other.tmux is h.tmux
+            other.await_text("%d 50" % (rows,))
+            other.write("to the window\n")
+            h.write("to the first\n")
+            other.await_text("to the window")
+            h.await_text("to the first")
+            assert "to the window" not in h.screenshot()
+            assert "to the first" not in other.screenshot()
+            # The server has to outlive the Runner that started it.
+            h.press("C-d")
+            h.await_exit()
+            h.shutdown()
+            other.press("C-d")
+            other.await_exit()
+    try:
+        sessions = subprocess.check_output(
+            [TMUX, "-L", h.tmux.name, "list-sessions"],
+            stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        # With no server left to ask, which is what we want.
+        sessions = e.output
+    assert "hecate_runner" not in sessions.decode('utf-8')
+
+
+def test_can_split_a_pane():
+    with Runner("cat", width=50, height=10) as h:
+        # Older tmux takes a row for the status line.
+        rows = len(h.capture())
+        with h.split_window("bash", "-c", "stty size; cat",
+                            horizontal=True) as other:
+            other.await_text("%d 24" % (rows,))
+            assert len(h.tmux.panes()) == 2
+            other.focus()
+            other.press("C-d")
+            other.await_exit()
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_cannot_resize_a_shared_server_runner():
+    with Runner("cat") as h:
+        with pytest.raises(TypeError):
+            h.open_window("cat", width=10)
+        h.press("C-d")
+        h.await_exit()
+
+
+@pytest.mark.parametrize("control_mode", [False, True])
+def test_can_wait_for_text_in_a_region(control_mode):
+    with Runner("cat", control_mode=control_mode) as h:
+        h.write("abc\ndef\n")
+        h.await_text("def", region=Region.rows(1))
+        with pytest.raises(Timeout):
+            h.await_text("def", region=Region.rows(0), timeout=0.1)
+        # Text split across two rows is not on either of them.
+        with pytest.raises(Timeout):
+            h.await_text("cd", region=Region(0, 2), timeout=0.1)
+        assert h.capture(Region(0, 2, 1, 2)) == ["b", "e"]
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_can_wait_for_a_regex():
+    with Runner("bash", "-c", "sleep 0.2; echo pid=$$; cat") as h:
+        match = h.await_match(r"pid=(\d+)")
+        assert int(match.group(1)) > 0
+        with pytest.raises(Timeout):
+            h.await_match(r"^pid", region=Region(left=1), timeout=0.1)
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_can_wait_for_a_condition():
+    with Runner("bash", "-c", "seq 3; cat", height=5) as h:
+        rows = h.await_condition(lambda rows: "3" in rows and rows)
+        assert rows[:3] == ["1", "2", "3"]
+        assert h.capture(Region.rows(0, 3)) == ["1", "2", "3"]
+        h.press("C-d")
+        h.await_exit()
+
+
+RESIZE_REPORTER = (
+    "trap 'stty size' WINCH; trap 'exit 0' INT; stty size; "
+    "while true; do sleep 0.01; done"
+)
+
+
+needs_resize = pytest.mark.skipif(
+    not tmux_supports(RESIZE_WINDOW_VERSION),
+    reason="tmux is too old to resize a window with no client")
+
+
+@needs_resize
+@pytest.mark.parametrize("control_mode", [False, True])
+def test_can_resize_the_console(control_mode):
+    with Runner("bash", "-c", RESIZE_REPORTER, width=50, height=10,
+                control_mode=control_mode) as h:
+        h.await_text("10 50")
+        for width, height in [(60, 12), (30, 8)]:
+            h.resize(width, height)
+            h.await_text("%d %d" % (height, width))
+            s = h.snapshot()
+            assert (s.width, s.height) == (width, height)
+        h.press("C-c")
+        h.await_exit()
+
+
+@needs_resize
+def test_can_resize_a_split_pane():
+    with Runner("cat", width=50, height=20) as h:
+        with h.split_window("bash", "-c", RESIZE_REPORTER) as other:
+            other.await_text(" 50")
+            other.resize(50, 5)
+            other.await_text("5 50")
+            other.press("C-c")
+            other.await_exit()
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_streams_scrollback():
+    with Runner("bash", "-c", "seq 100; cat", height=10) as h:
+        h.await_text("100")
+        # The cursor's line is on the screen below 100. Older tmux takes a
+        # row for the status line.
+        scrolled = 101 - len(h.capture())
+        chunks = list(h.scrollback(chunk_size=40))
+        assert [len(c) for c in chunks] == [40, 40, scrolled - 80]
+        assert sum(chunks, []) == [str(i) for i in range(1, scrolled + 1)]
+        assert list(h.scrollback()) == []
+        h.write("more\n")
+        h.await_text("moremore")
+        # Two lines of "more" and the cursor's line push two more off.
+        assert sum(h.scrollback(), []) == [
+            str(scrolled + 1), str(scrolled + 2)]
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_finds_its_place_after_history_is_trimmed():
+    with Runner("bash", "-c", "seq 50; read; seq 1000 1300; cat", height=5,
+                history_limit=100) as h:
+        h.await_text("50")
+        # The cursor's line is on the screen below the last number. Older
+        # tmux takes a row for the status line.
+        rows = len(h.capture())
+        assert sum(h.scrollback(), [])[-1] == str(51 - rows)
+        # Far more than the history limit, so tmux throws away old lines,
+        # including the ones we read last.
+        h.press("Enter")
+        h.await_text("1300")
+        lines = sum(h.scrollback(), [])
+        assert lines[-1] == str(1301 - rows)
+        assert lines == [str(i) for i in range(int(lines[0]), 1302 - rows)]
+        h.press("C-d")
+        h.await_exit()
+
+
+needs_direct_launch = pytest.mark.skipif(
+    not tmux_supports(DIRECT_LAUNCH_VERSION),
+    reason="tmux is too old to report on commands itself")
+
+
+@needs_direct_launch
+def test_runs_the_command_directly_if_asked():
+    with Runner("bash", "-c", "echo pid $$; cat", controller=False) as h:
+        assert h.direct
+        assert h.report_file is None
+        h.await_text("pid %d" % (h.child_pid,))
+        h.press("C-d")
+        h.await_exit()
+
+
+@needs_direct_launch
+def test_gets_exit_status_from_tmux():
+    with Runner("bash", "-c", "exit 3", controller=False) as h:
+        with pytest.raises(AbnormalExit) as e:
+            h.await_exit()
+    assert "status %d" % (3 << 8,) in str(e.value)
+    with Runner("bash", "-c", "kill -TERM $$", controller=False) as h:
+        with pytest.raises(AbnormalExit) as e:
+            h.await_exit()
+    assert "status %d" % (signal.SIGTERM,) in str(e.value)
+
+
+@needs_direct_launch
+def test_keeps_the_screen_a_direct_command_left():
+    with Runner(
+        "printf", "a\\nb\\nc", width=10, height=3, controller=False
+    ) as h:
+        h.await_exit()
+        assert h.screenshot() == "a\nb\nc\n"
+
+
+@needs_direct_launch
+def test_keeps_what_a_direct_command_wrote_just_before_exiting():
+    with Runner(
+        "bash", "-c", "seq 300000; echo END", height=5, controller=False
+    ) as h:
+        h.await_exit()
+        assert "END" in h.screenshot()
+
+
+@needs_direct_launch
+def test_sees_what_a_direct_command_wrote_just_before_exiting():
+    # tmux does not tell control mode clients about it.
+    with Runner(
+        "bash", "-c", "sleep 0.2; echo hello", control_mode=True,
+        controller=False
+    ) as h:
+        h.await_text("hello")
+        h.await_exit()
+    with Runner(
+        "bash", "-c", "sleep 0.2; echo hello", control_mode=True,
+        controller=False
+    ) as h:
+        await_any(h.when_text("hello"))
+        h.await_exit()
+
+
+@needs_direct_launch
+def test_a_direct_command_can_close_its_terminal_before_exiting():
+    with Runner(
+        sys.executable, "-c",
+        "import os, time\n"
+        "for fd in range(3):\n"
+        "    os.close(fd)\n"
+        "time.sleep(0.2)\n",
+        controller=False
+    ) as h:
+        h.await_exit()
+
+
+def test_uses_the_controller_by_default():
+    with Runner("cat") as h:
+        assert not h.direct
+        assert h.report_variables()[r.CHILD] == h.child_pid
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_recording_needs_the_controller(tmpdir):
+    with pytest.raises(ValueError):
+        Runner("cat", record=str(tmpdir.join("rec")), controller=False)
+
+
+def test_direct_launch_needs_a_backend_that_supports_it():
+    with pytest.raises(ValueError):
+        Runner("cat", backend=PtyBackend, controller=False)
+
+
+@pytest.mark.parametrize("control_mode", [False, True])
+def test_await_any_returns_the_first_condition_met(control_mode):
+    with Runner("cat", control_mode=control_mode) as server:
+        with Runner("cat", control_mode=control_mode) as client:
+            client.write("ready\n")
+            met = await_any(
+                server.when_text("ready"), client.when_text("ready"),
+                client.when_exit(),
+            )
+            assert met.runner is client
+            assert met.description == "text 'ready' to appear"
+            client.press("C-d")
+            met = await_any(server.when_exit(), client.when_exit())
+            assert met.runner is client
+            assert met.value == 0
+            assert client.exit_seen
+            server.press("C-d")
+            server.await_exit()
+
+
+def test_await_all_returns_every_value():
+    with Runner("cat") as h:
+        with Runner("bash", "-c", "exit 3") as other:
+            h.write("hello world\n")
+            match, status = await_all(
+                h.when_match(r"w\w+"), other.when_exit())
+            assert match.group(0) == "world"
+            assert status == 3 << 8
+            h.press("C-d")
+            h.await_exit()
+
+
+def test_await_all_can_wait_on_one_runner_several_times():
+    with Runner("cat") as h:
+        h.write("one\ntwo\n")
+        assert await_all(
+            h.when_text("one"),
+            h.when(lambda rows: "two" in rows, description="two"),
+        ) == [None, True]
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_await_any_times_out_with_what_it_was_waiting_for():
+    with Runner("cat") as h:
+        with Runner("cat") as other:
+            with pytest.raises(Timeout) as e:
+                await_any(
+                    h.when_text("never"), other.when_exit(), timeout=0.2)
+            assert "'never'" in str(e.value)
+            assert "process to exit" in str(e.value)
+            for runner in (h, other):
+                runner.press("C-d")
+                runner.await_exit()
+
+
+@pytest.mark.parametrize("controller", [
+    pytest.param(False, marks=needs_direct_launch), True])
+def test_can_restart_the_command(controller):
+    with Runner(
+        "bash", "-c", "seq 20; echo $$; cat", height=5, controller=controller
+    ) as h:
+        h.await_text("20")
+        first = h.child_pid
+        h.press("C-d")
+        h.await_exit()
+        h.restart()
+        assert not h.exit_seen
+        assert h.child_pid != first
+        h.await_text("20")
+        assert str(h.child_pid) in h.screenshot()
+        # Below 20 are the pid and the cursor's line. Older tmux takes a row
+        # for the status line.
+        scrolled = 22 - len(h.capture())
+        assert [l for c in h.scrollback() for l in c] == [
+            str(i) for i in range(1, scrolled + 1)]
+        h.write("hello\n")
+        h.await_text("hellohello")
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_restart_kills_a_command_that_is_still_running():
+    with Runner("cat") as h:
+        first = h.child_pid
+        h.restart()
+        assert wait_for_death(first, 1)
+        h.write("hi\n")
+        h.await_text("hihi")
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_can_restart_long_after_the_command_exits():
+    with Runner("bash", "-c", "echo go; cat") as h:
+        h.await_text("go")
+        h.press("C-d")
+        h.await_exit()
+        # Longer than hecate ever waits on the controller.
+        time.sleep(r.RELEASE_TIMEOUT + 0.5)
+        h.restart()
+        h.await_text("go")
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_cannot_restart_after_shutdown():
+    h = Runner("cat")
+    h.press("C-d")
+    h.await_exit()
+    h.shutdown()
+    with pytest.raises(InvalidState):
+        h.restart()
+
+
+@pytest.mark.parametrize("control_mode", [False, True])
+def test_can_stream_a_lot_of_input(control_mode):
+    lines = ["line %d\n" % i for i in range(20000)]
+    # Without echo, as drawing all of that again just before wc exits is the
+    # sort of thing tmux can lose the end of.
+    with Runner(
+        "bash", "-c", "stty -echo; wc -lc", control_mode=control_mode
+    ) as h:
+        h.write_stream(iter(lines))
+        h.press("C-d")
+        h.await_match(r"20000 +%d" % (sum(map(len, lines)),))
+        h.await_exit()
+
+
+def test_streaming_waits_for_a_slow_reader(tmpdir):
+    f = tmpdir.join("data")
+    f.write_binary(b"".join(("%d\n" % i).encode() for i in range(2000)))
+    with Runner(
+        sys.executable, "-c",
+        "import sys, time\n"
+        "for line in sys.stdin:\n"
+        "    time.sleep(0.0001)\n"
+        "    if line == '1999\\n': print('finished')\n",
+        default_timeout=5,
+    ) as h:
+        with open(str(f), "rb") as i:
+            h.write_stream(i, chunk_size=1000)
+        h.await_text("finished")
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_streaming_times_out_if_nothing_reads():
+    with Runner("sleep", "0.5") as h:
+        with pytest.raises(Timeout):
+            h.write_stream("x\n" * 100, chunk_size=10, timeout=0.1)
+        assert h.backend.unread_input() == 10
+        h.await_exit()
+
+
+def test_streaming_stops_when_the_command_exits():
+    with Runner("head", "-n", "1") as h:
+        h.write_stream(("%d\n" % i for i in range(100000)), chunk_size=100)
+        h.await_exit()
+        assert "99999" not in h.screenshot()
@@ -0,0 +1,76 @@
+from hecate.hecate import Runner, Timeout
+from hecate import instrument
+from hecate.tmux import Tmux
+import binascii
+import os
+import pytest
+import threading
+
+
+def test_collects_tmux_commands_and_runner_operations():
+    with instrument.collect() as stats:
+        with Runner("cat") as h:
+            h.write("hello\n")
+            h.await_text("hello")
+            h.press("C-d")
+            h.await_exit()
+    summary = stats.summary()
+    assert summary["commands"]["capture-pane"]["count"] >= 1
+    assert summary["commands"]["send-keys"]["count"] == 1
+    operations = summary["operations"]
+    for name in ["startup", "write", "await_text", "press", "await_exit",
+                 "shutdown"]:
+        assert operations[name]["count"] == 1
+    assert operations["await_text"]["screenshots"] >= 1
+    assert "await_text" in stats.report()
+
+
+def test_counts_polls_while_waiting():
+    with Runner("cat", default_timeout=0.2) as h:
+        with instrument.collect() as stats:
+            with pytest.raises(Timeout):
+                h.await_text("never")
+        h.press("C-d")
+        h.await_exit()
+    await_text = stats.summary()["operations"]["await_text"]
+    assert await_text["polls"] >= 2
+    assert await_text["screenshots"] == await_text["polls"]
+
+
+def test_records_argv_and_how_commands_were_sent():
+    mux = Tmux(binascii.hexlify(os.urandom(8)).decode('ascii'))
+    try:
+        with instrument.collect() as stats:
+            mux.execute_commands([["list-sessions"], ["list-windows"]])
+    finally:
+        mux.shutdown()
+    event, = stats.events
+    assert event.kind == instrument.COMMAND
+    assert event.argv == ["list-sessions", ";", "list-windows"]
+    assert event.via == "fork"
+    assert event.duration > 0
+
+
+def test_stops_listening_after_collect():
+    with instrument.collect() as stats:
+        pass
+    assert not instrument.enabled()
+    with Runner("cat") as h:
+        h.press("C-d")
+        h.await_exit()
+    assert stats.events == []
+
+
+def test_events_say_which_thread_they_happened_in():
+    events = []
+    instrument.add_listener(events.append)
+    try:
+        instrument.record_command(["here"], 0, "fork")
+        elsewhere = threading.Thread(
+            target=instrument.record_command, args=(["there"], 0, "fork"))
+        elsewhere.start()
+        elsewhere.join()
+    finally:
+        instrument.remove_listener(events.append)
+    assert [e.thread for e in events] == [
+        threading.get_ident(), elsewhere.ident]
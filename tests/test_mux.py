@@ -1,7 +1,8 @@
 import os
 import pytest
 import binascii
-from hecate.tmux import Tmux, DeadServer
+from hecate.tmux import Tmux, DeadServer, CommandFailed, tmux_supports, \
+    CAPTURE_TO_STDOUT_VERSION
 import time
 
 muxes = []
@@ -12,8 +13,8 @@ def teardown_function(fn):
         muxes.pop().shutdown()
 
 
-def newmux():
-    mux = Tmux(binascii.hexlify(os.urandom(8)))
+def newmux(control_mode=False):
+    mux = Tmux(binascii.hexlify(os.urandom(8)), control_mode=control_mode)
     muxes.append(mux)
     return mux
 
@@ -77,6 +78,30 @@ def test_can_capture_a_pane():
     assert len(pane_contents.split("\n")) == 50
 
 
+def test_can_expand_formats_for_one_of_several_panes():
+    mux = newmux()
+    mux.new_session(width=40, height=10, command="cat", name="formats")
+    mux.execute_command("split-window", "-h", "-t", "formats", "cat")
+    panes = mux.execute_command(
+        "list-panes", "-t", "formats", "-F", "#{pane_id}").split()
+    assert len(panes) == 2
+    widths = []
+    for pane in panes:
+        assert mux.pane_format(pane, "#{pane_id}") == pane
+        widths.append(int(mux.pane_format(pane, "#{pane_width}")))
+    assert sum(widths) == 39
+
+
+def test_capturing_a_pane_does_not_use_buffers_when_supported():
+    mux = newmux()
+    pane = mux.panes()[0]
+    mux.capture_pane(pane)
+    if tmux_supports(CAPTURE_TO_STDOUT_VERSION):
+        assert not mux.buffers()
+    else:
+        assert mux.buffers()
+
+
 def test_can_send_content_to_the_screen():
     mux = newmux()
     pane = mux.panes()[0]
@@ -96,3 +121,59 @@ def test_can_detect_when_server_dies():
     mux.kill_session(mux.sessions()[0])
     with pytest.raises(DeadServer):
         mux.sessions()
+
+
+def test_control_mode_runs_commands_without_forking():
+    mux = newmux(control_mode=True)
+    mux.new_session(name="kittenbob")
+    assert "kittenbob" in mux.sessions()
+    if mux.control_mode:
+        assert mux.control_client is not None
+        assert mux.control_client.alive()
+
+
+def test_control_mode_quotes_arguments():
+    mux = newmux(control_mode=True)
+    data = "it's $HOME ~ #{a} \\ \"quoted\""
+    b = mux.a_buffer()
+    mux.set_buffer(b, data)
+    assert mux.get_buffer(b) == data
+
+
+def test_control_mode_reports_failed_commands():
+    mux = newmux(control_mode=True)
+    with pytest.raises(CommandFailed):
+        mux.execute_command("kill-session", "-t", "nosuchsession")
+    assert mux.sessions()
+
+
+def environment(mux):
+    return mux.execute_command("show-environment", "-g").splitlines()
+
+
+@pytest.mark.parametrize("control_mode", [False, True])
+def test_can_execute_several_commands_at_once(control_mode):
+    mux = newmux(control_mode=control_mode)
+    mux.execute_commands([
+        ["set-environment", "-g", "FIRST", "a;"],
+        ["set-environment", "-g", "SECOND", "b"],
+    ])
+    assert "FIRST=a;" in environment(mux)
+    assert "SECOND=b" in environment(mux)
+    with pytest.raises(CommandFailed):
+        mux.execute_commands([
+            ["kill-session", "-t", "nosuchsession"],
+            ["list-sessions"],
+        ])
+    assert mux.sessions()
+
+
+def test_splits_batches_too_long_for_one_client():
+    mux = newmux()
+    mux.execute_commands([
+        ["set-environment", "-g", "V%d" % (i,), "x" * 100]
+        for i in range(300)
+    ])
+    variables = environment(mux)
+    assert "V0=" + "x" * 100 in variables
+    assert "V299=" + "x" * 100 in variables
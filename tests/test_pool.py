@@ -0,0 +1,251 @@
+from hecate.pool import RunnerPool, Scenario, WarmUp
+from hecate.hecate import Runner, AbnormalExit, Timeout, HecateWillHauntYou
+from hecate.tmux import tmux_supports, RESIZE_WINDOW_VERSION, \
+    DIRECT_LAUNCH_VERSION
+import gc
+import pytest
+import time
+import warnings
+
+
+def test_pool_keeps_servers_ready():
+    with RunnerPool(size=2) as pool:
+        start = time.time()
+        while time.time() < start + 5:
+            if len(pool.idle.get(pool.default_key, ())) == 2:
+                break
+            time.sleep(0.01)
+        assert len(pool.idle[pool.default_key]) == 2
+
+
+def test_can_run_a_command_from_a_pool():
+    with RunnerPool(size=1) as pool:
+        with pool.runner("cat") as h:
+            h.write("hello")
+            h.press("Enter")
+            h.await_text("hello")
+            h.press("C-d")
+            h.await_exit()
+
+
+def test_recycles_servers_with_a_clean_screen():
+    # The background filler only prepares the pool's own geometry, so using a
+    # different one means we know exactly which server we get back.
+    with RunnerPool(size=1) as pool:
+        with pool.runner("bash", "-c", "echo first; cat", width=33) as h:
+            h.await_text("first")
+            name = h.tmux.name
+            h.press("C-d")
+            h.await_exit()
+        with pool.runner("cat", width=33) as h:
+            assert h.tmux.name == name
+            assert "first" not in h.screenshot()
+            h.press("C-d")
+            h.await_exit()
+
+
+def rows_of(width, height):
+    # Older tmux takes a row for the status line, so this is how many rows a
+    # Runner of a given size really gets.
+    with Runner("cat", width=width, height=height) as h:
+        rows = len(h.capture())
+        h.press("C-d")
+        h.await_exit()
+    return rows
+
+
+def test_uses_requested_geometry():
+    with RunnerPool(size=1, width=10, height=5) as pool:
+        with pool.runner("cat") as h:
+            assert len(h.screenshot().splitlines()) == rows_of(10, 5)
+            h.write("." * 20)
+            h.await_text("." * 20)
+            assert "." * 10 + "\n" + "." * 10 in h.screenshot()
+            h.press("Enter")
+            h.press("C-d")
+            h.await_exit()
+        with pool.runner("cat", width=20, height=3) as h:
+            assert len(h.screenshot().splitlines()) == rows_of(20, 3)
+            h.press("C-d")
+            h.await_exit()
+
+
+def test_reports_abnormal_exit_from_pool():
+    with RunnerPool(size=1) as pool:
+        with pytest.raises(AbnormalExit):
+            with pool.runner("cat", "/does/not/exist/no/really"):
+                pass
+        with pool.runner("cat") as h:
+            h.press("C-d")
+            h.await_exit()
+
+
+def echo_and_exit(h):
+    h.write("hello")
+    h.press("Enter")
+    h.await_text("hello")
+    h.press("C-d")
+    h.await_exit()
+    return h.tmux.name
+
+
+def never_finds_it(h):
+    h.await_text("not going to happen", timeout=0.1)
+
+
+def test_runs_scenarios_concurrently():
+    with RunnerPool(size=2) as pool:
+        results = pool.run_all([
+            Scenario(echo_and_exit, "cat"),
+            Scenario(never_finds_it, "cat"),
+            Scenario(echo_and_exit, "cat", width=20),
+            Scenario(echo_and_exit, "cat", "/does/not/exist/no/really"),
+        ], max_workers=4)
+    assert [r.succeeded for r in results] == [True, False, True, False]
+    assert isinstance(results[1].exception, Timeout)
+    assert isinstance(results[3].exception, AbnormalExit)
+    assert results[0].value != results[2].value
+    assert "hello" in results[0].screenshot
+
+
+def test_does_not_recycle_shared_servers():
+    with RunnerPool(size=1) as pool:
+        with pool.runner("cat", width=33) as h:
+            name = h.tmux.name
+            with h.split_window("cat") as other:
+                other.press("C-d")
+                other.await_exit()
+            h.press("C-d")
+            h.await_exit()
+        with pool.runner("cat", width=33) as h:
+            assert h.tmux.name != name
+            h.press("C-d")
+            h.await_exit()
+
+
+@pytest.mark.skipif(
+    not tmux_supports(RESIZE_WINDOW_VERSION),
+    reason="tmux is too old to resize a window with no client")
+def test_does_not_recycle_resized_servers():
+    with RunnerPool(size=2, width=33, height=7) as pool:
+        with pool.runner("cat") as h:
+            h.resize(60, 12)
+            assert h.backend.server.shared
+            h.press("C-d")
+            h.await_exit()
+        with pool.runner("cat") as h:
+            s = h.snapshot()
+            assert (s.width, s.height) == (33, 7)
+            h.press("C-d")
+            h.await_exit()
+
+
+def is_piped(runner):
+    return runner.tmux.pane_format(runner.backend.pane, "#{pane_pipe}")
+
+
+@pytest.mark.skipif(
+    not tmux_supports(DIRECT_LAUNCH_VERSION),
+    reason="tmux is too old to report on commands itself")
+def test_only_sets_up_servers_for_direct_launch_when_asked():
+    with RunnerPool(size=1) as pool:
+        for _ in range(2):
+            with pool.runner("cat", controller=False) as h:
+                assert h.direct
+                assert is_piped(h) == "1"
+                h.press("C-d")
+                h.await_exit()
+            with pool.runner("cat") as h:
+                assert is_piped(h) == "0"
+                h.press("C-d")
+                h.await_exit()
+
+
+SLOW_START = WarmUp(
+    "bash", "-c", "sleep 0.3; echo ready; cat",
+    steps=[("await_text", "ready"), ("write", "hello\n"),
+           ("await_text", "hello")],
+)
+
+
+def await_spare(pool, warm_up):
+    start = time.time()
+    while time.time() < start + 5:
+        with pool.changed:
+            stock = pool.warm.get(warm_up.identity())
+            if stock is not None and stock.runners:
+                return stock.runners[0][0]
+        time.sleep(0.01)
+    assert False, "No spare was warmed up"
+
+
+def test_hands_out_warmed_runners():
+    with RunnerPool(size=1) as pool:
+        with pool.warmed(SLOW_START) as h:
+            assert "hello" in h.screenshot()
+            h.press("C-d")
+            h.await_exit()
+        spare = await_spare(pool, SLOW_START)
+        start = time.time()
+        with pool.warmed(SLOW_START) as h:
+            assert h is spare
+            assert time.time() < start + 0.3
+            assert "hello" in h.screenshot()
+            h.press("C-d")
+            h.await_exit()
+
+
+def test_throws_away_runners_warmed_in_another_environment(monkeypatch):
+    with RunnerPool(size=1) as pool:
+        with pool.warmed(SLOW_START) as h:
+            h.press("C-d")
+            h.await_exit()
+        spare = await_spare(pool, SLOW_START)
+        monkeypatch.setenv("HECATE_WARM_UP_TEST", "changed")
+        with pool.warmed(SLOW_START) as h:
+            assert h is not spare
+            assert spare.shutdown_called
+            h.press("C-d")
+            h.await_exit()
+
+
+def test_evicts_the_least_recently_used_warm_up():
+    other = WarmUp("cat")
+    with RunnerPool(size=1, max_warm_ups=1) as pool:
+        with pool.warmed(SLOW_START) as h:
+            h.press("C-d")
+            h.await_exit()
+        spare = await_spare(pool, SLOW_START)
+        with pool.warmed(other) as h:
+            assert spare.shutdown_called
+            assert list(pool.warm) == [other.identity()]
+            h.press("C-d")
+            h.await_exit()
+
+
+def test_cleans_up_a_warm_up_whose_command_exits():
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter("always")
+        with RunnerPool(size=1) as pool:
+            with pytest.raises(Timeout):
+                pool.warmed(WarmUp(
+                    "bash", "-c", "echo oops",
+                    steps=[("await_text", "ready")], default_timeout=0.3,
+                ))
+        gc.collect()
+    assert not [x for x in w if x.category is HecateWillHauntYou]
+
+
+def test_rejects_unknown_warm_up_actions():
+    with pytest.raises(ValueError):
+        WarmUp("cat", steps=[("shutdown", None)])
+
+
+def test_can_restart_a_runner_from_a_pool():
+    with RunnerPool(size=1) as pool:
+        with pool.runner("bash", "-c", "exit 1") as h:
+            with pytest.raises(AbnormalExit):
+                h.await_exit()
+            h.restart()
+            with pytest.raises(AbnormalExit):
+                h.await_exit()
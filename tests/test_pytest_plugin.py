@@ -0,0 +1,106 @@
+from hecate.tmux import server_names
+import pytest
+
+
+@pytest.fixture
+def run_with_plugin(pytester, monkeypatch):
+    # Load the plugin explicitly, whether or not hecate has been installed in
+    # a way that registers it.
+    monkeypatch.setenv("PYTEST_DISABLE_PLUGIN_AUTOLOAD", "1")
+
+    def run(*args):
+        return pytester.runpytest_subprocess(
+            "-p", "hecate.pytest_plugin", *args)
+    return run
+
+
+def test_runner_fixture_cleans_up(pytester, run_with_plugin):
+    pytester.makepyfile("""
+        import warnings
+        from hecate.hecate import HecateWillHauntYou
+
+        def test_finishes(runner):
+            h = runner("cat")
+            h.write("hello\\n")
+            h.await_text("hello")
+            h.press("C-d")
+            h.await_exit()
+
+        def test_leaves_it_running(runner):
+            runner("cat").await_text("")
+
+        def test_fails(runner):
+            runner("cat")
+            assert False
+
+        def test_no_haunting():
+            import gc
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter("always")
+                gc.collect()
+            assert not [x for x in w if x.category is HecateWillHauntYou]
+    """)
+    result = run_with_plugin()
+    result.assert_outcomes(passed=3, failed=1)
+    result.stdout.fnmatch_lines([
+        "*slowest 3 hecate tests*",
+        "*1 runners*test_finishes*",
+    ])
+    assert not [n for n in server_names() if n.startswith("hecate-main-")]
+
+
+def test_can_turn_off_timings(pytester, run_with_plugin):
+    pytester.makepyfile("""
+        def test_cat(runner):
+            h = runner("cat")
+            h.press("C-d")
+            h.await_exit()
+    """)
+    result = run_with_plugin("--hecate-timings=0", "--hecate-pool-size=1")
+    result.assert_outcomes(passed=1)
+    assert "hecate tests" not in result.stdout.str()
+
+
+def test_timings_leave_out_other_threads(pytester, run_with_plugin):
+    pytester.makepyfile("""
+        import threading
+        from hecate import instrument
+
+        def busy():
+            for _ in range(500):
+                instrument.record_command(["elsewhere"], 0, "fork")
+
+        def test_cat(runner):
+            h = runner("cat")
+            elsewhere = threading.Thread(target=busy)
+            elsewhere.start()
+            elsewhere.join()
+            h.press("C-d")
+            h.await_exit()
+    """)
+    result = run_with_plugin()
+    result.assert_outcomes(passed=1)
+    line, = [
+        l for l in result.stdout.lines if "tmux commands  " in l]
+    assert int(line.split()[3]) < 500
+
+
+def test_runner_fixture_cleans_up_exited_commands(pytester, run_with_plugin):
+    pytester.makepyfile("""
+        import gc
+        import warnings
+        from hecate.hecate import HecateWillHauntYou
+
+        def test_exits_by_itself(runner):
+            h = runner("echo", "hi")
+            h.await_text("hi")
+            runner("cat")
+
+        def test_no_haunting():
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter("always")
+                gc.collect()
+            assert not [x for x in w if x.category is HecateWillHauntYou]
+    """)
+    result = run_with_plugin()
+    result.assert_outcomes(passed=2)
@@ -0,0 +1,70 @@
+from hecate.hecate import Runner
+from hecate.backends import PtyBackend, TmuxBackend
+from hecate.recording import Recording
+from hecate.tmux import tmux_version, BROKEN_PIPE_PANE_VERSION
+import pytest
+import tempfile
+import time
+
+
+needs_pipe_pane = pytest.mark.skipif(
+    tmux_version() == BROKEN_PIPE_PANE_VERSION,
+    reason="This version of tmux can't pipe a pane's output")
+
+
+@pytest.fixture
+def recording_path():
+    with tempfile.NamedTemporaryFile() as f:
+        yield f.name
+
+
+@pytest.mark.parametrize("backend", [
+    pytest.param(TmuxBackend, marks=needs_pipe_pane), PtyBackend])
+def test_can_replay_what_a_program_drew(recording_path, backend):
+    with Runner(
+        "bash", "-c", "echo first; sleep 0.3; clear; echo second; cat",
+        width=40, height=10, record=recording_path, backend=backend
+    ) as h:
+        h.await_text("second")
+        # Older tmux takes a row for the status line.
+        height = len(h.capture())
+        h.press("C-d")
+        h.await_exit()
+    recording = Recording(recording_path)
+    assert recording.finished
+    assert (recording.width, recording.height) == (40, height)
+    assert height in (9, 10)
+    assert recording.duration >= 0.3
+    early = recording.text_at(0.1)
+    assert "first" in early
+    assert "second" not in early
+    final = recording.text_at()
+    assert "first" not in final
+    assert "second" in final
+    frames = list(recording.frames())
+    assert frames[-1] == (recording.duration, final)
+
+
+@needs_pipe_pane
+def test_replays_an_unfinished_recording(recording_path):
+    with Runner("cat", record=recording_path) as h:
+        h.write("hello\n")
+        h.await_text("hello")
+        # The recorder gets output a little after tmux does.
+        deadline = time.time() + 1
+        while True:
+            recording = Recording(recording_path)
+            if "hello" in recording.text_at() or time.time() > deadline:
+                break
+            time.sleep(0.01)
+        assert not recording.finished
+        assert "hello" in recording.text_at()
+        h.press("C-d")
+        h.await_exit()
+
+
+def test_rejects_files_that_are_not_recordings(recording_path):
+    with open(recording_path, "w") as o:
+        o.write("hello world\n")
+    with pytest.raises(ValueError):
+        Recording(recording_path)
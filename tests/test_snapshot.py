@@ -0,0 +1,81 @@
+# coding=utf-8
+
+from hecate.hecate import Runner, Region
+from hecate.snapshot import Snapshot, Attributes
+from hecate.tmux import tmux_supports, CAPTURE_TO_STDOUT_VERSION
+import pytest
+import sys
+
+
+CAPTURED = (
+    "\x1b[1m\x1b[31mred\x1b[0m plain \x1b[38;5;200;48;2;1;2;3mx\x1b[39m"
+    "\x1b[49m \x0elqk\x0f 中文 \x1b[4;7mU\n"
+    "still underlined\x1b[0m\n"
+)
+
+
+def test_parses_text_and_attributes():
+    s = Snapshot.parse(CAPTURED, 30, 3, (0, 2))
+    assert s.row(0) == "red plain x ┌─┐ 中文 U"
+    assert s.row(1) == "still underlined"
+    assert s.text() == s.row(0) + "\n" + s.row(1) + "\n\n"
+    assert s.attributes_at(0, 0).matches(fg=1, bold=True)
+    assert s.attributes_at(3, 0) == Attributes()
+    x = s.attributes_at(10, 0)
+    assert (x.fg, x.bg) == (200, (1, 2, 3))
+    assert s.attributes_at(0, 1).matches(underline=True, reverse=True)
+    assert s.cursor == (0, 2)
+
+
+def test_handles_wide_characters():
+    s = Snapshot.parse(CAPTURED, 30, 3)
+    x, y = s.find("文")
+    assert (x, y) == (18, 0)
+    assert s.char(17, 0) == ""
+    assert s.find("U") == (21, 0)
+
+
+def test_finds_text_by_style():
+    s = Snapshot.parse("red \x1b[31mred\x1b[0m\n", 10, 1)
+    assert s.find("red") == (0, 0)
+    assert s.find("red", fg=1) == (4, 0)
+    assert s.find("red", bold=True) is None
+
+
+def test_splits_rows_into_runs():
+    s = Snapshot.parse("ab\x1b[1mcd\x1b[0mef  \n", 10, 1)
+    assert [(x, t) for x, t, _ in s.runs(0)] == [(0, "ab"), (2, "cd"),
+                                                   (4, "ef")]
+    assert s.runs(0)[1][2].bold
+
+
+def test_plain_screens_do_not_store_attributes():
+    s = Snapshot.parse("hello\n", 80, 24)
+    assert s.attributes is None
+    assert sys.getsizeof(s.chars) < 80 * 24 * 5
+
+
+def test_can_take_rows_of_a_region():
+    s = Snapshot.parse("abc\ndef\nghi\n", 3, 3)
+    assert s.rows(Region(1, None, 1, 2)) == ["e", "h"]
+
+
+@pytest.mark.parametrize("control_mode", [False, True])
+def test_can_snapshot_a_runner(control_mode):
+    with Runner(
+        "bash", "-c", "printf 'a \\033[1;32mgreen\\033[0m b'; cat",
+        width=30, height=5, control_mode=control_mode
+    ) as h:
+        h.await_text("b")
+        s = h.snapshot()
+        # Older tmux takes a row for the status line.
+        assert (s.width, s.height) == (30, len(h.capture()))
+        assert s.height in (4, 5)
+        if tmux_supports(CAPTURE_TO_STDOUT_VERSION):
+            assert s.cursor == (len("a green b"), 0)
+            assert s.find("green", fg=2, bold=True) == (2, 0)
+        else:
+            assert s.cursor is None
+            assert s.find("green") == (2, 0)
+        h.press("C-d")
+        h.await_exit()
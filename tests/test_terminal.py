@@ -0,0 +1,96 @@
+# coding=utf-8
+
+from hecate.terminal import Screen, encode_key
+
+
+def screen_after(data, width=10, height=3):
+    screen = Screen(width, height)
+    screen.feed(data.encode('utf-8'))
+    return screen
+
+
+def test_wraps_at_the_end_of_a_line():
+    screen = screen_after("0123456789abc")
+    assert screen.display() == ["0123456789", "abc", ""]
+
+
+def test_text_is_formatted_like_capture_pane():
+    assert screen_after("hi\r\nthere").text() == "hi\nthere\n\n"
+
+
+def test_scrolls_when_writing_past_the_bottom():
+    screen = screen_after("a\r\nb\r\nc\r\nd")
+    assert screen.display() == ["b", "c", "d"]
+
+
+def test_moves_the_cursor_and_erases():
+    screen = screen_after("hello\x1b[1;3H\x1b[Kx\x1b[3;1Hbottom")
+    assert screen.display() == ["hex", "", "bottom"]
+
+
+def test_clears_the_screen():
+    screen = screen_after("hello\r\nworld\x1b[H\x1b[2J!")
+    assert screen.display() == ["!", "", ""]
+
+
+def test_scrolls_within_a_region():
+    screen = screen_after("top\x1b[2;3r\x1b[2;1Ha\r\nb\r\nc", height=4)
+    assert screen.display() == ["top", "b", "c", ""]
+
+
+def test_restores_the_screen_after_the_alternate_screen():
+    screen = screen_after("main\x1b[?1049h\x1b[Halternate")
+    assert screen.display()[0] == "alternate"
+    screen.feed(b"\x1b[?1049l")
+    assert screen.display()[0] == "main"
+
+
+def test_draws_lines_with_the_special_graphics_set():
+    screen = screen_after("\x1b(0lqk\x1b(B")
+    assert screen.display()[0] == "┌─┐"
+
+
+def test_wide_characters_take_two_cells():
+    screen = screen_after("日本語です")
+    assert screen.display() == ["日本語です", "", ""]
+    screen.feed("\x1b[1;3Hx".encode('utf-8'))
+    assert screen.display()[0] == "日x 語です"
+
+
+def test_answers_cursor_position_requests():
+    screen = Screen(10, 3)
+    assert screen.feed(b"ab\r\nc\x1b[6n") == b"\x1b[2;2R"
+
+
+def test_ignores_sequences_it_does_not_understand():
+    screen = screen_after("a\x1b]0;title\x07b\x1b[>4;1mc\x1b[31md")
+    assert screen.display()[0] == "abcd"
+
+
+def test_handles_utf8_split_across_feeds():
+    screen = Screen(10, 3)
+    data = "☃".encode('utf-8')
+    screen.feed(data[:1])
+    screen.feed(data[1:])
+    assert screen.display()[0] == "☃"
+
+
+def test_encodes_keys_like_tmux():
+    assert encode_key("Enter") == b"\r"
+    assert encode_key("C-d") == b"\x04"
+    assert encode_key("M-x") == b"\x1bx"
+    assert encode_key("Up") == b"\x1b[A"
+    assert encode_key("Up", application_cursor_keys=True) == b"\x1bOA"
+    assert encode_key("F5") == b"\x1b[15~"
+    assert encode_key("hello") == b"hello"
+
+
+def test_resizing_keeps_the_cursor_on_the_screen():
+    screen = screen_after("a\r\nb\r\nc 中")
+    screen.resize(3, 2)
+    assert screen.display() == ["b", "c"]
+    assert (screen.cursor.x, screen.cursor.y) == (2, 1)
+    screen.resize(5, 4)
+    assert screen.display() == ["b", "c", "", ""]
+    screen.feed(b"\r\n\r\n\r\nd")
+    assert screen.display() == ["c", "", "", "d"]